@@ -53,16 +53,38 @@ class AAADAO(utils.Base):
             ),
         )
 
-    def update(self, value, oldValue):
-        self._updateColumn('users', value, oldValue)
-        self._updateColumn('ad_groups', value, oldValue)
+    def countRows(self, value):
+        return self._statement.execute(
+            statement="""
+                select
+                    (
+                        select count(*)
+                        from users
+                        where domain = %(value)s
+                    ) as users,
+                    (
+                        select count(*)
+                        from ad_groups
+                        where domain = %(value)s
+                    ) as ad_groups
+            """,
+            args=dict(
+                value=value,
+            ),
+        )[0]
+
+    def update(self, value, oldValue, counts=None, progress=None):
+        for table in ('users', 'ad_groups'):
+            self._updateColumn(table, value, oldValue)
+            if progress is not None:
+                progress.update(counts[table])
 
 
 class RollbackError(RuntimeError):
     pass
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         prog='%s-authz-rename' % config.PACKAGE_NAME,
         description=(
@@ -115,8 +137,24 @@ def parse_args():
         metavar='NAME',
         help='new name of authz extension',
     )
+    parser.add_argument(
+        '--create-indexes',
+        dest='createIndexes',
+        default=False,
+        action='store_true',
+        help=(
+            'create missing indexes supporting rename, '
+            'indexes are dropped when rename ends'
+        ),
+    )
+    parser.add_argument(
+        '--profile-cpu',
+        dest='profileCpu',
+        metavar='FILE',
+        help='write cProfile statistics of rename into FILE',
+    )
 
-    args = parser.parse_args(sys.argv[1:])
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
 
     return args
 
@@ -170,6 +208,7 @@ def overrideAuthz(args, engine):
             )
 
             updated = False
+            progress = utils.Progress('Configuration files', unit='files')
             for dname, dirs, files in os.walk(
                 os.path.join(
                     engine.prefix,
@@ -177,6 +216,7 @@ def overrideAuthz(args, engine):
                 )
             ):
                 for fname in files:
+                    progress.update()
                     fpath = os.path.join(dname, fname)
                     with open(fpath, 'r') as f:
                         content = f.read()
@@ -197,15 +237,30 @@ def overrideAuthz(args, engine):
                         ) as f:
                             os.chmod(f.name, 0o644)
                             f.write(newcontent)
-                        aaadao.update(
-                            args.newName,
-                            args.authzName,
-                        )
                         updated = True
+            progress.close()
 
             if not updated:
                 raise RuntimeError('Authz %s was not found.' % args.authzName)
 
+            #
+            # rename statements dominate duration, they are
+            # reported separately of configuration files.
+            #
+            counts = aaadao.countRows(args.authzName)
+            progress = utils.Progress(
+                'Database rows',
+                total=counts['users'] + counts['ad_groups'],
+                unit='rows',
+            )
+            aaadao.update(
+                args.newName,
+                args.authzName,
+                counts=counts,
+                progress=progress,
+            )
+            progress.close()
+
             logger.info('Authz was successfully renamed to %s', args.newName)
 
             if not args.apply:
@@ -214,6 +269,33 @@ def overrideAuthz(args, engine):
                 )
 
 
+def run(args, engine):
+    logger = logging.getLogger(utils.Base.LOG_PREFIX)
+    ret = 1
+    try:
+        with utils.SupportingIndexes(
+            engine=engine,
+            indexes=(
+                ('users', 'domain', args.authzName),
+                ('ad_groups', 'domain', args.authzName),
+            ),
+            enabled=args.createIndexes,
+        ):
+            utils.runProfiled(
+                args.profileCpu,
+                overrideAuthz,
+                args=args,
+                engine=engine,
+            )
+        ret = 0
+    except RollbackError as e:
+        logger.warning('%s', e)
+    except Exception as e:
+        logger.error("Can't override authz configuration: %s", e)
+        logger.debug('Exception', exc_info=True)
+    return ret
+
+
 def main():
     args = parse_args()
     utils.setupLogger(log=args.log, debug=args.debug)
@@ -228,17 +310,7 @@ def main():
 
     engine = utils.Engine(prefix=args.prefix)
     engine.setupEnvironment()
-
-    ret = 1
-    try:
-        overrideAuthz(args=args, engine=engine)
-        ret = 0
-    except RollbackError as e:
-        logger.warning('%s', e)
-    except Exception as e:
-        logger.error("Can't override authz configuration: %s", e)
-        logger.debug('Exception', exc_info=True)
-    return ret
+    return run(args, engine)
 
 
 if __name__ == '__main__':
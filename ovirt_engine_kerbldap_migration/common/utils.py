@@ -1,22 +1,63 @@
+import atexit
 import base64
+import cProfile
+import contextlib
+import ctypes
+import ctypes.util
 import datetime
+import fcntl
+import gc
 import glob
+import gzip
+import hashlib
 import logging
+import logging.handlers
 import os
 import re
+import resource
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
-
-
-from M2Crypto import RSA
+import threading
+import time
 
 
 try:
-    import psycopg2
+    import queue
 except ImportError:
-    raise RuntimeError('Please install python-psycopg2')
+    import Queue as queue
+
+
+class LazyModule(object):
+
+    def __init__(self, name, package, submodules=()):
+        self._lazyName = name
+        self._lazyPackage = package
+        self._lazySubmodules = submodules
+        self._lazyModule = None
+
+    def _load(self):
+        if self._lazyModule is None:
+            try:
+                __import__(self._lazyName)
+                for submodule in self._lazySubmodules:
+                    __import__('%s.%s' % (self._lazyName, submodule))
+            except ImportError:
+                raise RuntimeError('Please install %s' % self._lazyPackage)
+            self._lazyModule = sys.modules[self._lazyName]
+        return self._lazyModule
+
+    def isLoaded(self):
+        return self._lazyModule is not None
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+
+RSA = LazyModule('M2Crypto.RSA', 'm2crypto')
+psycopg2 = LazyModule('psycopg2', 'python-psycopg2')
 
 
 class Base(object):
@@ -39,8 +80,14 @@ class Statement(Base):
 
     _connection = None
 
-    def __init__(self):
+    def __init__(self, release=None):
         super(Statement, self).__init__()
+        self._cursors = 0
+        self._release = release
+        self._latencyObserver = None
+
+    def attach(self, connection):
+        self._connection = connection
 
     def connect(
         self,
@@ -108,10 +155,13 @@ class Statement(Base):
         cursor = None
         try:
             cursor = self._connection.cursor()
+            start = time.time()
             cursor.execute(
                 statement,
                 args,
             )
+            if self._latencyObserver is not None:
+                self._latencyObserver(time.time() - start)
             if cursor.description is not None:
                 cols = [d[0] for d in cursor.description]
                 while True:
@@ -127,6 +177,85 @@ class Statement(Base):
 
         return ret
 
+    def executeIter(
+        self,
+        statement,
+        args=dict(),
+        size=1000,
+    ):
+        self.logger.debug('entry statement=%s %s', statement, args)
+
+        #
+        # server side cursor, held so it
+        # survives intermediate commits.
+        #
+        self._cursors += 1
+        cursor = self._connection.cursor(
+            name='converter_%s' % self._cursors,
+            withhold=True,
+        )
+        try:
+            cursor.itersize = size
+            cursor.execute(
+                statement,
+                args,
+            )
+            cols = None
+            for entry in cursor:
+                if cols is None:
+                    cols = [d[0] for d in cursor.description]
+                yield dict(zip(cols, entry))
+        finally:
+            if not self._connection.closed:
+                cursor.close()
+
+    def commit(self):
+        self.logger.debug('Commit')
+        self._connection.commit()
+
+    def setLatencyObserver(self, observer):
+        self._latencyObserver = observer
+
+    def setTimeouts(self, lockTimeout=None, statementTimeout=None):
+        # session settings, milliseconds
+        for name, value in (
+            ('lock_timeout', lockTimeout),
+            ('statement_timeout', statementTimeout),
+        ):
+            if value is not None:
+                self.execute(
+                    statement='SET %s = %%(value)s' % name,
+                    args=dict(
+                        value=value,
+                    ),
+                )
+
+    def exportSnapshot(self):
+        self.execute(
+            statement='SET TRANSACTION ISOLATION LEVEL REPEATABLE READ',
+        )
+        return self.execute(
+            statement='select pg_export_snapshot() as snapshot',
+        )[0]['snapshot']
+
+    def importSnapshot(self, snapshot):
+        self.execute(
+            statement='SET TRANSACTION ISOLATION LEVEL REPEATABLE READ',
+        )
+        self.execute(
+            statement='SET TRANSACTION SNAPSHOT %(snapshot)s',
+            args=dict(
+                snapshot=snapshot,
+            ),
+        )
+
+    def setAutocommit(self):
+        # not to be reused by transactional jobs
+        self._release = None
+        self._connection.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+        )
+
     def __enter__(self):
         return self
 
@@ -137,14 +266,146 @@ class Statement(Base):
         else:
             self.logger.debug('Rollback')
             self._connection.rollback()
-        self._connection.close()
+        if self._release is not None:
+            self._release(self._connection)
+        else:
+            self._connection.close()
+
+
+class SupportingIndexes(Base):
+
+    PREFIX = 'kerbldap_migration'
+
+    _COST_RE = re.compile(r'cost=[0-9.]+\.\.(?P<cost>[0-9.]+)')
+
+    def __init__(self, engine, indexes, enabled=True):
+        super(SupportingIndexes, self).__init__()
+        self._engine = engine
+        self._indexes = indexes
+        self._enabled = enabled
+        self._created = []
+        self._costs = {}
+
+    def _getStatement(self):
+        #
+        # own connection outside of any transaction,
+        # so indexes can be created concurrently.
+        #
+        statement = self._engine.getStatement()
+        statement.setAutocommit()
+        return statement
+
+    def _isIndexed(self, statement, table, column):
+        for row in statement.execute(
+            statement="""
+                select indexdef
+                from pg_indexes
+                where
+                    schemaname = current_schema() and
+                    tablename = %(table)s
+            """,
+            args=dict(
+                table=table,
+            ),
+        ):
+            if re.search(
+                r'\(\s*"?%s"?\s*[,)]' % re.escape(column),
+                row['indexdef'],
+            ):
+                return True
+        return False
+
+    def _getCost(self, statement, table, column, value):
+        plan = statement.execute(
+            statement=(
+                'explain select 1 from {table} where {column} = %(value)s'
+            ).format(
+                table=table,
+                column=column,
+            ),
+            args=dict(
+                value=value,
+            ),
+        )
+        m = self._COST_RE.search(list(plan[0].values())[0]) if plan else None
+        return float(m.group('cost')) if m else None
+
+    def create(self):
+        with self._getStatement() as statement:
+            for table, column, value in self._indexes:
+                if self._isIndexed(statement, table, column):
+                    self.logger.debug('%s.%s is indexed', table, column)
+                    continue
+                name = '%s_%s_%s' % (self.PREFIX, table, column)
+                self.logger.info('Creating supporting index %s', name)
+                before = self._getCost(statement, table, column, value)
+                self._created.append(name)
+                statement.execute(
+                    statement=(
+                        'drop index concurrently if exists {name}'
+                    ).format(name=name),
+                )
+                statement.execute(
+                    statement=(
+                        'create index concurrently {name} '
+                        'on {table} ({column})'
+                    ).format(
+                        name=name,
+                        table=table,
+                        column=column,
+                    ),
+                )
+                self._costs[name] = (
+                    before,
+                    self._getCost(statement, table, column, value),
+                )
+
+    def drop(self):
+        if not self._created:
+            return
+        with self._getStatement() as statement:
+            for name in self._created:
+                self.logger.info('Dropping supporting index %s', name)
+                statement.execute(
+                    statement=(
+                        'drop index concurrently if exists {name}'
+                    ).format(name=name),
+                )
+        for name, (before, after) in sorted(self._costs.items()):
+            if before is not None and after is not None:
+                self.logger.info(
+                    (
+                        'Supporting index %s reduced estimated lookup cost '
+                        'from %.2f to %.2f'
+                    ),
+                    name,
+                    before,
+                    after,
+                )
+        self._created = []
+
+    def __enter__(self):
+        if self._enabled:
+            self.create()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.drop()
 
 
 class OptionDecrypt(Base):
 
+    _keys = {}
+
     def __init__(self, prefix='/'):
         super(OptionDecrypt, self).__init__()
         pkcs12 = os.path.join(prefix, 'etc/pki/ovirt-engine/keys/engine.p12')
+        key = (pkcs12, os.stat(pkcs12).st_mtime)
+        self._rsa = self._keys.get(key)
+        if self._rsa is None:
+            self._rsa = self._keys[key] = self._loadKey(pkcs12)
+
+    def _loadKey(self, pkcs12):
         password = 'mypass'
         p = subprocess.Popen(
             [
@@ -163,7 +424,7 @@ class OptionDecrypt(Base):
             self.logger.debug('openssl stderr: %s', stderr)
             raise RuntimeError('Failed to execute openssl')
 
-        self._rsa = RSA.load_key_string(stdout)
+        return RSA.load_key_string(stdout)
 
     def decrypt(self, s):
         return self._rsa.private_decrypt(
@@ -244,10 +505,24 @@ class DNS(Base):
         """
     )
 
+    _CACHE_TTL = 300
+
+    _cache = {}
+
     def __init__(self):
         super(DNS, self).__init__()
 
     def resolveSRVRecord(self, domain, protocol, service, port):
+        key = (domain, protocol, service, port)
+        expires, ret = self._cache.get(key, (0, None))
+        if expires > time.time():
+            self.logger.debug('Cached: %s', ret)
+            return ret
+        ret = self._resolveSRVRecord(domain, protocol, service, port)
+        self._cache[key] = (time.time() + self._CACHE_TTL, ret)
+        return ret
+
+    def _resolveSRVRecord(self, domain, protocol, service, port):
         p = subprocess.Popen(
             [
                 'dig',
@@ -288,10 +563,161 @@ class DNS(Base):
 
 class Kerberos(Base):
 
+    #
+    # KRB5_CONFIG is process wide, lookup stages
+    # and daemon jobs may run concurrently.
+    #
+    _krb5ConfigLock = threading.RLock()
+
     def __init__(self, prefix):
         super(Kerberos, self).__init__()
         self._prefix = prefix
         self._cache = None
+        self._memoryCache = None
+        self._principal = None
+        self._credentialKey = None
+        self._krb5conf = None
+
+    def _getKrb5Conf(self, krb5conf):
+        if krb5conf:
+            return krb5conf
+        return os.path.join(
+            self._prefix,
+            'etc/ovirt-engine/krb5.conf',
+        )
+
+    def _acquireInProcess(self, user, password):
+        import gssapi
+        import gssapi.raw
+
+        with self._krb5Config():
+            creds = gssapi.raw.acquire_cred_with_password(
+                gssapi.Name(user, gssapi.NameType.kerberos_principal),
+                self._encodePassword(password),
+                usage='initiate',
+            ).creds
+            gssapi.raw.store_cred_into(
+                {'ccache': self._memoryCache},
+                creds,
+                usage='initiate',
+                overwrite=True,
+            )
+
+    def _encodePassword(self, password):
+        # python-2 argparse provides bytes in locale encoding
+        if isinstance(password, bytes):
+            return password
+        return password.encode('utf-8')
+
+    @contextlib.contextmanager
+    def _krb5Config(self):
+        with self._krb5ConfigLock:
+            backup = os.environ.get('KRB5_CONFIG')
+            os.environ['KRB5_CONFIG'] = self._krb5conf
+            try:
+                yield
+            finally:
+                if backup is None:
+                    del os.environ['KRB5_CONFIG']
+                else:
+                    os.environ['KRB5_CONFIG'] = backup
+
+    def acquire(self, user, password, krb5conf=None):
+        key = (
+            user,
+            hashlib.sha256(self._encodePassword(password)).hexdigest(),
+            self._getKrb5Conf(krb5conf),
+        )
+        if self._credentialKey == key and (
+            self._memoryCache is not None or
+            self._cache is not None
+        ):
+            self.logger.debug('Reusing credentials of %s', user)
+            return
+
+        self.close()
+        self._krb5conf = self._getKrb5Conf(krb5conf)
+        try:
+            import gssapi.raw
+            gssapi.raw.acquire_cred_with_password
+            gssapi.raw.krb5_ccache_name
+        except (ImportError, AttributeError):
+            self.logger.debug('In process gssapi is not available')
+            self.kinit(user, password, krb5conf)
+        else:
+            self.logger.debug('Acquiring credentials in process')
+            self._memoryCache = 'MEMORY:ovirt-kerbldap-%s-%s' % (
+                os.getpid(),
+                id(self),
+            )
+            try:
+                self._acquireInProcess(user, password)
+            except Exception:
+                self._memoryCache = None
+                self.logger.debug('gssapi error', exc_info=True)
+                raise RuntimeError(
+                    'Cannot authenticate to kerberos for account %s' % user
+                )
+        self._principal = user
+        self._credentialKey = key
+
+    @contextlib.contextmanager
+    def credentials(self):
+        if self._memoryCache is None:
+            yield
+        else:
+            #
+            # ccache name is per thread within gssapi, so
+            # concurrent identities do not interfere.
+            #
+            import gssapi.raw
+            with self._krb5Config():
+                previous = gssapi.raw.krb5_ccache_name(
+                    self._memoryCache.encode('utf-8')
+                )
+                try:
+                    yield
+                finally:
+                    gssapi.raw.krb5_ccache_name(previous)
+
+    def _destroyMemoryCache(self):
+        #
+        # gssapi cannot destroy ccache, memory
+        # ccache is process wide within libkrb5.
+        #
+        krb5 = ctypes.CDLL(
+            ctypes.util.find_library('krb5') or 'libkrb5.so.3'
+        )
+        context = ctypes.c_void_p()
+        if krb5.krb5_init_context(ctypes.byref(context)) != 0:
+            raise RuntimeError('Cannot initialize kerberos context')
+        try:
+            ccache = ctypes.c_void_p()
+            if krb5.krb5_cc_resolve(
+                context,
+                self._memoryCache.encode('utf-8'),
+                ctypes.byref(ccache),
+            ) == 0:
+                krb5.krb5_cc_destroy(context, ccache)
+        finally:
+            krb5.krb5_free_context(context)
+
+    def release(self):
+        if self._cache is not None:
+            self.kdestroy()
+            self._principal = None
+
+    def close(self):
+        self.release()
+        if self._memoryCache is not None:
+            try:
+                self._destroyMemoryCache()
+            except Exception:
+                self.logger.warning('Cannot destroy kerberos credentials')
+                self.logger.debug('Exception', exc_info=True)
+            self._memoryCache = None
+        self._principal = None
+        self._credentialKey = None
 
     def kinit(self, user, password, krb5conf=None):
         self.logger.debug('kinit')
@@ -303,14 +729,7 @@ class Kerberos(Base):
             'KRB5_CONFIG': os.environ.get('KRB5_CONFIG'),
         }
         os.environ['KRB5CCNAME'] = 'FILE:%s' % self._cache
-
-        if krb5conf:
-            os.environ['KRB5_CONFIG'] = krb5conf
-        else:
-            os.environ['KRB5_CONFIG'] = os.path.join(
-                self._prefix,
-                'etc/ovirt-engine/krb5.conf',
-            )
+        os.environ['KRB5_CONFIG'] = self._getKrb5Conf(krb5conf)
         p = subprocess.Popen(
             [
                 'kinit',
@@ -347,10 +766,12 @@ class Kerberos(Base):
 
 class FileTransaction(Base):
 
-    _files = []
+    # linux/fs.h FICLONE
+    _FICLONE = 0x40049409
 
     def __init__(self):
         super(FileTransaction, self).__init__()
+        self._files = []
 
     def _copyFile(self, src, dest):
         shutil.copyfile(src, dest)
@@ -362,12 +783,52 @@ class FileTransaction(Base):
             srcStat.st_gid
         )
 
+    def _reflinkFile(self, src, dest):
+        with open(src, 'rb') as fsrc:
+            with open(dest, 'wb') as fdest:
+                fcntl.ioctl(fdest.fileno(), self._FICLONE, fsrc.fileno())
+        shutil.copystat(src, dest)
+        srcStat = os.stat(src)
+        os.chown(
+            dest,
+            srcStat.st_uid,
+            srcStat.st_gid
+        )
+
+    def _backupFile(self, src, dest):
+        #
+        # target is always replaced by rename, so
+        # a hardlink keeps original content intact.
+        #
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            self.logger.debug('Cannot link %s', src, exc_info=True)
+
+        try:
+            self._reflinkFile(src, dest)
+            return
+        except (IOError, OSError):
+            self.logger.debug('Cannot reflink %s', src, exc_info=True)
+            if os.path.exists(dest):
+                os.unlink(dest)
+
+        self._copyFile(src, dest)
+
+    def _fsync(self, name):
+        fd = os.open(name, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
     def getFileName(self, name, forceNew=False):
         if forceNew and os.path.exists(name):
             raise RuntimeError('File %s already exists' % name)
 
         if os.path.exists(name):
-            self._copyFile(
+            self._backupFile(
                 name,
                 '%s.%s' % (
                     name,
@@ -393,14 +854,132 @@ class FileTransaction(Base):
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_type is None:
             self.logger.debug('Commit %s', self._files)
-            for tmpname, name in self._files:
-                if os.path.exists(tmpname):
-                    os.rename(tmpname, name)
+            files = [
+                (tmpname, name) for tmpname, name in self._files
+                if os.path.exists(tmpname)
+            ]
+            for tmpname, name in files:
+                self._fsync(tmpname)
+            dirs = set()
+            for tmpname, name in files:
+                os.rename(tmpname, name)
+                dirs.add(os.path.dirname(os.path.abspath(name)))
+            for d in sorted(dirs):
+                self._fsync(d)
         else:
             self.logger.debug('Rollback')
             for tmpname, name in self._files:
                 if os.path.exists(tmpname):
                     os.unlink(tmpname)
+        self._files = []
+
+
+class TrustStore(Base):
+
+    # line endings may be CRLF, body may be indented
+    _PEM_RE = re.compile(
+        flags=re.DOTALL | re.VERBOSE,
+        pattern=r"""
+            -----BEGIN\ CERTIFICATE-----
+            (?P<body>[A-Za-z0-9+/=\s]*?)
+            -----END\ CERTIFICATE-----
+        """,
+    )
+
+    _JKS_MAGIC = 0xFEEDFEED
+    _JKS_VERSION = 2
+    _JKS_TRUSTED_CERT = 2
+    _JKS_WHITENER = b'Mighty Aphrodite'
+
+    _cache = {}
+
+    def __init__(self, password='changeit', alias='myca'):
+        super(TrustStore, self).__init__()
+        self._password = password
+        self._alias = alias
+
+    def _utf(self, s):
+        s = s.encode('utf-8')
+        return struct.pack('>H', len(s)) + s
+
+    def loadCertificates(self, name):
+        with open(name, 'rb') as f:
+            content = f.read()
+        ret = [
+            base64.b64decode(''.join(m.group('body').split()))
+            for m in self._PEM_RE.finditer(content.decode('ascii', 'ignore'))
+        ]
+        if not ret:
+            if not self._isDER(content):
+                raise RuntimeError(
+                    "Cannot load certificates from '%s', "
+                    "expected PEM or DER certificate" % name
+                )
+            ret = [content]
+        return ret
+
+    def _isDER(self, content):
+        # single SEQUENCE spanning whole content
+        content = bytearray(content)
+        if len(content) < 2 or content[0] != 0x30:
+            return False
+        length = content[1]
+        header = 2
+        if length & 0x80:
+            count = length & 0x7f
+            if count == 0 or count > 4 or len(content) < 2 + count:
+                return False
+            length = 0
+            for b in content[2:2 + count]:
+                length = (length << 8) | b
+            header += count
+        return header + length == len(content)
+
+    def fingerprint(self, certificates):
+        digest = hashlib.sha256()
+        for cert in certificates:
+            digest.update(cert)
+        return digest.hexdigest()
+
+    def toJKS(self, certificates):
+        now = int(time.time() * 1000)
+        data = struct.pack(
+            '>IIi',
+            self._JKS_MAGIC,
+            self._JKS_VERSION,
+            len(certificates),
+        )
+        for i, cert in enumerate(certificates):
+            data += struct.pack('>i', self._JKS_TRUSTED_CERT)
+            data += self._utf(
+                self._alias if i == 0 else '%s-%s' % (self._alias, i)
+            )
+            data += struct.pack('>q', now)
+            data += self._utf('X.509')
+            data += struct.pack('>i', len(cert))
+            data += cert
+
+        digest = hashlib.sha1()
+        digest.update(self._password.encode('utf-16-be'))
+        digest.update(self._JKS_WHITENER)
+        digest.update(data)
+        return data + digest.digest()
+
+    def write(self, cacert, name):
+        certificates = self.loadCertificates(cacert)
+        fingerprint = self.fingerprint(certificates)
+        content = self._cache.get(fingerprint)
+        if content is None:
+            content = self.toJKS(certificates)
+            self._cache[fingerprint] = content
+        self.logger.debug(
+            "Writing '%s' certificates=%s fingerprint=%s",
+            name,
+            len(certificates),
+            fingerprint,
+        )
+        with open(name, 'wb') as f:
+            f.write(content)
 
 
 class Engine(Base):
@@ -413,9 +992,13 @@ class Engine(Base):
     def dataDir(self):
         return self._dataDir
 
-    def __init__(self, prefix='/'):
+    def __init__(self, prefix='/', persistent=False):
         super(Engine, self).__init__()
         self._prefix = prefix
+        self._persistent = persistent
+        self._dbConfig = None
+        self._idleConnections = []
+        self._resources = {}
         if prefix == '/':
             self._dataDir = os.path.join(
                 prefix,
@@ -445,42 +1028,645 @@ class Engine(Base):
                 )[0]
             )
 
-    def getStatement(self):
-        from ovirt_engine import configfile
-        engineConfig = configfile.ConfigFile(
-            files=[
-                os.path.join(
-                    self.dataDir,
-                    'services',
-                    'ovirt-engine',
-                    'ovirt-engine.conf',
-                ),
-                os.path.join(
-                    self.prefix,
-                    'etc',
-                    'ovirt-engine',
-                    'engine.conf',
+    def _getDbConfig(self):
+        if self._dbConfig is None:
+            from ovirt_engine import configfile
+            engineConfig = configfile.ConfigFile(
+                files=[
+                    os.path.join(
+                        self.dataDir,
+                        'services',
+                        'ovirt-engine',
+                        'ovirt-engine.conf',
+                    ),
+                    os.path.join(
+                        self.prefix,
+                        'etc',
+                        'ovirt-engine',
+                        'engine.conf',
+                    ),
+                ],
+            )
+            self._dbConfig = dict(
+                host=engineConfig.get('ENGINE_DB_HOST'),
+                port=engineConfig.get('ENGINE_DB_PORT'),
+                secured=engineConfig.getboolean('ENGINE_DB_SECURED'),
+                securedHostValidation=engineConfig.getboolean(
+                    'ENGINE_DB_SECURED_VALIDATION'
                 ),
-            ],
+                user=engineConfig.get('ENGINE_DB_USER'),
+                password=engineConfig.get('ENGINE_DB_PASSWORD'),
+                database=engineConfig.get('ENGINE_DB_DATABASE'),
+            )
+        return self._dbConfig
+
+    def _releaseConnection(self, connection):
+        try:
+            #
+            # job may leave held cursors or session
+            # settings behind.
+            #
+            cursor = connection.cursor()
+            try:
+                cursor.execute('CLOSE ALL')
+                cursor.execute('RESET ALL')
+            finally:
+                cursor.close()
+            connection.commit()
+            self._idleConnections.append(connection)
+        except psycopg2.Error:
+            self.logger.debug('Dropping connection', exc_info=True)
+            connection.close()
+
+    def _getIdleConnection(self):
+        while self._idleConnections:
+            connection = self._idleConnections.pop()
+            try:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute('SELECT 1')
+                finally:
+                    cursor.close()
+                connection.rollback()
+                return connection
+            except psycopg2.Error:
+                self.logger.debug('Dropping stale connection', exc_info=True)
+                connection.close()
+        return None
+
+    def getStatement(self):
+        if not self._persistent:
+            statement = Statement()
+            statement.connect(**self._getDbConfig())
+            return statement
+
+        statement = Statement(release=self._releaseConnection)
+        connection = self._getIdleConnection()
+        if connection is None:
+            statement.connect(**self._getDbConfig())
+        else:
+            self.logger.debug('Reusing database connection')
+            statement.attach(connection)
+        return statement
+
+    def getResource(self, key, create):
+        if not self._persistent:
+            return create()
+        ret = self._resources.get(key)
+        if ret is None:
+            ret = self._resources[key] = create()
+        else:
+            self.logger.debug('Reusing %s', key[0])
+        return ret
+
+    def close(self):
+        while self._idleConnections:
+            self._idleConnections.pop().close()
+        for e in self._resources.values():
+            close = getattr(e, 'close', None)
+            if close is not None:
+                close()
+        self._resources.clear()
+
+
+class Prefetch(Base):
+
+    _END = object()
+
+    def __init__(self, iterable, size, name):
+        super(Prefetch, self).__init__()
+        self._name = name
+        self._queue = queue.Queue(maxsize=size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(iterable,),
+            name=name,
         )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, iterable):
+        try:
+            for e in iterable:
+                if not self._put((e, None)):
+                    return
+            self._put((self._END, None))
+        except Exception as e:
+            self.logger.debug("Stage '%s' failed", self._name, exc_info=True)
+            self._put((self._END, e))
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+
+    def close(self):
+        self._stop.set()
+
+    def __iter__(self):
+        try:
+            while True:
+                e, error = self._queue.get()
+                if e is self._END:
+                    if error is not None:
+                        raise error
+                    break
+                yield e
+        finally:
+            self._stop.set()
+
+
+class Progress(Base):
 
-        statement = Statement()
-        statement.connect(
-            host=engineConfig.get('ENGINE_DB_HOST'),
-            port=engineConfig.get('ENGINE_DB_PORT'),
-            secured=engineConfig.getboolean('ENGINE_DB_SECURED'),
-            securedHostValidation=engineConfig.getboolean(
-                'ENGINE_DB_SECURED_VALIDATION'
+    _TTY_INTERVAL = 0.5
+    _LOG_INTERVAL = 30
+
+    interactive = True
+
+    def __init__(
+        self,
+        name,
+        total=None,
+        unit='items',
+        interval=None,
+        stream=None,
+    ):
+        super(Progress, self).__init__()
+        self._name = name
+        self._total = total
+        self._unit = unit
+        self._stream = sys.stderr if stream is None else stream
+        self._tty = (
+            self.interactive and
+            hasattr(self._stream, 'isatty') and
+            self._stream.isatty()
+        )
+        if interval is None:
+            interval = self._TTY_INTERVAL if self._tty else self._LOG_INTERVAL
+        self._interval = interval
+        self._start = self._last = time.time()
+        self._lastDone = 0
+        self._pending = False
+        self.done = 0
+        self.notFound = 0
+
+    def _format(self, now, rate):
+        ret = '%s: %s' % (self._name, self.done)
+        if self._total:
+            ret += '/%s (%d%%)' % (
+                self._total,
+                min(100, self.done * 100 // self._total),
+            )
+        ret += ', %.1f %s/s' % (rate, self._unit)
+        if self._total and self.done:
+            remaining = max(0, self._total - self.done) * (
+                (now - self._start) / self.done
+            )
+            ret += ', ETA %s' % datetime.timedelta(seconds=int(remaining))
+        if self.notFound:
+            ret += ', %s not found' % self.notFound
+        return ret
+
+    def update(self, count=1, notFound=0):
+        self.done += count
+        self.notFound += notFound
+        now = time.time()
+        if now - self._last >= self._interval:
+            line = self._format(
+                now,
+                (self.done - self._lastDone) / (now - self._last),
+            )
+            self._last = now
+            self._lastDone = self.done
+            if self._tty:
+                self._stream.write('\r\x1b[K%s' % line)
+                self._stream.flush()
+                self._pending = True
+            else:
+                self.logger.info('%s', line)
+
+    def close(self):
+        if self._pending:
+            self._stream.write('\r\x1b[K')
+            self._stream.flush()
+            self._pending = False
+        now = time.time()
+        self.logger.info(
+            '%s in %s',
+            self._format(now, self.done / max(now - self._start, 1e-6)),
+            datetime.timedelta(seconds=int(now - self._start)),
+        )
+
+
+class Throttle(Base):
+
+    _SMOOTHING = 0.2
+    _ADJUST_INTERVAL = 1
+    _MIN_FACTOR = 0.05
+    _RECOVER_STEP = 0.1
+
+    def __init__(self, rate, latency=None):
+        super(Throttle, self).__init__()
+        self._rate = float(rate)
+        self._latency = latency
+        self._factor = 1.0
+        self._average = None
+        self._next = time.time()
+        self._adjusted = 0
+        self.waited = 0
+
+    def getRate(self):
+        return self._rate * self._factor
+
+    def observe(self, elapsed):
+        if self._average is None:
+            self._average = elapsed
+        else:
+            self._average += self._SMOOTHING * (elapsed - self._average)
+
+        now = time.time()
+        if not self._latency or now - self._adjusted < self._ADJUST_INTERVAL:
+            return
+        if self._average > self._latency:
+            if self._factor > self._MIN_FACTOR:
+                self._factor = max(self._MIN_FACTOR, self._factor / 2)
+                self._adjusted = now
+                self.logger.info(
+                    (
+                        'Database latency %.0f ms is above %.0f ms, '
+                        'slowing down to %.1f rows/s'
+                    ),
+                    self._average * 1000,
+                    self._latency * 1000,
+                    self.getRate(),
+                )
+        elif self._factor < 1:
+            self._factor = min(1.0, self._factor + self._RECOVER_STEP)
+            self._adjusted = now
+            self.logger.debug('Speeding up to %.1f rows/s', self.getRate())
+
+    def wait(self, count=1):
+        now = time.time()
+        if self._next > now:
+            self.waited += self._next - now
+            time.sleep(self._next - now)
+            now = self._next
+        self._next = max(self._next, now) + count / self.getRate()
+
+
+class RateLimiter(Base):
+
+    _INITIAL_RATE = 10.0
+    _MIN_RATE = 1.0
+    _DECREASE = 0.5
+    _INCREASE = 0.05
+    _SMOOTHING = 0.2
+    _ADJUST_INTERVAL = 1
+    _BUSY_DELAY = 1
+    _REPORT_INTERVAL = 60
+
+    def __init__(self, maxRate=None, adaptive=False, latency=None):
+        super(RateLimiter, self).__init__()
+        self._maxRate = maxRate
+        self._adaptive = adaptive
+        self._latency = latency
+        if not adaptive:
+            self._rate = float(maxRate)
+        elif maxRate:
+            self._rate = min(self._INITIAL_RATE, float(maxRate))
+        else:
+            self._rate = self._INITIAL_RATE
+        #
+        # rate is doubled until first sign of
+        # overload, then increased additively.
+        #
+        self._slowStart = True
+        self._limited = False
+        self._average = None
+        self._next = self._adjusted = self._reported = time.time()
+        self._reportedRequests = 0
+        self.stats = dict(requests=0, busy=0, slow=0, highest=self._rate)
+
+    def getRate(self):
+        return self._rate
+
+    def _report(self, now):
+        if now - self._reported >= self._REPORT_INTERVAL:
+            self.logger.info(
+                'Ldap requests %.1f/s, rate limit %.1f/s',
+                (
+                    (self.stats['requests'] - self._reportedRequests) /
+                    (now - self._reported)
+                ),
+                self._rate,
+            )
+            self._reported = now
+            self._reportedRequests = self.stats['requests']
+
+    def acquire(self, count=1):
+        now = time.time()
+        if self._next > now:
+            self._limited = True
+            time.sleep(self._next - now)
+            now = self._next
+        self._next = max(self._next, now) + count / self._rate
+        self.stats['requests'] += count
+        self._report(now)
+
+    def _decrease(self, reason):
+        self._slowStart = False
+        self._adjusted = time.time()
+        rate = max(self._MIN_RATE, self._rate * self._DECREASE)
+        if rate < self._rate:
+            self._rate = rate
+            self.logger.info(
+                'Ldap %s, reducing rate limit to %.1f/s',
+                reason,
+                rate,
+            )
+
+    def observe(self, elapsed):
+        if self._average is None:
+            self._average = elapsed
+        else:
+            self._average += self._SMOOTHING * (elapsed - self._average)
+
+        now = time.time()
+        if (
+            not self._adaptive or
+            now - self._adjusted < self._ADJUST_INTERVAL
+        ):
+            return
+        if self._latency and self._average > self._latency:
+            self.stats['slow'] += 1
+            self._decrease(
+                'latency %.0f ms is above %.0f ms' % (
+                    self._average * 1000,
+                    self._latency * 1000,
+                )
+            )
+        elif self._limited:
+            # requests are waiting for limiter, probe higher rate
+            if self._slowStart:
+                rate = self._rate * 2
+            else:
+                rate = self._rate + max(1.0, self._rate * self._INCREASE)
+            if self._maxRate:
+                rate = min(rate, float(self._maxRate))
+            self._adjusted = now
+            self._limited = False
+            if rate > self._rate:
+                self._rate = rate
+                self.stats['highest'] = max(self.stats['highest'], rate)
+                self.logger.debug('Increasing rate limit to %.1f/s', rate)
+
+    def backoff(self, error):
+        self.stats['busy'] += 1
+        if self._adaptive:
+            self._decrease('server is busy (%s)' % error)
+        else:
+            self.logger.warning(
+                'Ldap server is busy (%s), retrying',
+                error,
+            )
+        time.sleep(self._BUSY_DELAY)
+
+    def logStats(self):
+        self.logger.info(
+            (
+                'Ldap requests %s, busy responses %s, slow periods %s, '
+                'rate limit %.1f/s, highest %.1f/s'
             ),
-            user=engineConfig.get('ENGINE_DB_USER'),
-            password=engineConfig.get('ENGINE_DB_PASSWORD'),
-            database=engineConfig.get('ENGINE_DB_DATABASE'),
+            self.stats['requests'],
+            self.stats['busy'],
+            self.stats['slow'],
+            self._rate,
+            self.stats['highest'],
         )
 
-        return statement
 
+def stage(iterable, size, name):
+    if not size:
+        return iterable
+    return Prefetch(iterable, size, name)
+
+
+def chunks(iterable, size):
+    chunk = []
+    for e in iterable:
+        chunk.append(e)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class MemoryProfiler(Base):
+
+    def __init__(self, enabled=False, top=10):
+        super(MemoryProfiler, self).__init__()
+        self._enabled = enabled
+        self._top = top
+        self._previous = None
+        self._tracemalloc = None
+        if enabled:
+            try:
+                import tracemalloc
+                self._tracemalloc = tracemalloc
+                tracemalloc.start()
+            except ImportError:
+                self.logger.debug(
+                    'tracemalloc is not available, counting objects'
+                )
+
+    def _objectCounts(self):
+        ret = {}
+        for o in gc.get_objects():
+            name = type(o).__name__
+            ret[name] = ret.get(name, 0) + 1
+        return ret
 
-def setupLogger(log=None, debug=False):
+    def snapshot(self, phase):
+        if not self._enabled:
+            return
+
+        if self._tracemalloc is not None:
+            current = self._tracemalloc.take_snapshot().filter_traces((
+                self._tracemalloc.Filter(False, self._tracemalloc.__file__),
+            ))
+            if self._previous is None:
+                stats = current.statistics('lineno')
+            else:
+                stats = current.compare_to(self._previous, 'lineno')
+            top = [str(stat) for stat in stats[:self._top]]
+        else:
+            current = self._objectCounts()
+            previous = self._previous or {}
+            top = [
+                '%s: %+d objects, total %s' % (
+                    name,
+                    current[name] - previous.get(name, 0),
+                    current[name],
+                )
+                for name in sorted(
+                    current,
+                    key=lambda n: current[n] - previous.get(n, 0),
+                    reverse=True,
+                )[:self._top]
+            ]
+        self._previous = current
+
+        self.logger.info(
+            "Memory after '%s', high-water mark %s KiB, top allocations:%s",
+            phase,
+            getMemoryHighWaterMark(),
+            ''.join('\n    %s' % e for e in top),
+        )
+
+
+def runProfiled(profile, func, *args, **kwargs):
+    if profile is None:
+        return func(*args, **kwargs)
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile)
+        logging.getLogger(Base.LOG_PREFIX).info(
+            'CPU profile written to %s',
+            profile,
+        )
+
+
+def getMemoryHighWaterMark():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class AsyncHandler(logging.Handler):
+
+    def __init__(self, handler, size=10000):
+        # logging.Handler is old style class on python-2.6
+        logging.Handler.__init__(self)
+        self._handler = handler
+        self._queue = queue.Queue(size)
+        self._thread = threading.Thread(
+            target=self._run,
+            name='log-writer',
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    break
+                self._handler.handle(record)
+            except Exception:
+                self.handleError(record)
+            finally:
+                self._queue.task_done()
+
+    def emit(self, record):
+        #
+        # arguments may be modified by caller
+        # after return, render them now.
+        #
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # traceback is available only while handled
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        self._queue.put(record)
+
+    def flush(self):
+        if self._thread.is_alive():
+            self._queue.join()
+        self._handler.flush()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._handler.close()
+        logging.Handler.close(self)
+
+
+class GzipRotatingFileHandler(logging.handlers.RotatingFileHandler):
+
+    def _compress(self, source, destination):
+        with open(source, 'rb') as f:
+            out = gzip.open(destination, 'wb')
+            try:
+                shutil.copyfileobj(f, out)
+            finally:
+                out.close()
+        os.unlink(source)
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        for i in range(self.backupCount - 1, 0, -1):
+            source = '%s.%d.gz' % (self.baseFilename, i)
+            if os.path.exists(source):
+                os.rename(
+                    source,
+                    '%s.%d.gz' % (self.baseFilename, i + 1),
+                )
+        if self.backupCount > 0:
+            self._compress(self.baseFilename, '%s.1.gz' % self.baseFilename)
+        self.stream = self._open()
+
+
+def createFileHandler(log, debug=False, rotateSize=None):
+    if rotateSize:
+        # rotating handler always appends
+        open(log, 'w').close()
+        h = GzipRotatingFileHandler(
+            log,
+            maxBytes=rotateSize,
+            backupCount=5,
+        )
+    else:
+        h = logging.FileHandler(log, 'w')
+    h.setLevel(logging.DEBUG if debug else logging.INFO)
+    h.setFormatter(
+        logging.Formatter(
+            fmt=(
+                '%(asctime)-15s '
+                '[%(levelname)-7s] '
+                '%(name)s.%(funcName)s:%(lineno)d '
+                '%(message)s'
+            ),
+        ),
+    )
+    #
+    # formatting and file io are performed by
+    # background thread, drained at close.
+    #
+    h = AsyncHandler(h)
+    h.setLevel(logging.DEBUG if debug else logging.INFO)
+    return h
+
+
+def setupLogger(log=None, debug=False, rotateSize=None):
     logger = logging.getLogger(Base.LOG_PREFIX)
     logger.propagate = False
     logger.setLevel(logging.DEBUG)
@@ -491,6 +1677,8 @@ def setupLogger(log=None, debug=False):
         h.setFormatter(
             logging.Formatter(
                 fmt=(
+                    # clear progress line
+                    ('\r\x1b[K' if h.stream.isatty() else '') +
                     '[%(levelname)-7s] '
                     '%(message)s'
                 ),
@@ -499,19 +1687,9 @@ def setupLogger(log=None, debug=False):
         logger.addHandler(h)
 
         if log is not None:
-            h = logging.StreamHandler(open(log, 'w'))
-            h.setLevel(logging.DEBUG if debug else logging.INFO)
-            h.setFormatter(
-                logging.Formatter(
-                    fmt=(
-                        '%(asctime)-15s '
-                        '[%(levelname)-7s] '
-                        '%(name)s.%(funcName)s:%(lineno)d '
-                        '%(message)s'
-                    ),
-                ),
-            )
+            h = createFileHandler(log, debug=debug, rotateSize=rotateSize)
             logger.addHandler(h)
+            atexit.register(h.close)
     except IOError:
         logging.warning('Cannot initialize logging', exc_info=True)
 
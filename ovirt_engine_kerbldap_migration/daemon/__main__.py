@@ -0,0 +1,396 @@
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+
+try:
+    import argparse
+except ImportError:
+    raise RuntimeError('Please install python-argparse')
+
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+from ..authz_rename import __main__ as authz_rename
+from ..common import config
+from ..common import utils
+from ..tool import __main__ as tool
+
+
+COMMANDS = {
+    'authz-rename': authz_rename,
+    'convert': tool,
+}
+
+
+class JobHandler(logging.Handler):
+
+    def __init__(self, job):
+        # logging.Handler is old style class on python-2.6
+        logging.Handler.__init__(self)
+        self._job = job
+
+    def emit(self, record):
+        self._job.send(
+            type='log',
+            level=record.levelname,
+            message=self.format(record),
+        )
+
+
+class Job(utils.Base):
+
+    def __init__(self, connection):
+        super(Job, self).__init__()
+        self._connection = connection
+        self._disconnected = False
+        self._lock = threading.Lock()
+
+    def send(self, **message):
+        if self._disconnected:
+            return
+        try:
+            with self._lock:
+                self._connection.sendall(
+                    (json.dumps(message) + '\n').encode('utf-8')
+                )
+        except socket.error:
+            #
+            # job is not interrupted, its
+            # outcome is in daemon log.
+            #
+            self._disconnected = True
+            self.logger.debug('Client disconnected', exc_info=True)
+
+    def receive(self):
+        #
+        # jobs are serialized, stalled client
+        # must not block queued clients.
+        #
+        self._connection.settimeout(Daemon.RECEIVE_TIMEOUT)
+        f = self._connection.makefile('rb')
+        try:
+            line = f.readline(Daemon.MAX_REQUEST)
+        except (socket.error, IOError) as e:
+            #
+            # python-2 file object of socket with timeout
+            # reports stall as EAGAIN.
+            #
+            if not isinstance(e, socket.timeout) and e.errno not in (
+                errno.EAGAIN,
+                errno.EWOULDBLOCK,
+            ):
+                raise
+            raise RuntimeError(
+                'Request was not received within %s seconds' % (
+                    Daemon.RECEIVE_TIMEOUT,
+                )
+            )
+        finally:
+            f.close()
+            self._connection.settimeout(None)
+        if not line.endswith(b'\n'):
+            raise RuntimeError('Incomplete request')
+        request = json.loads(line.decode('utf-8'))
+        if not isinstance(request, dict):
+            raise RuntimeError('Invalid request')
+        return request
+
+
+class Daemon(utils.Base):
+
+    MAX_REQUEST = 65536
+    RECEIVE_TIMEOUT = 30
+
+    def __init__(self, socketName):
+        super(Daemon, self).__init__()
+        self._socketName = socketName
+        self._engines = {}
+        self._jobs = 0
+        self._socket = None
+
+    def _getEngine(self, prefix):
+        engine = self._engines.get(prefix)
+        if engine is None:
+            engine = utils.Engine(prefix=prefix, persistent=True)
+            engine.setupEnvironment()
+            self._engines[prefix] = engine
+        return engine
+
+    def _parseArgs(self, module, argv):
+        #
+        # argparse reports usage and errors to stdout/stderr,
+        # those belong to the client.
+        #
+        out = StringIO()
+        backup = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = out
+        try:
+            return module.parse_args(argv)
+        except SystemExit:
+            raise RuntimeError(out.getvalue().strip() or 'Invalid arguments')
+        finally:
+            sys.stdout, sys.stderr = backup
+
+    def runJob(self, job):
+        self._jobs += 1
+        start = time.time()
+        handler = None
+        fileHandler = None
+        ret = 1
+        try:
+            request = job.receive()
+            command = request.get('command')
+            module = COMMANDS.get(command)
+            if module is None:
+                raise RuntimeError("Unknown command '%s'" % command)
+            argv = request.get('args', [])
+            if (
+                not isinstance(argv, list) or
+                not all(isinstance(a, type(u'')) for a in argv)
+            ):
+                raise RuntimeError('Invalid arguments')
+            args = self._parseArgs(module, [str(a) for a in argv])
+
+            handler = JobHandler(job)
+            handler.setLevel(logging.DEBUG if args.debug else logging.INFO)
+            handler.setFormatter(logging.Formatter(fmt='%(message)s'))
+            logging.getLogger(utils.Base.LOG_PREFIX).addHandler(handler)
+            if args.log is not None:
+                fileHandler = utils.createFileHandler(
+                    args.log,
+                    debug=args.debug,
+                    rotateSize=getattr(args, 'logRotate', 0) * 1024 * 1024,
+                )
+                logging.getLogger(utils.Base.LOG_PREFIX).addHandler(
+                    fileHandler
+                )
+
+            self.logger.info('Job %s: %s', self._jobs, command)
+            ret = module.run(args, self._getEngine(args.prefix))
+        except Exception as e:
+            self.logger.error('Job %s: %s', self._jobs, e)
+            self.logger.debug('Exception', exc_info=True)
+            if handler is None:
+                job.send(type='log', level='ERROR', message=str(e))
+        finally:
+            if fileHandler is not None:
+                logging.getLogger(utils.Base.LOG_PREFIX).removeHandler(
+                    fileHandler
+                )
+                fileHandler.close()
+            if handler is not None:
+                logging.getLogger(utils.Base.LOG_PREFIX).removeHandler(
+                    handler
+                )
+            self.logger.info(
+                'Job %s: status %s in %.1f seconds',
+                self._jobs,
+                ret,
+                time.time() - start,
+            )
+            job.send(type='result', status=ret, elapsed=time.time() - start)
+        return ret
+
+    def _removeStaleSocket(self):
+        if not os.path.exists(self._socketName):
+            return
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self._socketName)
+        except socket.error:
+            self.logger.debug('Removing stale socket %s', self._socketName)
+            os.unlink(self._socketName)
+        else:
+            raise RuntimeError(
+                'Daemon is already listening on %s' % self._socketName
+            )
+        finally:
+            s.close()
+
+    def serve(self):
+        # progress is reported to clients using log
+        utils.Progress.interactive = False
+        self._removeStaleSocket()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # jobs carry credentials and act as engine
+        umask = os.umask(0o077)
+        try:
+            self._socket.bind(self._socketName)
+        finally:
+            os.umask(umask)
+        self._socket.listen(5)
+        self.logger.info('Listening on %s', self._socketName)
+        try:
+            #
+            # jobs are serialized, waiting clients
+            # are queued by the listen backlog.
+            #
+            while True:
+                connection, address = self._socket.accept()
+                try:
+                    self.runJob(Job(connection))
+                finally:
+                    connection.close()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            if os.path.exists(self._socketName):
+                os.unlink(self._socketName)
+        for engine in self._engines.values():
+            engine.close()
+        self._engines.clear()
+
+
+def submit(socketName, command, argv, stream=None):
+    if stream is None:
+        stream = sys.stderr
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socketName)
+        s.sendall(
+            (json.dumps(dict(command=command, args=argv)) + '\n').encode(
+                'utf-8'
+            )
+        )
+        f = s.makefile('rb')
+        try:
+            for line in f:
+                message = json.loads(line.decode('utf-8'))
+                if message.get('type') == 'log':
+                    stream.write(
+                        '[%-7s] %s\n' % (
+                            message['level'],
+                            message['message'],
+                        )
+                    )
+                    stream.flush()
+                elif message.get('type') == 'result':
+                    return message['status']
+        finally:
+            f.close()
+    finally:
+        s.close()
+    raise RuntimeError('Daemon closed connection without result')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='%s-daemon' % config.PACKAGE_NAME,
+        description=(
+            'Serve conversion and authz rename jobs over local socket, '
+            'keeping database, kerberos and ldap resources between jobs.'
+        ),
+    )
+    parser.add_argument(
+        '--version',
+        action='version',
+        version='%s-%s (%s)' % (
+            config.PACKAGE_NAME,
+            config.PACKAGE_VERSION,
+            config.LOCAL_VERSION
+        ),
+    )
+    parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help='enable debug log',
+    )
+    parser.add_argument(
+        '--log',
+        metavar='FILE',
+        default=None,
+        help='write log into file',
+    )
+    parser.add_argument(
+        '--socket',
+        dest='socketName',
+        metavar='FILE',
+        default='/var/run/%s.sock' % config.PACKAGE_NAME,
+        help='unix socket to listen on or submit to, default: %(default)s',
+    )
+    parser.add_argument(
+        '--submit',
+        nargs=argparse.REMAINDER,
+        help=(
+            'submit job to running daemon and wait for its result, '
+            'followed by %s and its arguments' % (
+                ' or '.join(sorted(COMMANDS))
+            )
+        ),
+    )
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.submit is not None:
+        if not args.submit or args.submit[0] not in COMMANDS:
+            raise RuntimeError(
+                'Command to submit must be one of: %s' % (
+                    ', '.join(sorted(COMMANDS))
+                )
+            )
+
+    return args
+
+
+def main():
+    try:
+        args = parse_args()
+    except Exception as e:
+        sys.stderr.write('Error: %s\n' % e)
+        return 1
+
+    if args.submit is not None:
+        try:
+            return submit(args.socketName, args.submit[0], args.submit[1:])
+        except Exception as e:
+            sys.stderr.write('Error: %s\n' % e)
+            return 1
+
+    utils.setupLogger(log=args.log, debug=args.debug)
+    logger = logging.getLogger(utils.Base.LOG_PREFIX)
+    logger.info(
+        'daemon: %s-%s (%s)',
+        config.PACKAGE_NAME,
+        config.PACKAGE_VERSION,
+        config.LOCAL_VERSION
+    ),
+    logger.debug('Arguments: %s', args)
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    ret = 1
+    try:
+        Daemon(args.socketName).serve()
+    except (KeyboardInterrupt, SystemExit):
+        ret = 0
+    except Exception as e:
+        logger.error('Daemon failed: %s', e)
+        logger.debug('Exception', exc_info=True)
+    return ret
+
+
+if __name__ == '__main__':
+    os.umask(0o022)
+    sys.exit(main())
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
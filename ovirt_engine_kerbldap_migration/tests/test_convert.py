@@ -0,0 +1,1012 @@
+import base64
+import binascii
+import hashlib
+import json
+import mock
+import os.path
+import pytest
+import sys
+import uuid
+
+from ..tool import __main__ as tool
+
+
+JOURNAL = '/tmp/kerbldap-migration-test.journal'
+
+
+def teardown_function(function):
+    if os.path.exists(JOURNAL):
+        os.unlink(JOURNAL)
+
+
+@pytest.fixture
+def journal():
+    journal = tool.ConversionJournal(JOURNAL)
+    journal.open('myldap.com', 'myldap.com-new-authz')
+    return journal
+
+
+def test_journal_resume(journal):
+    seq = journal.begin('users', [('u1', 'n1'), ('u2', 'n2')])
+    journal.commit(seq, 'users', [('u1', 'n1'), ('u2', 'n2')])
+    journal.begin('ad_groups', [('g1', 'm1')])
+
+    loaded = tool.ConversionJournal(JOURNAL)
+    loaded.load()
+    loaded.open('myldap.com', 'myldap.com-new-authz')
+    assert loaded.getIds('users') == {'u1': 'n1', 'u2': 'n2'}
+    assert loaded.getIds('ad_groups') == {}
+    assert loaded.getAllNewIds('ad_groups') == set(['m1'])
+
+    aaadao = mock.MagicMock()
+    aaadao.fetchExistingIds = mock.MagicMock(return_value=set(['m1']))
+    tool.resolvePendingJournal(loaded, aaadao)
+    assert loaded.getIds('ad_groups') == {'g1': 'm1'}
+    assert loaded.getPending() == []
+
+
+def test_journal_other_domain(journal):
+    loaded = tool.ConversionJournal(JOURNAL)
+    loaded.load()
+    with pytest.raises(RuntimeError) as err:
+        loaded.open('other.com', 'other.com-new-authz')
+    assert 'was created for domain' in str(err)
+
+
+def test_journal_subscription_key(journal):
+    key = ('u1', 'event', 'a@b.c', '', 'EMAIL')
+    seq = journal.begin('event_subscriber', [(key, 'n1')])
+    journal.commit(seq, 'event_subscriber', [(key, 'n1')])
+
+    loaded = tool.ConversionJournal(JOURNAL)
+    loaded.load()
+    assert loaded.getIds('event_subscriber') == {key: 'n1'}
+
+
+def test_chunked_writer_commits(journal):
+    statement = mock.MagicMock()
+    insert = mock.MagicMock()
+    writer = tool.ChunkedWriter(
+        statement=statement,
+        chunkSize=2,
+        journal=journal,
+    )
+    for i in range(5):
+        writer.write('users', 'u%s' % i, 'n%s' % i, insert, {})
+    writer.flush()
+
+    assert insert.call_count == 5
+    assert statement.commit.call_count == 3
+    assert len(journal.getIds('users')) == 5
+
+
+def test_args_chunk_requires_journal():
+    sys.argv = [
+        'tool',
+        '--domain=myldap.com',
+        '--cacert=NONE',
+        '--apply',
+        '--chunk-size=100',
+    ]
+    with pytest.raises(RuntimeError) as err:
+        tool.parse_args()
+    assert 'requires --journal' in str(err)
+
+
+def test_args_journal_requires_chunk():
+    argv = [
+        '--domain=myldap.com',
+        '--cacert=NONE',
+        '--apply',
+        '--journal=%s' % JOURNAL,
+    ]
+    with pytest.raises(RuntimeError) as err:
+        tool.parse_args(argv)
+    assert 'requires --chunk-size' in str(err)
+    assert tool.parse_args(argv + ['--journal-rollback']).journalRollback
+
+
+def test_external_id_ad():
+    driver = tool.ADLDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    legacyId = '0b5b2a7e-1c4f-4a0e-9a55-6f0b1d3e2c11'
+    assert driver.getExternalId(legacyId) == base64.b64encode(
+        uuid.UUID(legacyId).bytes_le
+    )
+
+
+def test_external_id_openldap():
+    driver = tool.OpenLDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    legacyId = '0b5b2a7e-1c4f-4a0e-9a55-6f0b1d3e2c11'
+    assert driver.getExternalId(legacyId) == legacyId
+
+
+def test_external_id_expression():
+
+    def substr(s, start, length=None):
+        return s[start - 1:None if length is None else start - 1 + length]
+
+    def decode(s, format):
+        assert format == 'hex'
+        return binascii.unhexlify(s)
+
+    def encode(b, format):
+        assert format == 'base64'
+        return base64.b64encode(b).decode('utf-8')
+
+    legacyId = '0b5b2a7e-1c4f-4a0e-9a55-6f0b1d3e2c11'
+    for cls in (tool.ADLDAP, tool.RHDSLDAP, tool.OpenLDAP):
+        driver = cls(mock.create_autospec(tool.utils.Kerberos), None)
+        expression = cls.getExternalIdExpression('column').replace('||', '+')
+        # sql functions used by expressions
+        value = eval(
+            expression,
+            dict(
+                column=legacyId.upper() if cls is tool.ADLDAP else legacyId,
+                substr=substr,
+                decode=decode,
+                encode=encode,
+                lower=lambda s: s.lower(),
+                replace=lambda s, old, new: s.replace(old, new),
+            ),
+        )
+        externalId = driver.getExternalId(legacyId)
+        if not isinstance(externalId, str):
+            externalId = externalId.decode('utf-8')
+        assert value == externalId
+
+
+def test_resolve_legacy_entries_buffered():
+    rows = [
+        {'id': str(uuid.uuid4()), 'external_id': 'e%s' % i}
+        for i in range(5)
+    ]
+    resolve = mock.MagicMock(
+        side_effect=lambda ids: dict(
+            (i, {'entryId': i}) for i in ids if i != 'e3'
+        )
+    )
+    first = tool.Record.toUUID(rows[0]['id'])
+    second = tool.Record.toUUID(rows[1]['id'])
+    ids = {first: b'n0', second: b'n1'}
+    result = list(
+        tool.resolveLegacyEntries(
+            tool.pendingLegacyEntries(rows, 'id', ids),
+            resolve,
+            lambda e: e,
+            2,
+        )
+    )
+
+    assert resolve.call_count == 2
+    assert [(r['external_id'], e is not None) for r, e in result] == [
+        ('e2', True),
+        ('e3', False),
+        ('e4', True),
+    ]
+
+
+def test_permission_record():
+    row = dict(
+        id=str(uuid.uuid4()),
+        role_id=str(uuid.uuid4()),
+        ad_element_id=str(uuid.uuid4()),
+        object_id=str(uuid.uuid4()),
+        object_type_id=1,
+    )
+    perm = tool.PermissionRecord.fromRow(row)
+    assert len(perm.id) == 16
+    assert not hasattr(perm, '__dict__')
+    assert perm.toArgs() == row
+
+
+def test_global_catalog_ad():
+    driver = tool.ADLDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    driver.enableGlobalCatalog('forest.com')
+    assert driver._determineBindURI(
+        'child.forest.com',
+        ['gc1.forest.com'],
+        'ldaps',
+        None,
+    ) == ['ldaps://gc1.forest.com:3269']
+
+    user = tool.UserRecord(
+        dn='CN=user1,CN=Users,DC=child,DC=forest,DC=com',
+    )
+    driver._newUser(user)
+    assert user.namespace == 'DC=child,DC=forest,DC=com'
+
+
+def test_guid_lookup_ad():
+    found = str(uuid.uuid4())
+    missing = str(uuid.uuid4())
+    driver = tool.ADLDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    driver._namespace = 'DC=myldap,DC=com'
+    driver._connection = mock.MagicMock()
+    driver._connection.search_ext = mock.MagicMock(side_effect=[1, 2])
+    driver._connection.result = mock.MagicMock(
+        side_effect=[
+            (None, [('CN=user1,DC=myldap,DC=com', {})]),
+            tool.ldap.NO_SUCH_OBJECT(),
+        ]
+    )
+    driver._buildEntry = mock.MagicMock(
+        side_effect=lambda attrs, dn, entry, record: record(
+            dn=dn,
+            entryId=found,
+        )
+    )
+    ret = driver.getUsers([found, missing])
+
+    assert list(ret.keys()) == [found]
+    assert driver._connection.search_ext.call_args_list[0][0][:2] == (
+        '<GUID=%s>' % found,
+        tool.ldap.SCOPE_BASE,
+    )
+
+
+def test_guid_base_ad():
+    driver = tool.ADLDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    objectGUID = binascii.unhexlify('00112233445566778899aabbccddeeff')
+    # legacy id of entry, as stored by engine
+    entryId = '33221100-5544-7766-8899-aabbccddeeff'
+    assert uuid.UUID(entryId).bytes_le == objectGUID
+    assert driver.getExternalId(entryId) == base64.b64encode(objectGUID)
+    assert driver._getGUIDBase(entryId) == (
+        '<GUID=33221100-5544-7766-8899-aabbccddeeff>'
+    )
+
+
+def test_guid_lookup_ad_fallback():
+    driver = tool.ADLDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    driver._namespace = 'DC=myldap,DC=com'
+    driver.search = mock.MagicMock(
+        side_effect=[tool.ldap.UNWILLING_TO_PERFORM(), []]
+    )
+    assert driver.getUser(str(uuid.uuid4())) is None
+    assert driver.search.call_args_list[1][0][1] == tool.ldap.SCOPE_SUBTREE
+    assert not driver._guidLookup
+
+
+def test_search_base_narrowing():
+    driver = tool.OpenLDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    driver._namespace = 'dc=myldap,dc=com'
+    driver._simpleLearnEntries = 2
+    driver.search = mock.MagicMock(
+        return_value=[
+            (
+                'uid=u%s,ou=people,dc=myldap,dc=com' % i,
+                {'entryUUID': ['e%s' % i]},
+            )
+            for i in range(2)
+        ]
+    )
+    driver.getUsers(['e0', 'e1'])
+    assert ','.join(driver._searchBases[tool.UserRecord]) == (
+        'ou=people,dc=myldap,dc=com'
+    )
+
+    driver.search = mock.MagicMock(
+        side_effect=[
+            [],
+            [('uid=u3,ou=admins,dc=myldap,dc=com', {'entryUUID': ['e']})],
+        ]
+    )
+    assert driver.getUser('e') is not None
+    assert driver.search.call_args_list[0][0][0] == (
+        'ou=people,dc=myldap,dc=com'
+    )
+    assert not driver._isNarrowed(tool.UserRecord)
+
+
+def test_search_base_narrowing_rhds():
+    legacyIds = [
+        '12345678-9abc-def0-1234-56789abcdef%s' % i
+        for i in range(3)
+    ]
+    driver = tool.RHDSLDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    driver._namespace = 'dc=myldap,dc=com'
+    driver._simpleLearnEntries = 2
+    driver.search = mock.MagicMock(
+        return_value=[
+            (
+                'uid=u%s,ou=people,dc=myldap,dc=com' % i,
+                {'nsUniqueId': [driver.getExternalId(legacyIds[i])]},
+            )
+            for i in range(2)
+        ]
+    )
+    driver.getUsers(legacyIds[:2])
+    assert driver._isNarrowed(tool.UserRecord)
+
+    driver.search = mock.MagicMock(
+        return_value=[
+            (
+                'uid=u2,ou=people,dc=myldap,dc=com',
+                {'nsUniqueId': [driver.getExternalId(legacyIds[2])]},
+            )
+        ]
+    )
+    assert len(driver.getUsers(legacyIds[2:])) == 1
+    assert driver.search.call_count == 1
+    assert driver.search.call_args_list[0][0][0] == (
+        'ou=people,dc=myldap,dc=com'
+    )
+
+
+def test_search_base_ipa():
+    driver = tool.IPALDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    driver._namespace = 'dc=myldap,dc=com'
+    driver.search = mock.MagicMock(return_value=[])
+    driver.getGroups(['e'])
+    assert driver.search.call_args_list[0][0][0] == (
+        'cn=groups,cn=accounts,dc=myldap,dc=com'
+    )
+
+
+def test_driver_registry():
+    assert tool.getDriver('ad') is tool.ADLDAP
+    with pytest.raises(RuntimeError) as err:
+        tool.getDriver('novell')
+    assert 'not supported' in str(err)
+
+    with mock.patch.dict(tool.DRIVERS, {'custom': 'json:JSONDecoder'}):
+        assert tool.getDriver('custom') is json.JSONDecoder
+
+
+def test_conversion_verifier():
+    perm = tool.PermissionRecord(
+        id=uuid.uuid4().bytes,
+        role_id=uuid.uuid4().bytes,
+        ad_element_id=uuid.uuid4().bytes,
+        object_id=uuid.uuid4().bytes,
+        object_type_id=1,
+    )
+    text = '%s:%s:%s:1' % (
+        uuid.UUID(bytes=perm.role_id),
+        uuid.UUID(bytes=perm.ad_element_id),
+        uuid.UUID(bytes=perm.object_id),
+    )
+    checksum = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+
+    aaadao = mock.MagicMock()
+    aaadao.fetchVerifySummary = mock.MagicMock(
+        side_effect=[
+            {'permissions': (2, 10)},
+            {'permissions': (3, 10 + checksum), 'users': (1, 1)},
+        ]
+    )
+    verifier = tool.ConversionVerifier(aaadao, 'myldap.com-new-authz')
+    verifier.begin()
+    verifier.add('permissions', perm)
+    results = dict((r[0], r[1]) for r in verifier.verify())
+
+    assert results['permissions']
+    assert not results['users']
+    assert results['orphan_permissions']
+
+
+def test_shard_results(tmpdir):
+    names = []
+    for index in (1, 2):
+        name = str(tmpdir.join('shard%s' % index))
+        result = tool.ShardResult(name)
+        result.open('myldap.com', index, 2)
+        for externalId in ('e1', 'e2', 'e3', 'e4'):
+            if tool.ShardResult.getShard(externalId, 2) == index:
+                result.add(
+                    'user',
+                    externalId,
+                    None if externalId == 'e4' else tool.UserRecord(
+                        entryId=externalId,
+                        user_id=b'0123456789abcdef',
+                        username='u-%s' % externalId,
+                    ),
+                )
+        result.complete()
+        names.append(name)
+
+    results = tool.ShardResults(names[:1])
+    with pytest.raises(RuntimeError) as err:
+        results.load('myldap.com')
+    assert 'Missing results of shards: 2/2' in str(err)
+
+    results = tool.ShardResults(names)
+    results.load('myldap.com')
+    users = results.getUsers(['e1', 'e2', 'e4'])
+    assert sorted(users.keys()) == ['e1', 'e2']
+    assert users['e1'].username == 'u-e1'
+    assert users['e1'].user_id != b'0123456789abcdef'
+    with pytest.raises(RuntimeError):
+        results.getUsers(['e5'])
+
+
+def test_args_shard():
+    sys.argv = [
+        'tool',
+        '--domain=myldap.com',
+        '--cacert=NONE',
+        '--shard=3/2',
+        '--shard-output=/tmp/shard',
+    ]
+    with pytest.raises(RuntimeError) as err:
+        tool.parse_args()
+    assert "Invalid shard '3/2'" in str(err)
+
+
+def test_args_throttle_verify_timeout():
+    argv = [
+        'tool',
+        '--domain=myldap.com',
+        '--cacert=NONE',
+        '--throttle=100',
+    ]
+    args = tool.parse_args(argv[1:])
+    assert args.statementTimeout == 60000
+    assert args.verifyStatementTimeout == 0
+
+    args = tool.parse_args(argv[1:] + ['--verify-statement-timeout=600000'])
+    assert args.statementTimeout == 60000
+    assert args.verifyStatementTimeout == 600000
+
+
+def test_ldif_ad(tmpdir):
+    legacyId = '0b5b2a7e-1c4f-4a0e-9a55-6f0b1d3e2c11'
+    name = tmpdir.join('ad.ldif')
+    name.write(
+        'dn: CN=user1,CN=Users,DC=myldap,DC=com\n'
+        'objectguid:: %s\n'
+        'givenName: User\n'
+        'sAMAccountName: user1\n'
+        '\n'
+        'dn: CN=Users,DC=myldap,DC=com\n'
+        'cn: Users\n' % (
+            base64.b64encode(uuid.UUID(legacyId).bytes_le).decode('ascii'),
+        )
+    )
+    driver = tool.LDIFLDAP(
+        tool.ADLDAP(mock.create_autospec(tool.utils.Kerberos), None),
+        str(name),
+        'DC=myldap,DC=com',
+    )
+    driver.load('myldap.com')
+
+    user = driver.getUser(legacyId)
+    assert user.dn == 'CN=user1,CN=Users,DC=myldap,DC=com'
+    assert user.name == 'User'
+    assert user.namespace == 'DC=myldap,DC=com'
+    assert driver.getGroup(str(uuid.uuid4())) is None
+    assert 'vars.domain = myldap.com' in driver.getConfig()
+
+
+def test_ldap_reconnect():
+    driver = tool.OpenLDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    driver._RECONNECT_DELAY = 0
+    driver._uris = ['ldap://ldap1', 'ldap://ldap2']
+    driver._bindURI = 'ldap://ldap1'
+    driver._connection = mock.MagicMock()
+    driver._connection.search_ext_s = mock.MagicMock(
+        side_effect=tool.ldap.SERVER_DOWN()
+    )
+    connection = mock.MagicMock()
+    connection.search_ext_s = mock.MagicMock(return_value=[('dn', {})])
+
+    def bind(uri):
+        if uri == 'ldap://ldap1':
+            raise tool.ldap.SERVER_DOWN()
+        return connection
+
+    driver._bind = mock.MagicMock(side_effect=bind)
+    assert driver.search('', 0, '(objectClass=*)', []) == [('dn', {})]
+    assert driver._bindURI == 'ldap://ldap2'
+
+
+def test_ldap_hedge():
+    driver = tool.OpenLDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    driver._HEDGE_POLL = 0
+    driver._uris = ['ldap://ldap1', 'ldap://ldap2']
+    driver._bindURI = 'ldap://ldap1'
+    driver.enableHedging(after=0.1)
+
+    driver._connection = mock.MagicMock()
+    driver._connection.search_ext = mock.MagicMock(return_value=1)
+    driver._connection.result = mock.MagicMock(
+        side_effect=[tool.ldap.TIMEOUT(), (None, None), (None, None)]
+    )
+    hedge = mock.MagicMock()
+    hedge.search_ext = mock.MagicMock(return_value=2)
+    hedge.result = mock.MagicMock(
+        side_effect=[(None, None), (101, [('dn', {})])]
+    )
+    driver._bind = mock.MagicMock(return_value=hedge)
+
+    assert driver.search('', 0, '(objectClass=*)', []) == [('dn', {})]
+    driver._bind.assert_called_once_with('ldap://ldap2')
+    driver._connection.abandon.assert_called_once_with(1)
+    assert driver._hedgeStats == dict(lookups=1, hedged=1, won=1)
+
+
+def test_parallel_reads():
+    statements = []
+
+    def getStatement():
+        statement = mock.MagicMock()
+        statement.__enter__ = mock.MagicMock(return_value=statement)
+        statement.exportSnapshot.return_value = '00000003-1'
+        statements.append(statement)
+        return statement
+
+    engine = mock.MagicMock()
+    engine.getStatement = getStatement
+    args = mock.MagicMock(parallelReads=True, queueSize=10, bufferSize=10)
+    fetched = []
+
+    def fetch(name):
+        def f(dao):
+            fetched.append(name)
+            return iter([name])
+        return f
+
+    with mock.patch.object(tool, 'AAADAO'):
+        with tool.LegacyReads(
+            engine,
+            args,
+            dict(users=fetch('users'), groups=fetch('groups')),
+        ) as reads:
+            assert len(statements) == 3
+            assert statements[0].__exit__.called
+            for statement in statements[1:]:
+                statement.importSnapshot.assert_called_once_with(
+                    '00000003-1',
+                )
+            assert list(reads.get('users', None)) == ['users']
+            assert list(reads.get('groups', None)) == ['groups']
+    assert sorted(fetched) == ['groups', 'users']
+
+
+def test_ldap_rate_limit_busy():
+    driver = tool.OpenLDAP(mock.create_autospec(tool.utils.Kerberos), None)
+    driver.enableRateLimit(adaptive=True, latency=1)
+    driver._limiter._BUSY_DELAY = 0
+    driver._connection = mock.MagicMock()
+    driver._connection.search_ext_s = mock.MagicMock(
+        side_effect=[tool.ldap.BUSY(), tool.ldap.BUSY(), [('dn', {})]],
+    )
+    assert driver.search('', 0, '(objectClass=*)', []) == [('dn', {})]
+    assert driver._limiter.stats['busy'] == 2
+    assert driver._limiter.getRate() == 2.5
+
+
+def test_ldap_rate_limit_persistent_engine():
+    engine = tool.utils.Engine(persistent=True)
+    argv = ['--domain=myldap.com', '--cacert=NONE']
+    with mock.patch.object(tool.utils, 'VdcOptions') as options, \
+            mock.patch.object(tool.utils, 'OptionDecrypt'), \
+            mock.patch.object(tool.utils, 'Kerberos'), \
+            mock.patch.object(tool.OpenLDAP, 'connect') as connect:
+        options.return_value.getDomainEntry.return_value = dict(
+            provider='openldap',
+            ldapServers=['ldap1.myldap.com'],
+            user='admin',
+            password='secret',
+        )
+
+        domainEntry, driver1 = tool.connectDriver(
+            tool.parse_args(argv + ['--ldap-max-rate=10']),
+            engine,
+            None,
+        )
+        assert driver1._limiter is not None
+
+        domainEntry, driver2 = tool.connectDriver(
+            tool.parse_args(argv),
+            engine,
+            None,
+        )
+        assert driver2 is driver1
+        assert driver2._limiter is None
+
+        domainEntry, driver3 = tool.connectDriver(
+            tool.parse_args(argv + ['--ldap-adaptive-rate']),
+            engine,
+            None,
+        )
+        assert driver3 is driver1
+        assert driver3._limiter is not None
+        assert connect.call_count == 1
+
+
+class Database(object):
+
+    def __init__(self, users=3, groups=2, permissions=True):
+        self.tables = dict(
+            users=[
+                dict(
+                    user_id=str(uuid.uuid4()),
+                    username='user%s' % i,
+                    external_id='u%s' % i,
+                    last_admin_check_status=False,
+                    domain='myldap.com',
+                )
+                for i in range(users)
+            ],
+            ad_groups=[
+                dict(
+                    id=str(uuid.uuid4()),
+                    name='group%s' % i,
+                    external_id='g%s' % i,
+                    domain='myldap.com',
+                )
+                for i in range(groups)
+            ],
+            permissions=[],
+            event_subscriber=[],
+        )
+        if permissions:
+            for e in (
+                self.tables['users'][:1] + self.tables['ad_groups'][:1]
+            ):
+                self.tables['permissions'].append(
+                    dict(
+                        id=str(uuid.uuid4()),
+                        role_id=str(uuid.UUID(int=1)),
+                        ad_element_id=e.get('user_id', e.get('id')),
+                        object_id=str(uuid.UUID(int=2)),
+                        object_type_id=1,
+                    )
+                )
+            self.tables['event_subscriber'].append(
+                dict(
+                    subscriber_id=self.tables['users'][0]['user_id'],
+                    event_up_name='VM_DOWN',
+                    method_address='admin@myldap.com',
+                    tag_name='',
+                    notification_method='EMAIL',
+                )
+            )
+        self.inserts = []
+        self.commits = None
+        self._pending = []
+
+    def insert(self, table, row):
+        self.inserts.append((table, row))
+        self._pending.append((table, row))
+
+    def commit(self):
+        for table, row in self._pending:
+            self.tables[table].append(row)
+        self._pending = []
+
+    def _explicitCommit(self):
+        if self.commits is not None:
+            if not self.commits:
+                raise RuntimeError('Database crashed')
+            self.commits -= 1
+        self.commit()
+
+    def rollback(self):
+        self._pending = []
+
+    def getStatement(self):
+        statement = mock.MagicMock()
+        statement.__enter__ = mock.MagicMock(return_value=statement)
+        statement.__exit__ = mock.MagicMock(
+            side_effect=lambda exc_type, exc_value, tb: (
+                self.rollback() if exc_type else self.commit()
+            ),
+        )
+        statement.commit = mock.MagicMock(side_effect=self._explicitCommit)
+        return statement
+
+    def getRows(self, table, domain=None):
+        return [
+            dict(e) for e in self.tables[table]
+            if domain is None or e['domain'] == domain
+        ]
+
+
+class AAADAO(object):
+
+    def __init__(self, database):
+        self._database = database
+
+    def isAuthzExists(self, authz):
+        return any(
+            self._database.getRows(t, authz) for t in ('users', 'ad_groups')
+        )
+
+    def fetchLegacyUsers(self, legacy_domain, stream=False):
+        return self._database.getRows('users', legacy_domain)
+
+    def fetchLegacyGroups(self, legacy_domain, stream=False):
+        return self._database.getRows('ad_groups', legacy_domain)
+
+    def _isConverted(self, table, row, domain, externalId):
+        assert externalId == 'l.external_id'
+        return any(
+            e['external_id'] == row['external_id']
+            for e in self._database.getRows(table, domain)
+        )
+
+    def fetchPendingLegacyUsers(
+        self,
+        legacy_domain,
+        domain,
+        externalId,
+        stream=False,
+    ):
+        return [
+            e for e in self._database.getRows('users', legacy_domain)
+            if not self._isConverted('users', e, domain, externalId)
+        ]
+
+    def fetchPendingLegacyGroups(
+        self,
+        legacy_domain,
+        domain,
+        externalId,
+        stream=False,
+    ):
+        return [
+            e for e in self._database.getRows('ad_groups', legacy_domain)
+            if not self._isConverted('ad_groups', e, domain, externalId)
+        ]
+
+    def fetchConvertedIds(
+        self,
+        table,
+        column,
+        legacy_domain,
+        domain,
+        externalId,
+    ):
+        assert externalId == 'l.external_id'
+        return [
+            dict(legacy_id=legacy[column], new_id=new[column])
+            for legacy in self._database.getRows(table, legacy_domain)
+            for new in self._database.getRows(table, domain)
+            if legacy['external_id'] == new['external_id']
+        ]
+
+    def fetchAllPermissions(self, stream=False):
+        return [
+            tool.PermissionRecord.fromRow(e)
+            for e in self._database.getRows('permissions')
+        ]
+
+    def fetchAllSubscriptions(self, stream=False):
+        return self._database.getRows('event_subscriber')
+
+    def fetchDomainPermissions(self, domain, stream=False):
+        ids = set(
+            e['user_id'] for e in self._database.getRows('users', domain)
+        ) | set(
+            e['id'] for e in self._database.getRows('ad_groups', domain)
+        )
+        return [
+            tool.PermissionRecord.fromRow(e)
+            for e in self._database.getRows('permissions')
+            if e['ad_element_id'] in ids
+        ]
+
+    def fetchDomainSubscriptions(self, domain, stream=False):
+        ids = set(
+            e['user_id'] for e in self._database.getRows('users', domain)
+        )
+        return [
+            e for e in self._database.getRows('event_subscriber')
+            if e['subscriber_id'] in ids
+        ]
+
+    def countLegacyEntries(self, domain):
+        return dict(
+            users=len(self._database.getRows('users', domain)),
+            ad_groups=len(self._database.getRows('ad_groups', domain)),
+            permissions=len(self._database.getRows('permissions')),
+            event_subscriber=len(self._database.getRows('event_subscriber')),
+        )
+
+    def insertUser(self, user):
+        self._database.insert('users', user.toArgs())
+
+    def insertGroup(self, group):
+        self._database.insert('ad_groups', group.toArgs())
+
+    def insertPermission(self, permission):
+        self._database.insert('permissions', permission.toArgs())
+
+    def insertSubscription(self, subscription):
+        self._database.insert('event_subscriber', dict(subscription))
+
+    def fetchExistingIds(self, table, column, ids):
+        return set(
+            e[column] for e in self._database.getRows(table)
+            if e[column] in ids
+        )
+
+    def isSubscriptionExists(self, subscription):
+        return subscription in self._database.getRows('event_subscriber')
+
+
+class Driver(object):
+
+    def __init__(self, fail=None):
+        self._fail = fail
+        self.lookups = []
+
+    def getExternalId(self, legacyEntryId):
+        return legacyEntryId
+
+    def _getEntries(self, entryIds, record, idName, name):
+        if self._fail:
+            raise RuntimeError(self._fail)
+        self.lookups.extend(entryIds)
+        ret = {}
+        for entryId in entryIds:
+            ret[entryId] = record(entryId=entryId, name=name % entryId)
+            setattr(
+                ret[entryId],
+                idName,
+                uuid.uuid5(uuid.NAMESPACE_OID, entryId).bytes,
+            )
+        return ret
+
+    def getUsers(self, entryIds):
+        ret = self._getEntries(entryIds, tool.UserRecord, 'user_id', '%s')
+        for e in ret.values():
+            e.username = 'new-%s' % e.entryId
+        return ret
+
+    def getGroups(self, entryIds):
+        return self._getEntries(entryIds, tool.GroupRecord, 'id', 'new-%s')
+
+
+def _runConvert(database, argv, driver=None):
+    engine = mock.MagicMock(prefix='/')
+    engine.getStatement = mock.MagicMock(side_effect=database.getStatement)
+    with mock.patch.object(
+        tool,
+        'AAADAO',
+        lambda statement, bufferSize=None: AAADAO(database),
+    ), mock.patch.object(
+        tool,
+        'connectDriver',
+        return_value=(dict(provider='openldap'), driver or Driver()),
+    ), mock.patch.object(tool, 'AAAProfile'), \
+            mock.patch.object(tool, 'ConversionVerifier'), \
+            mock.patch.object(tool.utils, 'VdcOptions') as options:
+        options.return_value.getDomainEntry.return_value = dict(
+            provider='openldap',
+        )
+        tool.convert(
+            tool.parse_args(
+                ['--domain=myldap.com', '--cacert=NONE', '--apply'] + argv
+            ),
+            engine,
+        )
+
+
+def _converted(database):
+    ret = []
+    for table, row in database.inserts:
+        row = dict(row)
+        if table == 'permissions':
+            # new permission id is random
+            row.pop('id')
+        ret.append((table, sorted(row.items())))
+    return ret
+
+
+def test_convert_stages():
+    results = []
+    for argv in (
+        [],
+        ['--queue-size=1', '--buffer-size=1'],
+        ['--queue-size=2', '--parallel-reads'],
+    ):
+        database = Database()
+        _runConvert(database, argv)
+        results.append(_converted(database))
+    assert [len(r) for r in results] == [8, 8, 8]
+    assert results[0] == results[1] == results[2]
+    assert len(database.getRows('users', 'myldap.com-new-authz')) == 3
+
+
+def test_convert_stage_failure():
+    for argv in (
+        [],
+        ['--queue-size=1', '--buffer-size=1'],
+        ['--queue-size=1', '--parallel-reads'],
+    ):
+        database = Database()
+        with pytest.raises(RuntimeError) as err:
+            _runConvert(database, argv, Driver(fail='Directory is down'))
+        assert 'Directory is down' in str(err)
+        assert database.getRows('users', 'myldap.com-new-authz') == []
+
+
+def test_convert_resume_journal():
+    argv = ['--chunk-size=2', '--journal=%s' % JOURNAL]
+    journalCommit = tool.ConversionJournal.commit
+
+    def crashingCommit(self, seq, table, rows):
+        if seq == 2:
+            raise RuntimeError('Crashed')
+        journalCommit(self, seq, table, rows)
+
+    for crash, reinserted in (
+        # database committed second chunk, journal did not
+        (dict(journal=True), 0),
+        # database did not commit second chunk
+        (dict(database=1), 2),
+    ):
+        if os.path.exists(JOURNAL):
+            os.unlink(JOURNAL)
+        database = Database(users=5, permissions=False)
+        database.commits = crash.get('database')
+        with mock.patch.object(
+            tool.ConversionJournal,
+            'commit',
+            crashingCommit if crash.get('journal') else journalCommit,
+        ):
+            with pytest.raises(RuntimeError):
+                _runConvert(database, argv)
+        assert len(database.inserts) == 4
+
+        journal = tool.ConversionJournal(JOURNAL)
+        journal.load()
+        assert [p[0] for p in journal.getPending()] == [2]
+
+        database.commits = None
+        _runConvert(database, argv)
+        assert len(database.inserts) == 4 + 1 + reinserted + 2
+
+        converted = database.getRows('users', 'myldap.com-new-authz')
+        assert sorted(e['external_id'] for e in converted) == [
+            'u%s' % i for i in range(5)
+        ]
+        assert len(database.getRows('ad_groups', 'myldap.com-new-authz')) == 2
+
+        journal = tool.ConversionJournal(JOURNAL)
+        journal.load()
+        assert journal.getPending() == []
+        assert journal.isComplete()
+        assert len(journal.getIds('users')) == 5
+
+
+def test_convert_sync():
+    database = Database()
+    _runConvert(database, [])
+    legacyUser = dict(database.tables['users'][0])
+    legacyUser.update(
+        user_id=str(uuid.uuid4()),
+        username='user3',
+        external_id='u3',
+    )
+    database.tables['users'].append(legacyUser)
+    for e in database.tables['users'][0], legacyUser:
+        database.tables['permissions'].append(
+            dict(
+                id=str(uuid.uuid4()),
+                role_id=str(uuid.UUID(int=3)),
+                ad_element_id=e['user_id'],
+                object_id=str(uuid.UUID(int=2)),
+                object_type_id=1,
+            )
+        )
+    database.inserts = []
+
+    driver = Driver()
+    _runConvert(database, ['--sync'], driver)
+    assert driver.lookups == ['u3']
+    converted = _converted(database)
+    assert [table for table, row in converted] == [
+        'users',
+        'permissions',
+        'permissions',
+    ]
+    assert dict(converted[0][1])['external_id'] == 'u3'
+    assert sorted(
+        dict(row)['ad_element_id'] for table, row in converted[1:]
+    ) == sorted(
+        str(uuid.uuid5(uuid.NAMESPACE_OID, e)) for e in ('u0', 'u3')
+    )
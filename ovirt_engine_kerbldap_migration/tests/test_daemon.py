@@ -0,0 +1,155 @@
+import argparse
+import logging
+import mock
+import os
+import shutil
+import socket
+import threading
+
+from ..daemon import __main__ as daemon
+
+
+TMPDIR = '/tmp/kerbldap-migration-daemon'
+SOCKET = os.path.join(TMPDIR, 'daemon.sock')
+
+
+class Stream(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, s):
+        self.lines.append(s)
+
+    def flush(self):
+        pass
+
+
+class Command(object):
+
+    def __init__(self):
+        self.engines = []
+
+    def parse_args(self, argv):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--domain', required=True)
+        parser.add_argument('--log', default=None)
+        args = parser.parse_args(argv)
+        args.debug = False
+        args.prefix = '/'
+        return args
+
+    def run(self, args, engine):
+        self.engines.append(engine)
+        logging.getLogger('converter.Command').info(
+            'Converting %s',
+            args.domain,
+        )
+        return 0
+
+
+def setup_function(function):
+    if os.path.isdir(TMPDIR):
+        shutil.rmtree(TMPDIR)
+    os.makedirs(TMPDIR)
+    logging.getLogger('converter').setLevel(logging.DEBUG)
+
+
+def teardown_module():
+    if os.path.isdir(TMPDIR):
+        shutil.rmtree(TMPDIR)
+
+
+def _submit(d, command, argv):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(SOCKET)
+    s.listen(1)
+
+    def serve():
+        connection, address = s.accept()
+        try:
+            d.runJob(daemon.Job(connection))
+        finally:
+            connection.close()
+
+    t = threading.Thread(target=serve)
+    t.start()
+    stream = Stream()
+    try:
+        ret = daemon.submit(SOCKET, command, argv, stream=stream)
+    finally:
+        t.join()
+        s.close()
+        os.unlink(SOCKET)
+    return ret, ''.join(stream.lines)
+
+
+def test_daemon_jobs():
+    command = Command()
+    d = daemon.Daemon(SOCKET)
+    with mock.patch.dict(daemon.COMMANDS, {'convert': command}), \
+            mock.patch.object(daemon.utils, 'Engine'):
+        ret, output = _submit(d, 'convert', ['--domain', 'example.com'])
+        assert ret == 0
+        assert '[INFO   ] Converting example.com' in output
+
+        ret, output = _submit(d, 'convert', ['--domain', 'example.org'])
+        assert ret == 0
+        assert len(command.engines) == 2
+        assert command.engines[0] is command.engines[1]
+
+        ret, output = _submit(d, 'convert', [])
+        assert ret == 1
+        assert 'required' in output
+
+        ret, output = _submit(d, 'rename', [])
+        assert ret == 1
+        assert "Unknown command 'rename'" in output
+
+
+def test_daemon_job_log():
+    command = Command()
+    d = daemon.Daemon(SOCKET)
+    log = os.path.join(TMPDIR, 'job.log')
+    with mock.patch.dict(daemon.COMMANDS, {'convert': command}), \
+            mock.patch.object(daemon.utils, 'Engine'):
+        ret, output = _submit(
+            d,
+            'convert',
+            ['--domain', 'example.com', '--log', log],
+        )
+        assert ret == 0
+        ret, output = _submit(d, 'convert', ['--domain', 'example.org'])
+        assert ret == 0
+
+    with open(log) as f:
+        content = f.read()
+    assert 'Converting example.com' in content
+    assert 'example.org' not in content
+
+
+def test_daemon_stalled_client():
+    d = daemon.Daemon(SOCKET)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(SOCKET)
+    s.listen(1)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(SOCKET)
+        connection, address = s.accept()
+        try:
+            with mock.patch.object(daemon.Daemon, 'RECEIVE_TIMEOUT', 0.1):
+                assert d.runJob(daemon.Job(connection)) == 1
+        finally:
+            connection.close()
+        f = client.makefile('rb')
+        try:
+            lines = f.read()
+        finally:
+            f.close()
+        assert b'was not received' in lines
+        assert b'"result"' in lines
+    finally:
+        client.close()
+        s.close()
+        os.unlink(SOCKET)
@@ -83,7 +83,12 @@ def engine1():
 def engine2():
     """ This engine impl already DON'T contains users with specified authz """
     statement = mock.MagicMock()
-    statement.execute = mock.MagicMock(return_value=[])
+    statement.execute = mock.MagicMock(
+        side_effect=lambda statement, args: (
+            [dict(users=3, ad_groups=2)] if 'count(*)' in statement
+            else []
+        )
+    )
     statement.__exit__ = mock.MagicMock(return_value=None)
 
     engine = rename.utils.Engine(prefix=PREFIX)
@@ -152,7 +157,20 @@ def test_rename_with_apply(engine2):
         '--apply',
     ]
     args = rename.parse_args()
-    rename.overrideAuthz(args=args, engine=engine2)
+    with mock.patch.object(rename.utils, 'Progress') as progress:
+        rename.overrideAuthz(args=args, engine=engine2)
+    assert mock.call(
+        'Database rows',
+        total=5,
+        unit='rows',
+    ) in progress.call_args_list
+    assert mock.call().update(3) in progress.mock_calls
+    assert mock.call().update(2) in progress.mock_calls
+    statement = engine2.getStatement.return_value
+    assert len([
+        c for c in statement.execute.call_args_list
+        if 'count(*)' in c[1]['statement']
+    ]) == 1
 
     with open(AUTHZ_FILE) as f:
         AUTHZ_NAME_NEW in f.read()
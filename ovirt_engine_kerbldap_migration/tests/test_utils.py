@@ -0,0 +1,399 @@
+import base64
+import gzip
+import hashlib
+import io
+import logging
+import mock
+import os
+import pytest
+import shutil
+import struct
+import threading
+
+from ..common import utils
+
+
+TMPDIR = '/tmp/kerbldap-migration-utils'
+
+
+def setup_function(function):
+    if os.path.isdir(TMPDIR):
+        shutil.rmtree(TMPDIR)
+    os.makedirs(TMPDIR)
+
+
+def teardown_module():
+    if os.path.isdir(TMPDIR):
+        shutil.rmtree(TMPDIR)
+
+
+def test_filetransaction_commit():
+    name = os.path.join(TMPDIR, 'test.properties')
+    with open(name, 'w') as f:
+        f.write('old')
+
+    with utils.FileTransaction() as filetransaction:
+        with open(filetransaction.getFileName(name), 'w') as f:
+            f.write('new')
+
+    with open(name) as f:
+        assert f.read() == 'new'
+    backups = [
+        f for f in os.listdir(TMPDIR)
+        if f.startswith('test.properties.') and not f.endswith('.tmp')
+    ]
+    assert len(backups) == 1
+    with open(os.path.join(TMPDIR, backups[0])) as f:
+        assert f.read() == 'old'
+
+
+def test_filetransaction_rollback():
+    name = os.path.join(TMPDIR, 'test.properties')
+    try:
+        with utils.FileTransaction() as filetransaction:
+            with open(filetransaction.getFileName(name), 'w') as f:
+                f.write('new')
+            raise RuntimeError('rollback')
+    except RuntimeError:
+        pass
+
+    assert os.listdir(TMPDIR) == []
+
+
+def test_filetransaction_isolated():
+    first = utils.FileTransaction()
+    second = utils.FileTransaction()
+    first.getFileName(os.path.join(TMPDIR, 'first'))
+    assert second._files == []
+
+
+def test_truststore_jks():
+    certs = [b'first certificate', b'second certificate']
+    cacert = os.path.join(TMPDIR, 'ca.crt')
+    with open(cacert, 'w') as f:
+        for cert in certs:
+            f.write(
+                '-----BEGIN CERTIFICATE-----\n'
+                '%s\n'
+                '-----END CERTIFICATE-----\n' % (
+                    base64.b64encode(cert).decode('ascii'),
+                )
+            )
+
+    keystore = os.path.join(TMPDIR, 'profile.jks')
+    truststore = utils.TrustStore()
+    assert truststore.loadCertificates(cacert) == certs
+    truststore.write(cacert, keystore)
+
+    with open(keystore, 'rb') as f:
+        content = f.read()
+    magic, version, count = struct.unpack('>IIi', content[:12])
+    assert magic == 0xFEEDFEED
+    assert version == 2
+    assert count == 2
+    digest = hashlib.sha1()
+    digest.update('changeit'.encode('utf-16-be'))
+    digest.update(b'Mighty Aphrodite')
+    digest.update(content[:-20])
+    assert digest.digest() == content[-20:]
+
+
+def test_truststore_crlf():
+    cert = b'\x30\x03\x02\x01\x01'
+    cacert = os.path.join(TMPDIR, 'ca.crt')
+    with open(cacert, 'wb') as f:
+        f.write(
+            b'-----BEGIN CERTIFICATE-----\r\n' +
+            base64.b64encode(cert) +
+            b'\r\n-----END CERTIFICATE-----\r\n'
+        )
+    truststore = utils.TrustStore()
+    assert truststore.loadCertificates(cacert) == [cert]
+
+    with open(cacert, 'wb') as f:
+        f.write(cert)
+    assert truststore.loadCertificates(cacert) == [cert]
+
+    with open(cacert, 'wb') as f:
+        f.write(b'-----BEGIN CERTIFICATE-----\r\ngarbage')
+    with pytest.raises(RuntimeError) as err:
+        truststore.loadCertificates(cacert)
+    assert 'expected PEM or DER' in str(err.value)
+
+
+def test_stage_prefetch():
+    assert list(utils.stage(iter(range(100)), 3, 'test')) == list(range(100))
+
+
+def test_stage_error():
+    def failing():
+        yield 1
+        raise RuntimeError('stage failure')
+
+    with pytest.raises(RuntimeError) as err:
+        list(utils.stage(failing(), 1, 'test'))
+    assert 'stage failure' in str(err)
+
+
+def test_kerberos_reuse():
+    kerberos = utils.Kerberos('/')
+
+    def kinit(user, password, krb5conf=None):
+        kerberos._cache = '/nonexistent'
+
+    with mock.patch.dict('sys.modules', {'gssapi': None, 'gssapi.raw': None}):
+        kerberos.kinit = mock.MagicMock(side_effect=kinit)
+        kerberos.kdestroy = mock.MagicMock()
+        kerberos.acquire('user@EXAMPLE.COM', 'password')
+        kerberos.acquire('user@EXAMPLE.COM', 'password')
+        assert kerberos.kinit.call_count == 1
+        kerberos.acquire('user@EXAMPLE.COM', 'changed')
+        assert kerberos.kinit.call_count == 2
+        kerberos.acquire('user@EXAMPLE.COM', 'changed', '/tmp/krb5.conf')
+        assert kerberos.kinit.call_count == 3
+        kerberos.acquire(b'user@EXAMPLE.COM', u'p\xe4ss'.encode('utf-8'))
+        assert kerberos.kinit.call_count == 4
+
+
+def test_kerberos_close():
+    kerberos = utils.Kerberos('/')
+    kerberos._memoryCache = 'MEMORY:test'
+    kerberos._credentialKey = ('user@EXAMPLE.COM', '', '/etc/krb5.conf')
+    with mock.patch.object(utils.ctypes, 'CDLL') as cdll:
+        krb5 = cdll.return_value
+        krb5.krb5_init_context.return_value = 0
+        krb5.krb5_cc_resolve.return_value = 0
+        kerberos.close()
+    assert krb5.krb5_cc_resolve.call_args[0][1] == b'MEMORY:test'
+    assert krb5.krb5_cc_destroy.called
+    assert krb5.krb5_free_context.called
+    assert kerberos._memoryCache is None
+    assert kerberos._credentialKey is None
+
+
+def test_lazy_module():
+    module = utils.LazyModule('kerbldap_nonexistent', 'nonexistent')
+    assert not module.isLoaded()
+    with pytest.raises(RuntimeError) as err:
+        module.name
+    assert 'Please install nonexistent' in str(err)
+
+    module = utils.LazyModule('json', 'json')
+    assert module.loads('[]') == []
+    assert module.isLoaded()
+
+
+def test_progress():
+    stream = io.StringIO()
+    progress = utils.Progress('users', total=4, interval=0, stream=stream)
+    for i in range(4):
+        progress.update(notFound=i == 3)
+    progress.close()
+
+    assert progress.done == 4
+    assert progress.notFound == 1
+    assert stream.getvalue() == ''
+    assert progress._format(progress._start + 2, 2.0) == (
+        'users: 4/4 (100%), 2.0 items/s, ETA 0:00:00, 1 not found'
+    )
+
+
+def test_memory_profiler():
+    with mock.patch.dict('sys.modules', {'tracemalloc': None}):
+        profiler = utils.MemoryProfiler(enabled=True, top=3)
+    profiler.logger.info = mock.MagicMock()
+    profiler.snapshot('setup')
+    keep = [[] for i in range(1000)]
+    profiler.snapshot('users')
+    top = profiler.logger.info.call_args[0][3]
+    assert top.startswith('\n    list: +')
+    assert keep
+
+
+def test_run_profiled():
+    path = os.path.join(TMPDIR, 'cpu.pstats')
+    assert utils.runProfiled(path, sum, [1, 2]) == 3
+    assert os.path.exists(path)
+    assert utils.runProfiled(None, sum, [1, 2]) == 3
+
+
+def test_supporting_indexes():
+    statement = mock.MagicMock()
+    statement.__enter__ = mock.MagicMock(return_value=statement)
+    statement.execute = mock.MagicMock(
+        side_effect=lambda statement, args=None: (
+            [{'indexdef': 'CREATE INDEX i ON users USING btree (domain)'}]
+            if 'pg_indexes' in statement and args['table'] == 'users'
+            else [{'QUERY PLAN': 'Seq Scan on t  (cost=0.00..100.50 rows=1)'}]
+            if statement.startswith('explain') else []
+        )
+    )
+    engine = mock.MagicMock()
+    engine.getStatement = mock.MagicMock(return_value=statement)
+
+    with utils.SupportingIndexes(
+        engine,
+        (('users', 'domain', 'x'), ('ad_groups', 'domain', 'x')),
+    ):
+        executed = [c[2]['statement'] for c in statement.execute.mock_calls]
+    assert (
+        'create index concurrently kerbldap_migration_ad_groups_domain '
+        'on ad_groups (domain)'
+    ) in executed
+    assert not [s for s in executed if 'migration_users_domain' in s]
+    executed = [c[2]['statement'] for c in statement.execute.mock_calls]
+    assert executed[-1] == (
+        'drop index concurrently if exists '
+        'kerbldap_migration_ad_groups_domain'
+    )
+
+
+def test_async_handler_rotation():
+    name = os.path.join(TMPDIR, 'test.log')
+    target = utils.GzipRotatingFileHandler(name, maxBytes=100, backupCount=2)
+    target.setFormatter(logging.Formatter(fmt='%(message)s'))
+    handler = utils.AsyncHandler(target, size=2)
+    logger = logging.getLogger('kerbldap-migration-test')
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for i in range(10):
+            logger.error('message %s %s', i, 'x' * 40)
+        handler.flush()
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+    with open(name) as f:
+        assert f.read().splitlines()[-1].startswith('message 9 ')
+    with gzip.open('%s.1.gz' % name) as f:
+        assert f.read().decode('utf-8').startswith('message ')
+    assert os.path.exists('%s.2.gz' % name)
+    assert not os.path.exists('%s.3.gz' % name)
+
+
+def test_async_handler_render():
+
+    class Target(logging.Handler):
+
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.started = threading.Event()
+            self.messages = []
+
+        def handle(self, record):
+            self.started.wait()
+            self.messages.append(self.format(record))
+
+    target = Target()
+    handler = utils.AsyncHandler(target)
+    logger = logging.getLogger('kerbldap-migration-test')
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        values = ['before']
+        logger.error('values %s', values)
+        values[0] = 'after'
+        target.started.set()
+        handler.flush()
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    assert target.messages == ["values ['before']"]
+
+
+def test_persistent_engine():
+    connections = []
+
+    def connect(self, **kwargs):
+        connection = mock.MagicMock(closed=False)
+        connections.append(connection)
+        self.attach(connection)
+
+    engine = utils.Engine(persistent=True)
+    engine._dbConfig = {}
+    with mock.patch.object(utils.Statement, 'connect', connect), \
+            mock.patch.object(utils, 'psycopg2'):
+        with engine.getStatement():
+            pass
+        with engine.getStatement():
+            pass
+        statement = engine.getStatement()
+        statement.setAutocommit()
+        with statement:
+            pass
+        with engine.getStatement():
+            pass
+
+    # autocommit connection is not reused
+    assert len(connections) == 2
+    assert connections[0].close.called
+    assert not connections[1].close.called
+    cursor = connections[0].cursor.return_value
+    assert mock.call('RESET ALL') in cursor.execute.mock_calls
+    assert engine.getResource(('x',), object) is engine.getResource(
+        ('x',),
+        object,
+    )
+    resource = engine.getResource(('y',), mock.MagicMock)
+    engine.close()
+    assert connections[1].close.called
+    assert resource.close.called
+
+
+def test_throttle():
+    now = [1000.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    with mock.patch.object(utils.time, 'time', lambda: now[0]), \
+            mock.patch.object(utils.time, 'sleep', sleep):
+        throttle = utils.Throttle(10, latency=0.05)
+        for i in range(5):
+            throttle.wait()
+        assert abs(now[0] - 1000.4) < 1e-6
+
+        now[0] += 2
+        throttle.observe(0.5)
+        assert throttle.getRate() == 5
+        throttle.observe(0.5)
+        assert throttle.getRate() == 5
+
+        for i in range(20):
+            throttle.observe(0.001)
+        now[0] += 2
+        throttle.observe(0.001)
+        assert throttle.getRate() > 5
+
+
+def test_rate_limiter():
+    now = [1000.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    with mock.patch.object(utils.time, 'time', lambda: now[0]), \
+            mock.patch.object(utils.time, 'sleep', sleep):
+        limiter = utils.RateLimiter(maxRate=30, adaptive=True, latency=0.1)
+        assert limiter.getRate() == 10
+        for i in range(11):
+            limiter.acquire()
+            limiter.observe(0.01)
+        assert limiter.getRate() == 20
+        for i in range(21):
+            limiter.acquire()
+            limiter.observe(0.01)
+        assert limiter.getRate() == 30
+
+        now[0] += 1
+        limiter.observe(1)
+        assert limiter.getRate() == 15
+        assert limiter.stats['slow'] == 1
+        assert limiter.stats['highest'] == 30
+
+        fixed = utils.RateLimiter(maxRate=5)
+        for i in range(50):
+            fixed.acquire()
+            fixed.observe(0.01)
+        assert fixed.getRate() == 5
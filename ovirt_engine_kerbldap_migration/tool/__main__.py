@@ -1,24 +1,19 @@
 # Note you need cyrus-sasl-gssapi package
 import base64
+import collections
 import grp
+import hashlib
+import json
 import logging
 import os
 import pwd
 import re
-import subprocess
 import sys
+import time
 import urlparse
 import uuid
 
 
-try:
-    import ldap
-    import ldap.filter
-    import ldap.sasl
-except ImportError:
-    raise RuntimeError('Please install python-ldap')
-
-
 try:
     import argparse
 except ImportError:
@@ -29,6 +24,116 @@ from ..common import config
 from ..common import utils
 
 
+ldap = utils.LazyModule(
+    'ldap',
+    'python-ldap',
+    ('controls', 'dn', 'filter', 'sasl'),
+)
+ldif = utils.LazyModule('ldif', 'python-ldap')
+
+
+class Record(object):
+
+    __slots__ = ()
+    _uuids = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    @staticmethod
+    def toUUID(s):
+        return None if s is None else uuid.UUID(s).bytes
+
+    @staticmethod
+    def fromUUID(b):
+        return None if b is None else str(uuid.UUID(bytes=b))
+
+    @classmethod
+    def fromRow(cls, row):
+        ret = cls()
+        for name in cls.__slots__:
+            value = row.get(name)
+            if name in cls._uuids:
+                value = cls.toUUID(value)
+            setattr(ret, name, value)
+        return ret
+
+    def toArgs(self):
+        ret = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if name in self._uuids:
+                value = self.fromUUID(value)
+            ret[name] = value
+        return ret
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.toArgs())
+
+
+class UserRecord(Record):
+
+    __slots__ = (
+        'dn',
+        'entryId',
+        'name',
+        'surname',
+        'email',
+        'department',
+        'username',
+        'user_id',
+        'namespace',
+        'domain',
+        'last_admin_check_status',
+    )
+    _uuids = ('user_id',)
+
+    @property
+    def external_id(self):
+        return self.entryId
+
+    def toArgs(self):
+        ret = super(UserRecord, self).toArgs()
+        ret['external_id'] = self.external_id
+        return ret
+
+
+class GroupRecord(Record):
+
+    __slots__ = (
+        'dn',
+        'entryId',
+        'name',
+        'description',
+        'id',
+        'namespace',
+        'domain',
+    )
+    _uuids = ('id',)
+
+    @property
+    def external_id(self):
+        return self.entryId
+
+    def toArgs(self):
+        ret = super(GroupRecord, self).toArgs()
+        ret['external_id'] = self.external_id
+        return ret
+
+
+class PermissionRecord(Record):
+
+    __slots__ = (
+        'id',
+        'role_id',
+        'ad_element_id',
+        'object_id',
+        'object_type_id',
+    )
+    _uuids = ('id', 'role_id', 'ad_element_id', 'object_id')
+
+
 class AAADAO(utils.Base):
 
     _legacyAttrs = {
@@ -56,10 +161,29 @@ class AAADAO(utils.Base):
             ):
                 del self._legacyAttrs[attr]
 
-    def __init__(self, statement):
+    def __init__(self, statement, bufferSize=None):
         self._statement = statement
+        self._bufferSize = bufferSize
         self._fetchLegacyAttributes()
 
+    def _query(self, statement, args=dict(), stream=False, record=None):
+        if stream and self._bufferSize:
+            ret = self._statement.executeIter(
+                statement=statement,
+                args=args,
+                size=self._bufferSize,
+            )
+            if record is not None:
+                ret = (record.fromRow(e) for e in ret)
+        else:
+            ret = self._statement.execute(
+                statement=statement,
+                args=args,
+            )
+            if record is not None:
+                ret = [record.fromRow(e) for e in ret]
+        return ret
+
     def isAuthzExists(self, authz):
         return len(
             self._statement.execute(
@@ -78,8 +202,8 @@ class AAADAO(utils.Base):
             )
         ) != 0
 
-    def fetchLegacyUsers(self, legacy_domain):
-        users = self._statement.execute(
+    def fetchLegacyUsers(self, legacy_domain, stream=False):
+        users = self._query(
             statement="""
                 select user_id, username, external_id, last_admin_check_status
                 from users
@@ -88,12 +212,13 @@ class AAADAO(utils.Base):
             args=dict(
                 legacy_domain=legacy_domain,
             ),
+            stream=stream,
         )
 
         return users
 
-    def fetchLegacyGroups(self, legacy_domain):
-        groups = self._statement.execute(
+    def fetchLegacyGroups(self, legacy_domain, stream=False):
+        groups = self._query(
             statement="""
                 select id, name, external_id
                 from ad_groups
@@ -102,20 +227,275 @@ class AAADAO(utils.Base):
             args=dict(
                 legacy_domain=legacy_domain,
             ),
+            stream=stream,
         )
 
         return groups
 
-    def fetchAllPermissions(self):
-        return self._statement.execute(
-            statement="""select * from permissions""",
+    def fetchPendingLegacyUsers(
+        self,
+        legacy_domain,
+        domain,
+        externalId,
+        stream=False,
+    ):
+        return self._query(
+            statement="""
+                select
+                    l.user_id,
+                    l.username,
+                    l.external_id,
+                    l.last_admin_check_status
+                from users l
+                where
+                    l.domain = %(legacy_domain)s and
+                    not exists (
+                        select 1
+                        from users n
+                        where
+                            n.domain = %(domain)s and
+                            n.external_id = {externalId}
+                    )
+            """.format(
+                externalId=externalId,
+            ),
+            args=dict(
+                legacy_domain=legacy_domain,
+                domain=domain,
+            ),
+            stream=stream,
         )
 
-    def fetchAllSubscriptions(self):
-        return self._statement.execute(
+    def fetchPendingLegacyGroups(
+        self,
+        legacy_domain,
+        domain,
+        externalId,
+        stream=False,
+    ):
+        return self._query(
+            statement="""
+                select l.id, l.name, l.external_id
+                from ad_groups l
+                where
+                    l.domain = %(legacy_domain)s and
+                    not exists (
+                        select 1
+                        from ad_groups n
+                        where
+                            n.domain = %(domain)s and
+                            n.external_id = {externalId}
+                    )
+            """.format(
+                externalId=externalId,
+            ),
+            args=dict(
+                legacy_domain=legacy_domain,
+                domain=domain,
+            ),
+            stream=stream,
+        )
+
+    def fetchConvertedIds(
+        self,
+        table,
+        column,
+        legacy_domain,
+        domain,
+        externalId,
+    ):
+        return self._query(
+            statement="""
+                select l.{column} as legacy_id, n.{column} as new_id
+                from {table} l, {table} n
+                where
+                    l.domain = %(legacy_domain)s and
+                    n.domain = %(domain)s and
+                    n.external_id = {externalId}
+            """.format(
+                table=table,
+                column=column,
+                externalId=externalId,
+            ),
+            args=dict(
+                legacy_domain=legacy_domain,
+                domain=domain,
+            ),
+        )
+
+    def fetchAllPermissions(self, stream=False):
+        return self._query(
+            statement="""
+                select id, role_id, ad_element_id, object_id, object_type_id
+                from permissions
+            """,
+            stream=stream,
+            record=PermissionRecord,
+        )
+
+    def fetchAllSubscriptions(self, stream=False):
+        return self._query(
             statement="""select * from event_subscriber""",
+            stream=stream,
+        )
+
+    def fetchDomainPermissions(self, domain, stream=False):
+        return self._query(
+            statement="""
+                select id, role_id, ad_element_id, object_id, object_type_id
+                from permissions
+                where ad_element_id in (
+                    select user_id
+                    from users
+                    where domain = %(domain)s
+                    union
+                    select id
+                    from ad_groups
+                    where domain = %(domain)s
+                )
+            """,
+            args=dict(
+                domain=domain,
+            ),
+            stream=stream,
+            record=PermissionRecord,
+        )
+
+    def fetchDomainSubscriptions(self, domain, stream=False):
+        return self._query(
+            statement="""
+                select *
+                from event_subscriber
+                where subscriber_id in (
+                    select user_id
+                    from users
+                    where domain = %(domain)s
+                )
+            """,
+            args=dict(
+                domain=domain,
+            ),
+            stream=stream,
         )
 
+    def fetchVerifySummary(self, domain):
+        #
+        # checksum is sum of first 32 bits of md5 of each row,
+        # so it can be accumulated while rows are written.
+        #
+        ret = {}
+        for row in self._statement.execute(
+            statement="""
+                select
+                    'users' as name,
+                    count(*) as count,
+                    sum(
+                        ('x' || substr(md5(user_id::text), 1, 8))::
+                        bit(32)::bigint
+                    ) as checksum
+                from users
+                where domain = %(domain)s
+                union all
+                select
+                    'ad_groups' as name,
+                    count(*) as count,
+                    sum(
+                        ('x' || substr(md5(id::text), 1, 8))::
+                        bit(32)::bigint
+                    ) as checksum
+                from ad_groups
+                where domain = %(domain)s
+                union all
+                select
+                    'permissions' as name,
+                    count(*) as count,
+                    sum(
+                        (
+                            'x' || substr(
+                                md5(
+                                    role_id::text || ':' ||
+                                    ad_element_id::text || ':' ||
+                                    object_id::text || ':' ||
+                                    object_type_id::text
+                                ),
+                                1,
+                                8
+                            )
+                        )::bit(32)::bigint
+                    ) as checksum
+                from permissions
+                where ad_element_id in (
+                    select user_id
+                    from users
+                    where domain = %(domain)s
+                    union
+                    select id
+                    from ad_groups
+                    where domain = %(domain)s
+                )
+                union all
+                select
+                    'event_subscriber' as name,
+                    count(*) as count,
+                    sum(
+                        (
+                            'x' || substr(
+                                md5(
+                                    subscriber_id::text || ':' ||
+                                    coalesce(event_up_name::text, '') ||
+                                    ':' ||
+                                    coalesce(method_address::text, '') ||
+                                    ':' ||
+                                    coalesce(tag_name::text, '') || ':' ||
+                                    coalesce(notification_method::text, '')
+                                ),
+                                1,
+                                8
+                            )
+                        )::bit(32)::bigint
+                    ) as checksum
+                from event_subscriber
+                where subscriber_id in (
+                    select user_id
+                    from users
+                    where domain = %(domain)s
+                )
+                union all
+                select
+                    'orphan_permissions' as name,
+                    count(*) as count,
+                    0 as checksum
+                from permissions p
+                where
+                    not exists (
+                        select 1
+                        from users u
+                        where u.user_id = p.ad_element_id
+                    ) and
+                    not exists (
+                        select 1
+                        from ad_groups g
+                        where g.id = p.ad_element_id
+                    )
+                union all
+                select
+                    'orphan_subscriptions' as name,
+                    count(*) as count,
+                    0 as checksum
+                from event_subscriber e
+                where not exists (
+                    select 1
+                    from users u
+                    where u.user_id = e.subscriber_id
+                )
+            """,
+            args=dict(
+                domain=domain,
+            ),
+        ):
+            ret[row['name']] = (row['count'], int(row['checksum'] or 0))
+        return ret
+
     def insertPermission(self, permission):
         self._statement.execute(
             statement="""
@@ -133,7 +513,7 @@ class AAADAO(utils.Base):
                     %(object_type_id)s
                 )
             """,
-            args=permission,
+            args=permission.toArgs(),
         )
 
     def insertUser(self, user):
@@ -180,7 +560,7 @@ class AAADAO(utils.Base):
                     '' if not self._legacyAttrs.values() else ','
                 )
             ),
-            args=user,
+            args=user.toArgs(),
         )
 
     def insertGroup(self, group):
@@ -202,9 +582,88 @@ class AAADAO(utils.Base):
                     %(namespace)s
                 )
             """,
-            args=group,
+            args=group.toArgs(),
+        )
+
+    def countLegacyEntries(self, domain):
+        return self._statement.execute(
+            statement="""
+                select
+                    (
+                        select count(*)
+                        from users
+                        where domain = %(domain)s
+                    ) as users,
+                    (
+                        select count(*)
+                        from ad_groups
+                        where domain = %(domain)s
+                    ) as ad_groups,
+                    (
+                        select count(*)
+                        from permissions
+                    ) as permissions,
+                    (
+                        select count(*)
+                        from event_subscriber
+                    ) as event_subscriber
+            """,
+            args=dict(
+                domain=domain,
+            ),
+        )[0]
+
+    def fetchExistingIds(self, table, column, ids):
+        if not ids:
+            return set()
+        return set(
+            str(e['id']) for e in self._statement.execute(
+                statement="""
+                    select {column} as id
+                    from {table}
+                    where {column} = any(%(ids)s::uuid[])
+                """.format(
+                    table=table,
+                    column=column,
+                ),
+                args=dict(
+                    ids=list(ids),
+                ),
+            )
         )
 
+    def isSubscriptionExists(self, subscription):
+        return len(
+            self._statement.execute(
+                statement="""
+                    select 1
+                    from event_subscriber
+                    where
+                        subscriber_id = %(subscriber_id)s and
+                        event_up_name = %(event_up_name)s and
+                        method_address = %(method_address)s and
+                        tag_name = %(tag_name)s and
+                        notification_method = %(notification_method)s
+                """,
+                args=subscription,
+            )
+        ) != 0
+
+    def deleteRows(self, table, column, ids):
+        if ids:
+            self._statement.execute(
+                statement="""
+                    delete from {table}
+                    where {column} = any(%(ids)s::uuid[])
+                """.format(
+                    table=table,
+                    column=column,
+                ),
+                args=dict(
+                    ids=list(ids),
+                ),
+            )
+
     def insertSubscription(self, subscription):
         self._statement.execute(
             statement="""
@@ -239,12 +698,36 @@ class LDAP(utils.Base):
     _cacert = None
     _protocol = None
     _secure = None
+    _searchControls = None
+    _uris = ()
+
+    _RECONNECT_RETRIES = 5
+    _RECONNECT_DELAY = 1
+    _RECONNECT_MAX_DELAY = 30
+
+    _hedge = False
+    _hedgeAfter = None
+    _hedgeDelay = None
+    _hedgeConnection = None
+    _hedgeStats = None
+
+    _HEDGE_SAMPLES = 1000
+    _HEDGE_RECALC = 100
+    _HEDGE_MIN_DELAY = 0.05
+    _HEDGE_POLL = 0.001
+
+    _limiter = None
+
+    _BUSY_RETRIES = 5
 
     def __init__(self, kerberos, profile):
         super(LDAP, self).__init__()
         self._kerberos = kerberos
         self._profile = profile
 
+    def close(self):
+        self._kerberos.close()
+
     def determineNamespace(self, connection=None):
         return None
 
@@ -285,10 +768,25 @@ class LDAP(utils.Base):
     def _encodeLdapId(self, entryId):
         return entryId
 
-    def _getEntryById(self, attrs, entryId):
+    def getExternalId(self, legacyEntryId):
+        return self._encodeLdapId(self._decodeLegacyEntryId(legacyEntryId))
+
+    @classmethod
+    def getExternalIdExpression(cls, column):
+        # sql of getExternalId
+        return column
+
+    def _buildEntry(self, attrs, dn, entry, record):
+        ret = record(dn=dn)
+        for k, v in attrs.items():
+            setattr(ret, k, entry.get(v, [''])[0])
+        ret.entryId = self._encodeLdapId(ret.entryId)
+        return ret
+
+    def _getEntryById(self, attrs, entryId, record, base=None):
         ret = None
         result = self.search(
-            self.getNamespace(),
+            base or self.getSearchBase(),
             ldap.SCOPE_SUBTREE,
             '(%s=%s)' % (
                 attrs['entryId'],
@@ -297,12 +795,27 @@ class LDAP(utils.Base):
             attrs.values(),
         )
         if result and result[0][0] is not None:
-            entry = result[0][1]
-            ret = {}
-            ret['__dn'] = result[0][0]
-            for k, v in attrs.items():
-                ret[k] = entry.get(v, [''])[0]
-            ret['entryId'] = self._encodeLdapId(ret['entryId'])
+            ret = self._buildEntry(attrs, result[0][0], result[0][1], record)
+        return ret
+
+    def _getEntriesByIds(self, attrs, entryIds, record, base=None):
+        ret = {}
+        if entryIds:
+            for dn, entry in self.search(
+                base or self.getSearchBase(),
+                ldap.SCOPE_SUBTREE,
+                '(|%s)' % ''.join(
+                    '(%s=%s)' % (
+                        attrs['entryId'],
+                        self._decodeLegacyEntryId(entryId),
+                    )
+                    for entryId in entryIds
+                ),
+                attrs.values(),
+            ):
+                if dn is not None:
+                    e = self._buildEntry(attrs, dn, entry, record)
+                    ret[e.entryId] = e
         return ret
 
     def connect(
@@ -336,34 +849,15 @@ class LDAP(utils.Base):
         self._secure = protocol in ['ldaps', 'startTLS']
         self._port = port
 
-        for uri in self._determineBindURI(
+        self._uris = self._determineBindURI(
             dnsDomain,
             ldapServers,
             protocol,
             port,
-        ):
+        )
+        for uri in self._uris:
             try:
-                connection = ldap.initialize(uri)
-                if self._secure:
-                    if self._cacert:
-                        connection.set_option(
-                            ldap.OPT_X_TLS_REQUIRE_CERT,
-                            ldap.OPT_X_TLS_DEMAND
-                        )
-                        connection.set_option(
-                            ldap.OPT_X_TLS_CACERTFILE,
-                            self._cacert
-                        )
-                    else:
-                        connection.set_option(
-                            ldap.OPT_X_TLS_REQUIRE_CERT,
-                            ldap.OPT_X_TLS_NEVER
-                        )
-                    connection.set_option(
-                        ldap.OPT_X_TLS_NEWCTX,
-                        0
-                    )
-
+                connection = self._initialize(uri)
                 if self.search(
                     '',
                     ldap.SCOPE_BASE,
@@ -399,44 +893,275 @@ class LDAP(utils.Base):
                 krb5conf,
             )
         )
-        self.logger.debug(
-            "connect uri='%s', cacert='%s', bindUser='%s'",
-            self._bindURI,
-            self._cacert,
-            self._bindUser,
-        )
-        self._connection = ldap.initialize(self._bindURI)
+        self._connection = self._bind(self._bindURI)
+        self._namespace = self._determineNamespace()
+
+    def _initialize(self, uri):
+        connection = ldap.initialize(uri)
         if self._secure:
             if self._cacert:
-                self._connection.set_option(
+                connection.set_option(
                     ldap.OPT_X_TLS_REQUIRE_CERT,
                     ldap.OPT_X_TLS_DEMAND
                 )
-                self._connection.set_option(
+                connection.set_option(
                     ldap.OPT_X_TLS_CACERTFILE,
                     self._cacert
                 )
             else:
-                self._connection.set_option(
+                connection.set_option(
                     ldap.OPT_X_TLS_REQUIRE_CERT,
                     ldap.OPT_X_TLS_NEVER
                 )
-            self._connection.set_option(
+            connection.set_option(
                 ldap.OPT_X_TLS_NEWCTX,
                 0
             )
-        self._connection.set_option(
+        return connection
+
+    def _bind(self, uri):
+        self.logger.debug(
+            "connect uri='%s', cacert='%s', bindUser='%s'",
+            uri,
+            self._cacert,
+            self._bindUser,
+        )
+        connection = self._initialize(uri)
+        connection.set_option(
             ldap.OPT_REFERRALS,
             0,
         )
-        self._connection.set_option(
+        connection.set_option(
             ldap.OPT_PROTOCOL_VERSION,
             ldap.VERSION3,
         )
         if self._protocol == 'startTLS':
-            self._connection.start_tls_s()
-        self._connection.simple_bind_s(self._bindUser, self._bindPassword)
-        self._namespace = self._determineNamespace()
+            connection.start_tls_s()
+        connection.simple_bind_s(self._bindUser, self._bindPassword)
+        return connection
+
+    def _reconnect(self):
+        #
+        # current server first, then the others in
+        # order of preference.
+        #
+        uris = [self._bindURI] + [u for u in self._uris if u != self._bindURI]
+        delay = self._RECONNECT_DELAY
+        for attempt in range(1, self._RECONNECT_RETRIES + 1):
+            for uri in uris:
+                try:
+                    self._connection = self._bind(uri)
+                    self._bindURI = uri
+                    self._hedgeConnection = None
+                    self.logger.warning('Reconnected to ldap URI: %s', uri)
+                    return
+                except ldap.LDAPError:
+                    self.logger.debug(
+                        'Reconnect to %s failed',
+                        uri,
+                        exc_info=True,
+                    )
+            self.logger.warning(
+                'Cannot reconnect to ldap, attempt %s, retrying in %s seconds',
+                attempt,
+                delay,
+            )
+            time.sleep(delay)
+            delay = min(delay * 2, self._RECONNECT_MAX_DELAY)
+        raise RuntimeError('Cannot reconnect to ldap')
+
+    def _getConnectionErrors(self):
+        return (
+            ldap.SERVER_DOWN,
+            ldap.CONNECT_ERROR,
+            ldap.TIMEOUT,
+            ldap.UNAVAILABLE,
+        )
+
+    def _retry(self, func, *args, **kwargs):
+        retries = self._RECONNECT_RETRIES
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except self._getConnectionErrors() as e:
+                if retries == 0:
+                    raise
+                retries -= 1
+                self.logger.warning('Lost ldap connection: %s', e)
+                self.logger.debug('Exception', exc_info=True)
+                self._reconnect()
+
+    def _getBusyErrors(self):
+        return (
+            ldap.BUSY,
+            ldap.UNWILLING_TO_PERFORM,
+            ldap.ADMINLIMIT_EXCEEDED,
+        )
+
+    def enableRateLimit(self, maxRate=None, adaptive=False, latency=None):
+        self._limiter = utils.RateLimiter(
+            maxRate=maxRate,
+            adaptive=adaptive,
+            latency=latency,
+        )
+
+    def disableRateLimit(self):
+        self._limiter = None
+
+    def _limit(self, requests, func, *args):
+        if self._limiter is None:
+            return func(*args)
+        retries = self._BUSY_RETRIES
+        while True:
+            self._limiter.acquire(requests)
+            start = time.time()
+            try:
+                ret = func(*args)
+            except self._getBusyErrors() as e:
+                if retries == 0:
+                    raise
+                retries -= 1
+                self.logger.debug('Exception', exc_info=True)
+                self._limiter.backoff(e.__class__.__name__)
+                continue
+            self._limiter.observe((time.time() - start) / requests)
+            return ret
+
+    def logRateStats(self):
+        if self._limiter is not None:
+            self._limiter.logStats()
+
+    def enableHedging(self, after=None):
+        self._hedge = True
+        self._hedgeAfter = after
+        self._latencies = collections.deque(maxlen=self._HEDGE_SAMPLES)
+        self._hedgeStats = dict(lookups=0, hedged=0, won=0)
+
+    def _getHedgeConnection(self):
+        if self._hedgeConnection is None:
+            for uri in self._uris:
+                if uri == self._bindURI:
+                    continue
+                try:
+                    self._hedgeConnection = self._bind(uri)
+                    self.logger.debug('Hedging lookups using %s', uri)
+                    break
+                except ldap.LDAPError:
+                    self.logger.debug(
+                        'Cannot bind hedge connection to %s',
+                        uri,
+                        exc_info=True,
+                    )
+            else:
+                self.logger.warning(
+                    'No other ldap server is available, disabling hedging'
+                )
+                self._hedge = False
+        return self._hedgeConnection
+
+    def _getHedgeDelay(self):
+        if self._hedgeAfter:
+            return self._hedgeAfter
+        if self._hedgeStats['lookups'] % self._HEDGE_RECALC == 0:
+            if len(self._latencies) < self._HEDGE_RECALC:
+                self._hedgeDelay = None
+            else:
+                ordered = sorted(self._latencies)
+                self._hedgeDelay = max(
+                    ordered[int(len(ordered) * 0.95)],
+                    self._HEDGE_MIN_DELAY,
+                )
+        return self._hedgeDelay
+
+    def _searchHedged(self, baseDN, scope, ldapfilter, attributes):
+        delay = self._getHedgeDelay()
+        self._hedgeStats['lookups'] += 1
+        start = time.time()
+        msgid = self._connection.search_ext(
+            baseDN,
+            scope,
+            ldapfilter,
+            attributes,
+            serverctrls=self._searchControls,
+        )
+        try:
+            ret = self._connection.result(msgid, all=1, timeout=delay)[1]
+        except ldap.TIMEOUT:
+            ret = self._hedgeSearch(
+                msgid,
+                baseDN,
+                scope,
+                ldapfilter,
+                attributes,
+            )
+        self._latencies.append(time.time() - start)
+        return ret
+
+    def _abandon(self, connection, msgid):
+        try:
+            connection.abandon(msgid)
+        except ldap.LDAPError:
+            self.logger.debug('Abandon failed', exc_info=True)
+
+    def _dropHedgeConnection(self):
+        self.logger.debug('Hedge connection failed', exc_info=True)
+        self._hedgeConnection = None
+
+    def _hedgeSearch(self, msgid, baseDN, scope, ldapfilter, attributes):
+        hedge = self._getHedgeConnection()
+        if hedge is None:
+            return self._connection.result(msgid)[1]
+        self._hedgeStats['hedged'] += 1
+        try:
+            hedgeId = hedge.search_ext(
+                baseDN,
+                scope,
+                ldapfilter,
+                attributes,
+                serverctrls=self._searchControls,
+            )
+        except self._getConnectionErrors():
+            self._dropHedgeConnection()
+            return self._connection.result(msgid)[1]
+
+        #
+        # first answer wins, including errors such as
+        # no such object, the other request is abandoned.
+        #
+        while True:
+            try:
+                result = self._connection.result(msgid, all=1, timeout=0)
+            except ldap.LDAPError:
+                self._abandon(hedge, hedgeId)
+                raise
+            if result[0] is not None:
+                self._abandon(hedge, hedgeId)
+                return result[1]
+
+            try:
+                result = hedge.result(hedgeId, all=1, timeout=0)
+            except self._getConnectionErrors():
+                self._dropHedgeConnection()
+                return self._connection.result(msgid)[1]
+            except ldap.LDAPError:
+                self._hedgeStats['won'] += 1
+                self._abandon(self._connection, msgid)
+                raise
+            if result[0] is not None:
+                self._hedgeStats['won'] += 1
+                self._abandon(self._connection, msgid)
+                return result[1]
+
+            time.sleep(self._HEDGE_POLL)
+
+    def logHedgeStats(self):
+        if self._hedgeStats:
+            self.logger.info(
+                'Hedged %s of %s lookups, hedge won %s',
+                self._hedgeStats['hedged'],
+                self._hedgeStats['lookups'],
+                self._hedgeStats['won'],
+            )
 
     def search(self, baseDN, scope, ldapfilter, attributes, connection=None):
         self.logger.debug(
@@ -446,9 +1171,40 @@ class LDAP(utils.Base):
             ldapfilter,
             attributes,
         )
-        if connection is None:
-            connection = self._connection
-        ret = connection.search_s(baseDN, scope, ldapfilter, attributes)
+        if connection is None and self._hedge:
+            ret = self._retry(
+                self._limit,
+                1,
+                self._searchHedged,
+                baseDN,
+                scope,
+                ldapfilter,
+                attributes,
+            )
+        elif connection is None:
+            #
+            # connection is replaced when reconnected,
+            # so it is resolved within retry.
+            #
+            ret = self._retry(
+                self._limit,
+                1,
+                lambda: self._connection.search_ext_s(
+                    baseDN,
+                    scope,
+                    ldapfilter,
+                    attributes,
+                    serverctrls=self._searchControls,
+                ),
+            )
+        else:
+            ret = connection.search_ext_s(
+                baseDN,
+                scope,
+                ldapfilter,
+                attributes,
+                serverctrls=self._searchControls,
+            )
         self.logger.debug('SearchResult: %s', ret)
         return ret
 
@@ -458,15 +1214,30 @@ class LDAP(utils.Base):
     def getNamespace(self):
         return self._namespace
 
+    def getSearchBase(self):
+        return self.getNamespace()
+
+    def _getEntryNamespace(self, entry):
+        return self.getNamespace()
+
+    def _newUser(self, user):
+        user.user_id = uuid.uuid4().bytes
+        user.namespace = self._getEntryNamespace(user)
+        return user
+
+    def _newGroup(self, group):
+        group.id = uuid.uuid4().bytes
+        group.namespace = self._getEntryNamespace(group)
+        return group
+
     def getUser(self, entryId):
         user = self._getEntryById(
             attrs=self._attrUserMap,
             entryId=entryId,
+            record=UserRecord,
         )
         if user:
-            user['user_id'] = str(uuid.uuid4())
-            user['external_id'] = user['entryId']
-            user['namespace'] = self.getNamespace()
+            self._newUser(user)
 
         return user
 
@@ -474,14 +1245,35 @@ class LDAP(utils.Base):
         group = self._getEntryById(
             attrs=self._attrGroupMap,
             entryId=entryId,
+            record=GroupRecord,
         )
         if group:
-            group['id'] = str(uuid.uuid4())
-            group['external_id'] = group['entryId']
-            group['namespace'] = self.getNamespace()
+            self._newGroup(group)
 
         return group
 
+    def getUsers(self, entryIds):
+        ret = self._getEntriesByIds(
+            attrs=self._attrUserMap,
+            entryIds=entryIds,
+            record=UserRecord,
+        )
+        for user in ret.values():
+            self._newUser(user)
+
+        return ret
+
+    def getGroups(self, entryIds):
+        ret = self._getEntriesByIds(
+            attrs=self._attrGroupMap,
+            entryIds=entryIds,
+            record=GroupRecord,
+        )
+        for group in ret.values():
+            self._newGroup(group)
+
+        return ret
+
     def getUserDN(self):
         return self._bindUser
 
@@ -499,38 +1291,155 @@ class SimpleLDAP(LDAP):
 
     _simpleNamespaceAttribute = 'defaultNamingContext'
     _simpleProvider = None
+    _simpleSearchBases = {}
+    _simpleLearnEntries = 20
 
-    def _determineNamespace(self, connection=None):
-        return self.search(
-            '',
-            ldap.SCOPE_BASE,
-            '(objectClass=*)',
-            [self._simpleNamespaceAttribute],
-            connection=connection,
-        )[0][1][self._simpleNamespaceAttribute][0]
+    def __init__(self, *args, **kwargs):
+        super(SimpleLDAP, self).__init__(*args, **kwargs)
+        self._searchBases = {}
+        self._learnBases = {}
+
+    def _explodeDN(self, dn):
+        return ldap.dn.explode_dn(dn)
+
+    def _commonBase(self, base, dn):
+        ret = []
+        for a, b in zip(reversed(base), reversed(dn)):
+            if a.lower() != b.lower():
+                break
+            ret.insert(0, a)
+        return ret
 
-    def _determineBindUser(
-        self,
-        dnsDomain,
-        ldapServer,
-        saslUser,
-        bindPassword,
+    def _getRecordSearchBase(self, record):
+        if record not in self._searchBases:
+            namespace = self._explodeDN(self.getNamespace())
+            rdn = self._simpleSearchBases.get(record)
+            if rdn is None:
+                self._learnBases[record] = (0, None)
+                self._searchBases[record] = namespace
+            else:
+                self._searchBases[record] = self._explodeDN(rdn) + namespace
+        return self._searchBases[record]
+
+    def _learnSearchBase(self, record, dns):
+        if record not in self._learnBases:
+            return
+        count, base = self._learnBases[record]
+        for dn in dns:
+            parent = self._explodeDN(dn)[1:]
+            base = parent if base is None else self._commonBase(base, parent)
+            count += 1
+        if count < self._simpleLearnEntries:
+            self._learnBases[record] = (count, base)
+        else:
+            del self._learnBases[record]
+            self._searchBases[record] = base
+            self.logger.debug(
+                'Narrowed %s search base to: %s',
+                record.__name__,
+                ','.join(base),
+            )
+
+    def _widenSearchBase(self, record, dns):
+        base = self._searchBases[record]
+        for dn in dns:
+            base = self._commonBase(base, self._explodeDN(dn)[1:])
+        self._searchBases[record] = base
+        self.logger.debug(
+            'Widened %s search base to: %s',
+            record.__name__,
+            ','.join(base),
+        )
+
+    def _isNarrowed(self, record):
+        return (
+            len(self._getRecordSearchBase(record)) >
+            len(self._explodeDN(self.getNamespace()))
+        )
+
+    def _getEntryById(self, attrs, entryId, record):
+        ret = None
+        narrowed = self._isNarrowed(record)
+        if narrowed:
+            try:
+                ret = super(SimpleLDAP, self)._getEntryById(
+                    attrs,
+                    entryId,
+                    record,
+                    base=','.join(self._getRecordSearchBase(record)),
+                )
+            except ldap.NO_SUCH_OBJECT:
+                pass
+        if ret is None:
+            ret = super(SimpleLDAP, self)._getEntryById(
+                attrs,
+                entryId,
+                record,
+            )
+            if ret is not None and narrowed:
+                self._widenSearchBase(record, [ret.dn])
+        if ret is not None:
+            self._learnSearchBase(record, [ret.dn])
+        return ret
+
+    def _getEntriesByIds(self, attrs, entryIds, record):
+        ret = {}
+        narrowed = self._isNarrowed(record)
+        if narrowed:
+            try:
+                ret = super(SimpleLDAP, self)._getEntriesByIds(
+                    attrs,
+                    entryIds,
+                    record,
+                    base=','.join(self._getRecordSearchBase(record)),
+                )
+            except ldap.NO_SUCH_OBJECT:
+                pass
+        missing = [e for e in entryIds if self.getExternalId(e) not in ret]
+        if missing:
+            found = super(SimpleLDAP, self)._getEntriesByIds(
+                attrs,
+                missing,
+                record,
+            )
+            if found and narrowed:
+                self._widenSearchBase(record, [e.dn for e in found.values()])
+            ret.update(found)
+        self._learnSearchBase(record, [e.dn for e in ret.values()])
+        return ret
+
+    def _determineNamespace(self, connection=None):
+        return self.search(
+            '',
+            ldap.SCOPE_BASE,
+            '(objectClass=*)',
+            [self._simpleNamespaceAttribute],
+            connection=connection,
+        )[0][1][self._simpleNamespaceAttribute][0]
+
+    def _determineBindUser(
+        self,
+        dnsDomain,
+        ldapServer,
+        saslUser,
+        bindPassword,
         krb5conf,
     ):
-        self._kerberos.kinit(saslUser, bindPassword, krb5conf)
+        self._kerberos.acquire(saslUser, bindPassword, krb5conf)
         connection = None
         try:
             connection = ldap.initialize(ldapServer)
             connection.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION3)
             connection.set_option(ldap.OPT_REFERRALS, 0)
             connection.set_option(ldap.OPT_X_SASL_NOCANON, True)
-            connection.sasl_interactive_bind_s(
-                '',
-                ldap.sasl.sasl(
-                    {},
-                    'GSSAPI',
-                ),
-            )
+            with self._kerberos.credentials():
+                connection.sasl_interactive_bind_s(
+                    '',
+                    ldap.sasl.sasl(
+                        {},
+                        'GSSAPI',
+                    ),
+                )
             entry = self.search(
                 self._determineNamespace(connection),
                 ldap.SCOPE_SUBTREE,
@@ -553,7 +1462,7 @@ class SimpleLDAP(LDAP):
         finally:
             if connection:
                 connection.unbind_s()
-            self._kerberos.kdestroy()
+            self._kerberos.release()
 
     def getConfig(self):
         url = urlparse.urlparse(self._bindURI)
@@ -612,6 +1521,15 @@ class RHDSLDAP(SimpleLDAP):
             entryId[28:]
         )
 
+    @classmethod
+    def getExternalIdExpression(cls, column):
+        return (
+            "substr({column}, 1, 13) || substr({column}, 15, 9) || "
+            "substr({column}, 25, 4) || '-' || substr({column}, 29)"
+        ).format(
+            column=column,
+        )
+
 
 class OpenLDAP(SimpleLDAP):
 
@@ -660,6 +1578,11 @@ class IPALDAP(SimpleLDAP):
 
     _simpleUserFilter = '(objectClass=person)(ipaUniqueID=*)'
 
+    _simpleSearchBases = {
+        UserRecord: 'cn=users,cn=accounts',
+        GroupRecord: 'cn=groups,cn=accounts',
+    }
+
     def __init__(self, *args, **kwargs):
         super(IPALDAP, self).__init__(*args, **kwargs)
 
@@ -681,6 +1604,51 @@ class ADLDAP(LDAP):
         'name': 'name',
     }
 
+    _GC_PORTS = {
+        'ldaps': '3269',
+        'plain': '3268',
+        'startTLS': '3268',
+    }
+
+    # LDAP_SERVER_SEARCH_OPTIONS_OID, SERVER_SEARCH_FLAG_PHANTOM_ROOT
+    _PHANTOM_ROOT_OID = '1.2.840.113556.1.4.1340'
+    _PHANTOM_ROOT_VALUE = b'\x30\x03\x02\x01\x02'
+
+    _forest = None
+    _rootNamingContext = None
+    _guidLookup = True
+
+    def enableGlobalCatalog(self, forest):
+        self._forest = forest
+
+    def isGlobalCatalog(self):
+        return self._forest is not None
+
+    def _determineBindURI(self, dnsDomain, ldapServers, protocol, port):
+        if not self.isGlobalCatalog():
+            return super(ADLDAP, self)._determineBindURI(
+                dnsDomain,
+                ldapServers,
+                protocol,
+                port,
+            )
+
+        service = 'ldaps' if protocol == 'ldaps' else 'ldap'
+        if port is None:
+            port = self._GC_PORTS[protocol]
+        if ldapServers is None:
+            ldapServers = utils.DNS().resolveSRVRecord(
+                domain=self._forest,
+                protocol='tcp',
+                service='gc',
+                port=port,
+            )
+        else:
+            ldapServers = [
+                '%s:%s' % (server, port) for server in ldapServers
+            ]
+        return ['%s://%s' % (service, server) for server in ldapServers]
+
     def _determineBindUser(
         self,
         dnsDomain,
@@ -692,13 +1660,23 @@ class ADLDAP(LDAP):
         return '%s@%s' % (saslUser.split('@', 1)[0], dnsDomain)
 
     def _determineNamespace(self, connection=None):
-        _configurationNamingContext = self.search(
+        rootDSE = self.search(
             '',
             ldap.SCOPE_BASE,
             '(objectclass=*)',
-            ['configurationNamingContext'],
+            ['configurationNamingContext', 'rootDomainNamingContext'],
             connection=connection,
-        )[0][1]['configurationNamingContext'][0]
+        )[0][1]
+        _configurationNamingContext = rootDSE['configurationNamingContext'][0]
+        if self.isGlobalCatalog():
+            self._rootNamingContext = rootDSE['rootDomainNamingContext'][0]
+            self._searchControls = [
+                ldap.controls.LDAPControl(
+                    self._PHANTOM_ROOT_OID,
+                    False,
+                    self._PHANTOM_ROOT_VALUE,
+                ),
+            ]
         return self.search(
             'CN=Partitions,%s' % _configurationNamingContext,
             ldap.SCOPE_SUBTREE,
@@ -718,10 +1696,163 @@ class ADLDAP(LDAP):
     def _encodeLdapId(self, entryId):
         return base64.b64encode(entryId)
 
+    def getExternalId(self, legacyEntryId):
+        return self._encodeLdapId(uuid.UUID(legacyEntryId).bytes_le)
+
+    @classmethod
+    def getExternalIdExpression(cls, column):
+        #
+        # bytes_le reverses byte order of
+        # first three fields of uuid.
+        #
+        return (
+            "encode(decode({hex}, 'hex'), 'base64')"
+        ).format(
+            hex=' || '.join(
+                "substr(replace(lower({column}), '-', ''), {start}, {length})"
+                .format(
+                    column=column,
+                    start=start,
+                    length=length,
+                )
+                for start, length in (
+                    (7, 2), (5, 2), (3, 2), (1, 2),
+                    (11, 2), (9, 2),
+                    (15, 2), (13, 2),
+                    (17, 16),
+                )
+            ),
+        )
+
+    def getSearchBase(self):
+        if self.isGlobalCatalog():
+            return self._rootNamingContext
+        return self.getNamespace()
+
+    def _getGUIDBase(self, entryId):
+        #
+        # undashed form is objectGUID octets in stored order,
+        # dashed form matches entry id, which is bytes_le based.
+        #
+        return '<GUID=%s>' % uuid.UUID(entryId)
+
+    def _disableGUIDLookup(self, error):
+        self.logger.debug(
+            'GUID lookup is not available, using subtree search: %s',
+            error,
+        )
+        self._guidLookup = False
+
+    def _getEntryById(self, attrs, entryId, record):
+        if self._guidLookup:
+            try:
+                result = self.search(
+                    self._getGUIDBase(entryId),
+                    ldap.SCOPE_BASE,
+                    '(objectClass=*)',
+                    attrs.values(),
+                )
+                if result and result[0][0] is not None:
+                    return self._buildEntry(
+                        attrs,
+                        result[0][0],
+                        result[0][1],
+                        record,
+                    )
+                return None
+            except ldap.NO_SUCH_OBJECT:
+                return None
+            except (
+                ldap.INVALID_DN_SYNTAX,
+                ldap.UNWILLING_TO_PERFORM,
+                ldap.PROTOCOL_ERROR,
+            ) as e:
+                self._disableGUIDLookup(e)
+        return super(ADLDAP, self)._getEntryById(attrs, entryId, record)
+
+    def _getEntriesByIds(self, attrs, entryIds, record):
+        if not self._guidLookup or not entryIds:
+            return super(ADLDAP, self)._getEntriesByIds(
+                attrs,
+                entryIds,
+                record,
+            )
+
+        try:
+            return self._retry(
+                self._limit,
+                len(entryIds),
+                self._getEntriesByGUIDs,
+                attrs,
+                entryIds,
+                record,
+            )
+        except (
+            ldap.INVALID_DN_SYNTAX,
+            ldap.UNWILLING_TO_PERFORM,
+            ldap.PROTOCOL_ERROR,
+        ) as e:
+            self._disableGUIDLookup(e)
+            return super(ADLDAP, self)._getEntriesByIds(
+                attrs,
+                entryIds,
+                record,
+            )
+
+    def _getEntriesByGUIDs(self, attrs, entryIds, record):
+        #
+        # issue all base object lookups, then collect results,
+        # so round trips overlap.
+        #
+        ret = {}
+        msgids = [
+            self._connection.search_ext(
+                self._getGUIDBase(entryId),
+                ldap.SCOPE_BASE,
+                '(objectClass=*)',
+                attrs.values(),
+                serverctrls=self._searchControls,
+            )
+            for entryId in entryIds
+        ]
+        try:
+            while msgids:
+                msgid = msgids.pop(0)
+                try:
+                    result = self._connection.result(msgid)[1]
+                except ldap.NO_SUCH_OBJECT:
+                    continue
+                self.logger.debug('SearchResult: %s', result)
+                for dn, entry in result:
+                    if dn is not None:
+                        e = self._buildEntry(attrs, dn, entry, record)
+                        ret[e.entryId] = e
+        except ldap.LDAPError:
+            for msgid in msgids:
+                try:
+                    self._connection.abandon(msgid)
+                except ldap.LDAPError:
+                    pass
+            raise
+        return ret
+
+    def _getEntryNamespace(self, entry):
+        if not self.isGlobalCatalog():
+            return self.getNamespace()
+        #
+        # entries of whole forest are returned,
+        # namespace is the domain partition of entry.
+        #
+        return ','.join(
+            rdn for rdn in entry.dn.split(',')
+            if rdn.strip().upper().startswith('DC=')
+        )
+
     def getConfig(self):
         return (
             'include = <ad.properties>\n'
             '\n'
+            '{forest}'
             'vars.domain = {domain}\n'
             'vars.user = {user}\n'
             'vars.password = {password}\n'
@@ -737,7 +1868,126 @@ class ADLDAP(LDAP):
             password=self._bindPassword,
             domain=self._dnsDomain,
             service='ldaps' if self._protocol == 'ldaps' else 'ldap',
+            forest=(
+                'vars.forest = %s\n' % self._forest
+                if self.isGlobalCatalog() else ''
+            ),
+        )
+
+
+class LDIFLDAP(utils.Base):
+
+    def __init__(self, driver, name, namespace):
+        super(LDIFLDAP, self).__init__()
+        self._driver = driver
+        self._name = name
+        self._index = {}
+        driver._namespace = namespace
+
+    def load(self, dnsDomain, bindUser=None, bindPassword=None):
+        driver = self._driver
+        attrs = set(
+            a.lower() for a in (
+                list(driver._attrUserMap.values()) +
+                list(driver._attrGroupMap.values())
+            )
+        )
+        entryIdAttrs = set((
+            driver._attrUserMap['entryId'].lower(),
+            driver._attrGroupMap['entryId'].lower(),
+        ))
+        index = self._index
+
+        class Parser(ldif.LDIFParser):
+            def handle(self, dn, entry):
+                entry = dict(
+                    (k.lower(), v) for k, v in entry.items()
+                    if k.lower() in attrs
+                )
+                for a in entryIdAttrs:
+                    if a in entry:
+                        index[driver._encodeLdapId(entry[a][0])] = (
+                            dn,
+                            entry,
+                        )
+                        break
+
+        self.logger.debug("Indexing LDIF '%s'", self._name)
+        with open(self._name, 'rb') as f:
+            Parser(f).parse()
+        self.logger.debug('Indexed %s entries', len(index))
+
+        #
+        # profile configuration is rendered by the driver,
+        # there is no connection.
+        #
+        driver._dnsDomain = dnsDomain
+        driver._bindURI = 'ldap://%s' % dnsDomain
+        driver._protocol = 'plain'
+        driver._secure = False
+        driver._port = None
+        driver._bindUser = bindUser
+        driver._bindPassword = bindPassword
+
+    def _getEntries(self, attrs, entryIds, record):
+        ret = {}
+        for entryId in entryIds:
+            found = self._index.get(self._driver.getExternalId(entryId))
+            if found is not None:
+                dn, entry = found
+                e = self._driver._buildEntry(
+                    attrs,
+                    dn,
+                    dict(
+                        (a, entry.get(a.lower(), ['']))
+                        for a in attrs.values()
+                    ),
+                    record,
+                )
+                ret[e.entryId] = e
+        return ret
+
+    def getUsers(self, entryIds):
+        ret = self._getEntries(self._driver._attrUserMap, entryIds, UserRecord)
+        for user in ret.values():
+            self._driver._newUser(user)
+        return ret
+
+    def getGroups(self, entryIds):
+        ret = self._getEntries(
+            self._driver._attrGroupMap,
+            entryIds,
+            GroupRecord,
         )
+        for group in ret.values():
+            self._driver._newGroup(group)
+        return ret
+
+    def getUser(self, entryId):
+        ret = list(self.getUsers([entryId]).values())
+        return ret[0] if ret else None
+
+    def getGroup(self, entryId):
+        ret = list(self.getGroups([entryId]).values())
+        return ret[0] if ret else None
+
+    def getExternalId(self, legacyEntryId):
+        return self._driver.getExternalId(legacyEntryId)
+
+    def getNamespace(self):
+        return self._driver.getNamespace()
+
+    def getCACert(self):
+        return None
+
+    def getProtocol(self):
+        return self._driver.getProtocol()
+
+    def isSecure(self):
+        return False
+
+    def getConfig(self):
+        return self._driver.getConfig()
 
 
 class AAAProfile(utils.Base):
@@ -796,6 +2046,9 @@ class AAAProfile(utils.Base):
             ),
         )
 
+    def exists(self):
+        return os.path.exists(self._files['authzFile'])
+
     def checkExisting(self):
         for f in self._files:
             if os.path.exists(f):
@@ -823,34 +2076,8 @@ class AAAProfile(utils.Base):
                 self._files['trustStore'],
                 forceNew=True,
             )
-            # keytool does not like empty files
-            if os.path.exists(keystore):
-                os.unlink(keystore)
-
-            from ovirt_engine import java
-            p = subprocess.Popen(
-                [
-                    os.path.join(
-                        java.Java().getJavaHome(),
-                        'bin',
-                        'keytool'
-                    ),
-                    '-importcert',
-                    '-noprompt',
-                    '-trustcacerts',
-                    '-storetype', 'JKS',
-                    '-keystore', keystore,
-                    '-storepass', 'changeit',
-                    '-file', cacert,
-                    '-alias', 'myca',
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            stdout, stderr = p.communicate()
-            self.logger.debug('keytool stdout: %s, stderr: %s', stdout, stderr)
-            if p.wait() != 0:
-                raise RuntimeError('Failed to execute keytool')
+            utils.TrustStore().write(cacert, keystore)
+            os.chmod(keystore, 0o644)
 
         with open(
             self._filetransaction.getFileName(
@@ -955,11 +2182,525 @@ class AAAProfile(utils.Base):
         super(AAAProfile, self).__exit__(exc_type, exc_value, traceback)
 
 
+class ConversionJournal(utils.Base):
+
+    TABLES = ('users', 'ad_groups', 'permissions', 'event_subscriber')
+
+    ID_COLUMNS = {
+        'users': 'user_id',
+        'ad_groups': 'id',
+        'permissions': 'id',
+        'event_subscriber': 'subscriber_id',
+    }
+
+    SUBSCRIPTION_KEY = (
+        'subscriber_id',
+        'event_up_name',
+        'method_address',
+        'tag_name',
+        'notification_method',
+    )
+
+    def __init__(self, name):
+        super(ConversionJournal, self).__init__()
+        self._name = name
+        self._header = None
+        self._complete = False
+        self._seq = 0
+        self._entries = dict((t, {}) for t in self.TABLES)
+        self._pending = []
+
+    def _append(self, record):
+        with open(self._name, 'a') as f:
+            f.write('%s\n' % json.dumps(record))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _key(self, key):
+        return tuple(key) if isinstance(key, list) else key
+
+    def exists(self):
+        return os.path.exists(self._name)
+
+    def isComplete(self):
+        return self._complete
+
+    def load(self):
+        batches = {}
+        committed = set()
+        aborted = set()
+        with open(self._name, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if record['type'] == 'header':
+                    self._header = record
+                elif record['type'] == 'batch':
+                    batches[record['seq']] = record
+                elif record['type'] == 'commit':
+                    committed.add(record['seq'])
+                elif record['type'] == 'abort':
+                    aborted.add(record['seq'])
+                elif record['type'] == 'complete':
+                    self._complete = True
+        if self._header is None:
+            raise RuntimeError("Journal '%s' is corrupted" % self._name)
+
+        for seq in sorted(batches.keys()):
+            batch = batches[seq]
+            rows = [(self._key(k), v) for k, v in batch['rows']]
+            if seq in committed:
+                self._entries[batch['table']].update(rows)
+            elif seq not in aborted:
+                self._pending.append((seq, batch['table'], rows))
+            self._seq = max(self._seq, seq)
+
+        self.logger.debug(
+            'Journal loaded: %s',
+            dict((t, len(e)) for t, e in self._entries.items()),
+        )
+
+    def open(self, domain, authzName):
+        if self._header is None:
+            self._header = dict(
+                type='header',
+                domain=domain,
+                authzName=authzName,
+            )
+            self._append(self._header)
+        elif (
+            self._header['domain'] != domain or
+            self._header['authzName'] != authzName
+        ):
+            raise RuntimeError(
+                "Journal '%s' was created for domain '%s' authz '%s'" % (
+                    self._name,
+                    self._header['domain'],
+                    self._header['authzName'],
+                )
+            )
+
+    def getIds(self, table):
+        return self._entries[table]
+
+    def getAllNewIds(self, table):
+        ret = set(self._entries[table].values())
+        for seq, t, rows in self._pending:
+            if t == table:
+                ret.update(v for k, v in rows)
+        return ret
+
+    def getPending(self):
+        return list(self._pending)
+
+    def resolvePending(self, seq, committed):
+        for p in self._pending:
+            if p[0] == seq:
+                self._pending.remove(p)
+                if committed:
+                    self._entries[p[1]].update(p[2])
+                    self._append(dict(type='commit', seq=seq))
+                else:
+                    self._append(dict(type='abort', seq=seq))
+                break
+
+    def begin(self, table, rows):
+        self._seq += 1
+        self._append(
+            dict(
+                type='batch',
+                seq=self._seq,
+                table=table,
+                rows=rows,
+            )
+        )
+        return self._seq
+
+    def commit(self, seq, table, rows):
+        self._append(dict(type='commit', seq=seq))
+        self._entries[table].update(rows)
+
+    def complete(self):
+        self._append(dict(type='complete'))
+        self._complete = True
+
+    def remove(self):
+        if os.path.exists(self._name):
+            os.unlink(self._name)
+
+
+class ShardResult(utils.Base):
+
+    KINDS = {
+        'user': (UserRecord, 'user_id'),
+        'group': (GroupRecord, 'id'),
+    }
+
+    @staticmethod
+    def parse(shard):
+        m = re.match(r'^(?P<index>\d+)/(?P<count>\d+)$', shard)
+        if not m:
+            raise RuntimeError("Invalid shard '%s', expected I/N" % shard)
+        index, count = int(m.group('index')), int(m.group('count'))
+        if not 1 <= index <= count:
+            raise RuntimeError("Invalid shard '%s'" % shard)
+        return index, count
+
+    @staticmethod
+    def getShard(externalId, count):
+        return int(
+            hashlib.md5(externalId.encode('utf-8')).hexdigest()[:8],
+            16,
+        ) % count + 1
+
+    def __init__(self, name):
+        super(ShardResult, self).__init__()
+        self._name = name
+        self._file = None
+
+    def _write(self, record):
+        self._file.write('%s\n' % json.dumps(record))
+
+    def open(self, domain, index, count):
+        self._file = open('%s.tmp' % self._name, 'w')
+        self._write(
+            dict(
+                type='header',
+                domain=domain,
+                index=index,
+                count=count,
+            )
+        )
+
+    def add(self, kind, externalId, entry):
+        fields = None
+        if entry is not None:
+            fields = entry.toArgs()
+            del fields[self.KINDS[kind][1]]
+        self._write(
+            dict(
+                type='entry',
+                kind=kind,
+                external_id=externalId,
+                fields=fields,
+            )
+        )
+
+    def complete(self):
+        self._write(dict(type='complete'))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        os.rename('%s.tmp' % self._name, self._name)
+
+
+class ShardResults(utils.Base):
+
+    def __init__(self, names):
+        super(ShardResults, self).__init__()
+        self._names = names
+        self._entries = dict((k, {}) for k in ShardResult.KINDS)
+
+    def load(self, domain):
+        count = None
+        indexes = set()
+        for name in self._names:
+            header = None
+            complete = False
+            with open(name, 'r') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record['type'] == 'header':
+                        header = record
+                    elif record['type'] == 'entry':
+                        self._entries[record['kind']][
+                            record['external_id']
+                        ] = record['fields']
+                    elif record['type'] == 'complete':
+                        complete = True
+            if header is None or not complete:
+                raise RuntimeError("Shard result '%s' is incomplete" % name)
+            if header['domain'] != domain:
+                raise RuntimeError(
+                    "Shard result '%s' was created for domain '%s'" % (
+                        name,
+                        header['domain'],
+                    )
+                )
+            if count not in (None, header['count']):
+                raise RuntimeError(
+                    "Shard result '%s' has %s shards, expected %s" % (
+                        name,
+                        header['count'],
+                        count,
+                    )
+                )
+            count = header['count']
+            indexes.add(header['index'])
+        missing = set(range(1, count + 1)) - indexes
+        if missing:
+            raise RuntimeError(
+                'Missing results of shards: %s' % ', '.join(
+                    '%s/%s' % (i, count) for i in sorted(missing)
+                )
+            )
+
+    def _resolve(self, kind, externalIds):
+        record, idName = ShardResult.KINDS[kind]
+        ret = {}
+        for externalId in externalIds:
+            if externalId not in self._entries[kind]:
+                raise RuntimeError(
+                    "Entry '%s' is not within shard results, "
+                    "it was probably added after shards were resolved" % (
+                        externalId,
+                    )
+                )
+            fields = self._entries[kind][externalId]
+            if fields is not None:
+                entry = record(**fields)
+                setattr(entry, idName, uuid.uuid4().bytes)
+                ret[entry.entryId] = entry
+        return ret
+
+    def getUsers(self, externalIds):
+        return self._resolve('user', externalIds)
+
+    def getGroups(self, externalIds):
+        return self._resolve('group', externalIds)
+
+
+class ConversionVerifier(utils.Base):
+
+    TABLES = ConversionJournal.TABLES
+
+    _ORPHANS = ('orphan_permissions', 'orphan_subscriptions')
+
+    @staticmethod
+    def checksum(*values):
+        text = ':'.join('' if v is None else '%s' % (v,) for v in values)
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        return int(hashlib.md5(text).hexdigest()[:8], 16)
+
+    @classmethod
+    def rowChecksum(cls, table, row):
+        if table == 'users':
+            return cls.checksum(Record.fromUUID(row.user_id))
+        elif table == 'ad_groups':
+            return cls.checksum(Record.fromUUID(row.id))
+        elif table == 'permissions':
+            return cls.checksum(
+                Record.fromUUID(row.role_id),
+                Record.fromUUID(row.ad_element_id),
+                Record.fromUUID(row.object_id),
+                row.object_type_id,
+            )
+        else:
+            return cls.checksum(
+                *[row.get(k) for k in ConversionJournal.SUBSCRIPTION_KEY]
+            )
+
+    def __init__(self, aaadao, domain):
+        super(ConversionVerifier, self).__init__()
+        self._aaadao = aaadao
+        self._domain = domain
+        self._expected = None
+
+    def begin(self):
+        self._expected = self._aaadao.fetchVerifySummary(self._domain)
+
+    def add(self, table, row):
+        count, checksum = self._expected.get(table, (0, 0))
+        self._expected[table] = (
+            count + 1,
+            checksum + self.rowChecksum(table, row),
+        )
+
+    def verify(self):
+        actual = self._aaadao.fetchVerifySummary(self._domain)
+        ret = []
+        for name in self.TABLES + self._ORPHANS:
+            expected = self._expected.get(name, (0, 0))
+            current = actual.get(name, (0, 0))
+            ret.append((name, expected == current, expected[0], current[0]))
+        return ret
+
+    def log(self, results):
+        failed = [r for r in results if not r[1]]
+        self.logger.info(
+            'Verification %s: %s',
+            'failed' if failed else 'passed',
+            ', '.join(
+                '%s=%s%s' % (
+                    name,
+                    current,
+                    '' if ok else ' (expected %s)' % expected,
+                )
+                for name, ok, expected, current in results
+            ),
+        )
+        for name, ok, expected, current in failed:
+            self.logger.warning(
+                "Verification of '%s' failed, expected %s rows found %s",
+                name,
+                expected,
+                current,
+            )
+        return not failed
+
+
+class LegacyReads(utils.Base):
+
+    def __init__(self, engine, args, fetches):
+        super(LegacyReads, self).__init__()
+        self._engine = engine
+        self._args = args
+        self._fetches = fetches
+        self._readers = {}
+
+    def _openSnapshotReaders(self):
+        self.logger.info('Exporting database snapshot for parallel reads')
+        statements = {}
+        try:
+            #
+            # snapshot can be imported only while
+            # exporting transaction is open.
+            #
+            coordinator = self._engine.getStatement()
+            with coordinator:
+                snapshot = coordinator.exportSnapshot()
+                self.logger.debug('Importing snapshot %s', snapshot)
+                for name in self._fetches:
+                    statement = self._engine.getStatement()
+                    statements[name] = statement
+                    statement.importSnapshot(snapshot)
+        except Exception:
+            for statement in statements.values():
+                with statement:
+                    pass
+            raise
+
+        for name, statement in statements.items():
+            self._readers[name] = utils.stage(
+                _readLegacyRowsStage(
+                    statement,
+                    self._args.bufferSize,
+                    self._fetches[name],
+                ),
+                self._args.queueSize,
+                'read-%s' % name,
+            )
+
+    def get(self, name, aaadao):
+        reader = self._readers.pop(name, None)
+        if reader is None:
+            reader = readLegacyRows(
+                self._engine,
+                aaadao,
+                self._args,
+                'read-%s' % name,
+                self._fetches[name],
+            )
+        return reader
+
+    def __enter__(self):
+        if self._args.parallelReads:
+            self._openSnapshotReaders()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
+
+
+class ChunkedWriter(utils.Base):
+
+    def __init__(
+        self,
+        statement,
+        chunkSize=0,
+        journal=None,
+        verifier=None,
+        throttle=None,
+    ):
+        super(ChunkedWriter, self).__init__()
+        self._statement = statement
+        self._chunkSize = chunkSize
+        self._journal = journal
+        self._verifier = verifier
+        self._throttle = throttle
+        self._table = None
+        self._rows = []
+        self._counts = {}
+
+    def getCount(self, table):
+        return self._counts.get(table, 0)
+
+    def write(self, table, key, newId, insert, row):
+        if table != self._table:
+            self.flush()
+            self._table = table
+        if self._throttle is not None:
+            self._throttle.wait()
+        insert(row)
+        self._counts[table] = self._counts.get(table, 0) + 1
+        if self._verifier is not None:
+            self._verifier.add(table, row)
+        if self._chunkSize:
+            self._rows.append((key, newId))
+            if len(self._rows) >= self._chunkSize:
+                self.flush()
+
+    def flush(self):
+        if self._rows:
+            seq = self._journal.begin(self._table, self._rows)
+            self._statement.commit()
+            self._journal.commit(seq, self._table, self._rows)
+            self.logger.debug(
+                "Committed %s rows of '%s'",
+                len(self._rows),
+                self._table,
+            )
+        self._rows = []
+
+
+#
+# provider -> driver, either class name within this module
+# or 'module:class' of external driver, imported when selected.
+#
+DRIVERS = {
+    'ad': 'ADLDAP',
+    'ipa': 'IPALDAP',
+    'rhds': 'RHDSLDAP',
+    'openldap': 'OpenLDAP',
+}
+
+
+# sample value for estimating cost of lookups by id
+NULL_ID = str(uuid.UUID(int=0))
+
+
+def getDriver(provider):
+    driver = DRIVERS.get(provider)
+    if driver is None:
+        raise RuntimeError("Provider '%s' is not supported" % provider)
+    if ':' not in driver:
+        return globals()[driver]
+    module, driver = driver.split(':', 1)
+    __import__(module)
+    return getattr(sys.modules[module], driver)
+
+
 class RollbackError(RuntimeError):
     pass
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         prog='%s-tool' % config.PACKAGE_NAME,
         description=(
@@ -993,6 +2734,17 @@ def parse_args():
         default=None,
         help='write log into file',
     )
+    parser.add_argument(
+        '--log-rotate',
+        dest='logRotate',
+        metavar='MB',
+        type=int,
+        default=0,
+        help=(
+            'rotate log file when it exceeds MB megabytes, '
+            'keeping five compressed previous logs'
+        ),
+    )
     parser.add_argument(
         '--apply',
         default=False,
@@ -1077,92 +2829,569 @@ def parse_args():
         metavar='FILE',
         help='use this krb5 conf instead of ovirt default krb5 conf',
     )
-    args = parser.parse_args(sys.argv[1:])
-
-    if args.domain == args.profile:
-        raise RuntimeError(
-            'Profile cannot be the same as domain',
-        )
-
-    if not args.profile:
-        args.profile = '%s-new' % args.domain
-
-    if not args.authnName:
-        args.authnName = '%s-authn' % args.profile
-
-    if not args.authzName:
-        args.authzName = '%s-authz' % args.profile
-
-    if args.cacert == 'NONE':
-        args.cacert = None
+    parser.add_argument(
+        '--ldif',
+        dest='ldif',
+        metavar='FILE',
+        help=(
+            'read users and groups from LDIF export instead of directory, '
+            'for dry runs only'
+        ),
+    )
+    parser.add_argument(
+        '--ldif-namespace',
+        dest='ldifNamespace',
+        metavar='DN',
+        help=(
+            'namespace of LDIF entries, default is DN made of domain '
+            'components of domain name'
+        ),
+    )
+    parser.add_argument(
+        '--hedge',
+        dest='hedge',
+        default=False,
+        action='store_true',
+        help=(
+            'repeat slow directory lookups on another ldap server, '
+            'first answer is used'
+        ),
+    )
+    parser.add_argument(
+        '--hedge-after',
+        dest='hedgeAfter',
+        metavar='MS',
+        type=int,
+        default=0,
+        help=(
+            'repeat lookups slower than MS milliseconds, '
+            'default is 95th percentile of observed latency'
+        ),
+    )
+    parser.add_argument(
+        '--ldap-adaptive-rate',
+        dest='ldapAdaptiveRate',
+        default=False,
+        action='store_true',
+        help=(
+            'adapt ldap request rate to directory load, slow down on high '
+            'latency or busy, unwilling to perform and admin limit '
+            'exceeded responses'
+        ),
+    )
+    parser.add_argument(
+        '--ldap-max-rate',
+        dest='ldapMaxRate',
+        metavar='REQUESTS',
+        type=int,
+        help='never exceed REQUESTS ldap requests per second',
+    )
+    parser.add_argument(
+        '--ldap-latency',
+        dest='ldapLatency',
+        metavar='MS',
+        type=int,
+        default=200,
+        help=(
+            'average ldap request latency above which adaptive rate '
+            'slows down, default is 200'
+        ),
+    )
+    parser.add_argument(
+        '--global-catalog',
+        dest='globalCatalog',
+        default=False,
+        action='store_true',
+        help=(
+            'active directory only, resolve entries of whole forest '
+            'using global catalog'
+        ),
+    )
+    parser.add_argument(
+        '--forest',
+        dest='forest',
+        metavar='DNS',
+        help=(
+            'active directory forest root domain used to locate global '
+            'catalog servers, default is domain name'
+        ),
+    )
+    parser.add_argument(
+        '--sync',
+        default=False,
+        action='store_true',
+        help=(
+            'add users, groups and permissions that were added to legacy '
+            'domain since previous conversion'
+        ),
+    )
+    parser.add_argument(
+        '--buffer-size',
+        dest='bufferSize',
+        metavar='ROWS',
+        type=int,
+        default=100,
+        help=(
+            'amount of rows to fetch and entries to resolve at once, '
+            'default is 100'
+        ),
+    )
+    parser.add_argument(
+        '--queue-size',
+        dest='queueSize',
+        metavar='ROWS',
+        type=int,
+        default=0,
+        help=(
+            'overlap database reads, directory lookups and database writes '
+            'with at most ROWS rows queued between stages, '
+            'default is 0 to run stages sequentially'
+        ),
+    )
+    parser.add_argument(
+        '--parallel-reads',
+        dest='parallelReads',
+        default=False,
+        action='store_true',
+        help=(
+            'read legacy users, groups, permissions and subscriptions '
+            'concurrently from single exported database snapshot, '
+            'requires --queue-size'
+        ),
+    )
+    parser.add_argument(
+        '--chunk-size',
+        dest='chunkSize',
+        metavar='ROWS',
+        type=int,
+        default=0,
+        help=(
+            'commit every ROWS inserted rows, requires --journal, '
+            'default is 0 to convert within single transaction'
+        ),
+    )
+    parser.add_argument(
+        '--throttle',
+        dest='throttle',
+        metavar='ROWS',
+        type=int,
+        default=0,
+        help=(
+            'low impact mode, insert at most ROWS rows per second and '
+            'slow down further while database latency is high, '
+            'default is 0 to insert at full speed'
+        ),
+    )
+    parser.add_argument(
+        '--throttle-latency',
+        dest='throttleLatency',
+        metavar='MS',
+        type=int,
+        default=50,
+        help=(
+            'average statement latency above which throttled writes '
+            'slow down, default is 50'
+        ),
+    )
+    parser.add_argument(
+        '--lock-timeout',
+        dest='lockTimeout',
+        metavar='MS',
+        type=int,
+        help=(
+            'database lock_timeout of conversion session, '
+            'default is 3000 when throttled'
+        ),
+    )
+    parser.add_argument(
+        '--statement-timeout',
+        dest='statementTimeout',
+        metavar='MS',
+        type=int,
+        help=(
+            'database statement_timeout of conversion session, '
+            'default is 60000 when throttled, verification uses '
+            '--verify-statement-timeout instead'
+        ),
+    )
+    parser.add_argument(
+        '--verify-statement-timeout',
+        dest='verifyStatementTimeout',
+        metavar='MS',
+        type=int,
+        default=0,
+        help=(
+            'database statement_timeout of conversion verification '
+            'when --statement-timeout is in effect, default is 0 '
+            '(no timeout)'
+        ),
+    )
+    parser.add_argument(
+        '--journal',
+        dest='journal',
+        metavar='FILE',
+        help=(
+            'record committed chunks into journal, requires '
+            '--chunk-size, an existing journal resumes interrupted '
+            'conversion'
+        ),
+    )
+    parser.add_argument(
+        '--journal-rollback',
+        dest='journalRollback',
+        default=False,
+        action='store_true',
+        help='delete rows recorded in journal instead of converting',
+    )
+    parser.add_argument(
+        '--shard',
+        dest='shard',
+        metavar='I/N',
+        help=(
+            'resolve only shard I of N of users and groups and write '
+            'result into --shard-output, database is not modified'
+        ),
+    )
+    parser.add_argument(
+        '--shard-output',
+        dest='shardOutput',
+        metavar='FILE',
+        help='shard result file',
+    )
+    parser.add_argument(
+        '--merge-shards',
+        dest='mergeShards',
+        metavar='FILE',
+        action='append',
+        help=(
+            'convert using users and groups of shard result files '
+            'instead of directory lookups, may be specified multiple times'
+        ),
+    )
+    parser.add_argument(
+        '--create-indexes',
+        dest='createIndexes',
+        default=False,
+        action='store_true',
+        help=(
+            'create missing indexes supporting conversion queries, '
+            'indexes are dropped when conversion ends'
+        ),
+    )
+    parser.add_argument(
+        '--profile-cpu',
+        dest='profileCpu',
+        metavar='FILE',
+        help='write cProfile statistics of conversion into FILE',
+    )
+    parser.add_argument(
+        '--profile-memory',
+        dest='profileMemory',
+        default=False,
+        action='store_true',
+        help='log top memory allocations after each conversion phase',
+    )
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    if args.bufferSize < 1:
+        raise RuntimeError('Buffer size must be positive')
+
+    if args.ldif and args.apply:
+        raise RuntimeError('LDIF source can be used only without --apply')
+
+    if args.ldif and args.hedge:
+        raise RuntimeError('LDIF source cannot be combined with --hedge')
+
+    if args.ldif and (args.ldapAdaptiveRate or args.ldapMaxRate):
+        raise RuntimeError('LDIF source cannot be combined with rate limit')
+
+    if args.ldapMaxRate is not None and args.ldapMaxRate < 1:
+        raise RuntimeError('Ldap max rate must be positive')
+
+    if args.shard:
+        args.shard = ShardResult.parse(args.shard)
+        if not args.shardOutput:
+            raise RuntimeError('Shard mode requires --shard-output')
+        if args.sync or args.journal or args.mergeShards:
+            raise RuntimeError(
+                'Shard mode cannot be combined with --sync, --journal '
+                'or --merge-shards'
+            )
+
+    if args.queueSize < 0:
+        raise RuntimeError('Queue size cannot be negative')
+
+    if args.parallelReads and not args.queueSize:
+        raise RuntimeError('Parallel reads require --queue-size')
+
+    if args.chunkSize < 0:
+        raise RuntimeError('Chunk size cannot be negative')
+
+    if args.chunkSize and not args.journal:
+        raise RuntimeError('Chunked commit mode requires --journal')
+
+    if args.chunkSize and not args.apply:
+        raise RuntimeError('Chunked commit mode requires --apply')
+
+    if args.journalRollback and not args.journal:
+        raise RuntimeError('Journal rollback requires --journal')
+
+    #
+    # rows are journaled only when committed in chunks,
+    # rollback of such journal would remove nothing.
+    #
+    if args.journal and not args.chunkSize and not args.journalRollback:
+        raise RuntimeError('Journal requires --chunk-size')
+
+    if args.throttle < 0 or args.throttleLatency < 0:
+        raise RuntimeError('Throttle cannot be negative')
+
+    if args.throttle:
+        if args.lockTimeout is None:
+            args.lockTimeout = 3000
+        if args.statementTimeout is None:
+            args.statementTimeout = 60000
+
+    if args.domain == args.profile:
+        raise RuntimeError(
+            'Profile cannot be the same as domain',
+        )
+
+    if not args.profile:
+        args.profile = '%s-new' % args.domain
+
+    if not args.authnName:
+        args.authnName = '%s-authn' % args.profile
+
+    if not args.authzName:
+        args.authzName = '%s-authz' % args.profile
+
+    if args.cacert == 'NONE':
+        args.cacert = None
 
     return args
 
 
+def connectDriver(args, engine, statement):
+    logger = logging.getLogger(utils.Base.LOG_PREFIX)
+
+    logger.info('Loading options')
+    domainEntry = utils.VdcOptions(statement).getDomainEntry(
+        args.domain,
+    )
+    if not all([domainEntry.values()]):
+        raise RuntimeError(
+            "Domain '%s' does not exist. Exiting." % args.domain
+        )
+
+    domainEntry['password'] = utils.OptionDecrypt(
+        prefix=engine.prefix
+    ).decrypt(
+        domainEntry['password'],
+    )
+    if args.ldapServers:
+        domainEntry['ldapServers'] = args.ldapServers.split(',')
+
+    if args.globalCatalog and domainEntry['provider'] != 'ad':
+        raise RuntimeError(
+            'Global catalog is supported only by active directory'
+        )
+
+    def createDriver():
+        driver = getDriver(domainEntry['provider'])(
+            utils.Kerberos(engine.prefix),
+            args.domain,
+        )
+        if args.globalCatalog:
+            driver.enableGlobalCatalog(args.forest or args.domain)
+        return driver
+
+    if args.ldif:
+        logger.info("Loading LDIF '%s'", args.ldif)
+        driver = LDIFLDAP(
+            createDriver(),
+            args.ldif,
+            args.ldifNamespace or ','.join(
+                'DC=%s' % dc for dc in args.domain.split('.')
+            ),
+        )
+        driver.load(args.domain, args.bindUser, args.bindPassword)
+        return domainEntry, driver
+
+    def connect():
+        driver = createDriver()
+        driver.connect(
+            dnsDomain=args.domain,
+            ldapServers=domainEntry['ldapServers'],
+            saslUser=domainEntry['user'],
+            bindUser=args.bindUser,
+            bindPassword=(
+                args.bindPassword if args.bindPassword
+                else domainEntry['password']
+            ),
+            krb5conf=args.krb5conf,
+            protocol=args.protocol,
+            port=args.port,
+            cacert=args.cacert,
+        )
+        return driver
+
+    #
+    # bound driver is kept by persistent engine, a lost
+    # connection is recovered by the driver itself.
+    #
+    driver = engine.getResource(
+        (
+            'driver',
+            args.domain,
+            domainEntry['provider'],
+            tuple(domainEntry['ldapServers'] or ()),
+            domainEntry['user'],
+            domainEntry['password'],
+            args.bindUser,
+            args.bindPassword,
+            args.krb5conf,
+            args.protocol,
+            args.port,
+            args.cacert,
+            args.globalCatalog,
+            args.forest,
+            args.hedge,
+        ),
+        connect,
+    )
+    if args.hedge:
+        driver.enableHedging(
+            after=args.hedgeAfter / 1000.0 if args.hedgeAfter else None,
+        )
+    #
+    # rate is per job, reused driver
+    # must not keep limit of previous job.
+    #
+    if args.ldapAdaptiveRate or args.ldapMaxRate:
+        driver.enableRateLimit(
+            maxRate=args.ldapMaxRate,
+            adaptive=args.ldapAdaptiveRate,
+            latency=args.ldapLatency / 1000.0,
+        )
+    else:
+        driver.disableRateLimit()
+    return domainEntry, driver
+
+
+def legacyFetches(args, externalId=None):
+    return dict(
+        users=(
+            (
+                lambda dao: dao.fetchPendingLegacyUsers(
+                    args.domain,
+                    args.authzName,
+                    externalId,
+                    stream=True,
+                )
+            ) if args.sync
+            else (lambda dao: dao.fetchLegacyUsers(args.domain, stream=True))
+        ),
+        groups=(
+            (
+                lambda dao: dao.fetchPendingLegacyGroups(
+                    args.domain,
+                    args.authzName,
+                    externalId,
+                    stream=True,
+                )
+            ) if args.sync
+            else (lambda dao: dao.fetchLegacyGroups(args.domain, stream=True))
+        ),
+        permissions=(
+            (
+                lambda dao: dao.fetchDomainPermissions(
+                    args.domain,
+                    stream=True,
+                )
+            ) if args.sync
+            else (lambda dao: dao.fetchAllPermissions(stream=True))
+        ),
+        subscriptions=(
+            (
+                lambda dao: dao.fetchDomainSubscriptions(
+                    args.domain,
+                    stream=True,
+                )
+            ) if args.sync
+            else (lambda dao: dao.fetchAllSubscriptions(stream=True))
+        ),
+    )
+
+
+def getExternalIdExpression(engine, domain):
+    statement = engine.getStatement()
+    with statement:
+        provider = utils.VdcOptions(statement).getDomainEntry(
+            domain,
+        )['provider']
+    return getDriver(provider).getExternalIdExpression('l.external_id')
+
+
 def convert(args, engine):
+    externalId = None
+    if args.sync:
+        #
+        # legacy entries of sync are read only when missing
+        # in authz, the directory is not known yet.
+        #
+        externalId = getExternalIdExpression(engine, args.domain)
+    with LegacyReads(engine, args, legacyFetches(args, externalId)) as reads:
+        _convert(args, engine, reads)
 
-    DRIVERS = {
-        'ad': ADLDAP,
-        'ipa': IPALDAP,
-        'rhds': RHDSLDAP,
-        'openldap': OpenLDAP,
-    }
+
+def _convert(args, engine, reads):
 
     logger = logging.getLogger(utils.Base.LOG_PREFIX)
 
+    memoryProfiler = utils.MemoryProfiler(enabled=args.profileMemory)
+
     logger.info('Connecting to database')
     statement = engine.getStatement()
 
     with utils.FileTransaction() as filetransaction:
         with statement:
-            aaadao = AAADAO(statement)
+            statement.setTimeouts(
+                lockTimeout=args.lockTimeout,
+                statementTimeout=args.statementTimeout,
+            )
+            aaadao = AAADAO(statement, bufferSize=args.bufferSize)
+
+            journal = None
+            if args.journal:
+                journal = ConversionJournal(args.journal)
+                if journal.exists():
+                    logger.info('Resuming from journal %s', args.journal)
+                    journal.load()
+                    if journal.isComplete():
+                        raise RuntimeError(
+                            "Journal '%s' belongs to completed conversion" % (
+                                args.journal,
+                            )
+                        )
+                    resolvePendingJournal(journal, aaadao)
+                journal.open(args.domain, args.authzName)
 
             logger.info('Sanity checks')
-            if aaadao.isAuthzExists(args.authzName):
+            if (
+                not args.sync and
+                aaadao.isAuthzExists(args.authzName) and
+                not (journal and any(
+                    journal.getIds(t) for t in ConversionJournal.TABLES
+                ))
+            ):
                 raise RuntimeError(
                     "User/Group from domain '%s' exists in database" % (
                         args.authzName
                     )
                 )
 
-            logger.info('Loading options')
-            domainEntry = utils.VdcOptions(statement).getDomainEntry(
-                args.domain,
-            )
-            if not all([domainEntry.values()]):
-                raise RuntimeError(
-                    "Domain '%s' does not exist. Exiting." % args.domain
-                )
-
-            domainEntry['password'] = utils.OptionDecrypt(
-                prefix=engine.prefix
-            ).decrypt(
-                domainEntry['password'],
-            )
-            if args.ldapServers:
-                domainEntry['ldapServers'] = args.ldapServers.split(',')
-
-            driver = DRIVERS.get(domainEntry['provider'])
-            if driver is None:
-                raise RuntimeError(
-                    "Provider '%s' is not supported" % domainEntry['provider']
-                )
-
-            driver = driver(utils.Kerberos(engine.prefix), args.domain)
-            driver.connect(
-                dnsDomain=args.domain,
-                ldapServers=domainEntry['ldapServers'],
-                saslUser=domainEntry['user'],
-                bindUser=args.bindUser,
-                bindPassword=(
-                    args.bindPassword if args.bindPassword
-                    else domainEntry['password']
-                ),
-                krb5conf=args.krb5conf,
-                protocol=args.protocol,
-                port=args.port,
-                cacert=args.cacert,
-            )
+            domainEntry, driver = connectDriver(args, engine, statement)
 
             aaaprofile = AAAProfile(
                 profile=args.profile,
@@ -1173,11 +3402,100 @@ def convert(args, engine):
                 prefix=engine.prefix,
             )
 
+            convertedUsers = {}
+            convertedGroups = {}
+            if args.sync:
+                if not aaaprofile.exists():
+                    raise RuntimeError(
+                        "Authz '%s' configuration does not exist, "
+                        "cannot synchronize" % args.authzName
+                    )
+                logger.info('Indexing entries of %s', args.authzName)
+                externalId = getDriver(
+                    domainEntry['provider']
+                ).getExternalIdExpression('l.external_id')
+                convertedUsers, convertedGroups = [
+                    dict(
+                        (
+                            Record.toUUID(e['legacy_id']),
+                            Record.toUUID(e['new_id']),
+                        )
+                        for e in aaadao.fetchConvertedIds(
+                            table,
+                            ConversionJournal.ID_COLUMNS[table],
+                            args.domain,
+                            args.authzName,
+                            externalId,
+                        )
+                    )
+                    for table in ('users', 'ad_groups')
+                ]
+
+            resolveUsers = driver.getUsers
+            resolveGroups = driver.getGroups
+            if args.mergeShards:
+                logger.info('Loading shard results')
+                shardResults = ShardResults(args.mergeShards)
+                shardResults.load(args.domain)
+                resolveUsers = shardResults.getUsers
+                resolveGroups = shardResults.getGroups
+
+            verifier = ConversionVerifier(aaadao, args.authzName)
+            verifier.begin()
+            throttle = None
+            if args.throttle:
+                logger.info(
+                    'Throttling writes to %s rows/s',
+                    args.throttle,
+                )
+                throttle = utils.Throttle(
+                    args.throttle,
+                    latency=args.throttleLatency / 1000.0,
+                )
+                statement.setLatencyObserver(throttle.observe)
+            writer = ChunkedWriter(
+                statement=statement,
+                chunkSize=args.chunkSize,
+                journal=journal,
+                verifier=verifier,
+                throttle=throttle,
+            )
+            #
+            # totals are unknown in sync mode, only
+            # entries missing in authz are read.
+            #
+            totals = (
+                {} if args.sync
+                else aaadao.countLegacyEntries(args.domain)
+            )
+
+            memoryProfiler.snapshot('setup')
             logger.info('Converting users')
-            users = {}
-            for legacyUser in aaadao.fetchLegacyUsers(args.domain):
+            userIds = journalIds(journal, 'users')
+            userIds.update(convertedUsers)
+            progress = newProgress(
+                'Users',
+                totals,
+                'users',
+                userIds,
+                'lookups',
+            )
+            for legacyUser, e in utils.stage(
+                resolveLegacyEntries(
+                    pendingLegacyEntries(
+                        reads.get('users', aaadao),
+                        'user_id',
+                        userIds,
+                    ),
+                    resolveUsers,
+                    driver.getExternalId,
+                    args.bufferSize,
+                ),
+                args.queueSize,
+                'resolve-users',
+            ):
                 logger.debug("Converting user '%s'", legacyUser['username'])
-                e = driver.getUser(entryId=legacyUser['external_id'])
+                progress.update(notFound=e is None)
                 if e is None:
                     logger.warning(
                         (
@@ -1188,19 +3506,48 @@ def convert(args, engine):
                         legacyUser['external_id'],
                     )
                 else:
-                    e.update({
-                        'domain': args.authzName,
-                        'last_admin_check_status': legacyUser[
-                            'last_admin_check_status'
-                        ],
-                    })
-                    users[legacyUser['user_id']] = e
+                    e.domain = args.authzName
+                    e.last_admin_check_status = legacyUser[
+                        'last_admin_check_status'
+                    ]
+                    userIds[Record.toUUID(legacyUser['user_id'])] = e.user_id
+                    writer.write(
+                        'users',
+                        legacyUser['user_id'],
+                        Record.fromUUID(e.user_id),
+                        aaadao.insertUser,
+                        e,
+                    )
+            writer.flush()
+            progress.close()
+            memoryProfiler.snapshot('users')
 
             logger.info('Converting groups')
-            groups = {}
-            for legacyGroup in aaadao.fetchLegacyGroups(args.domain):
+            groupIds = journalIds(journal, 'ad_groups')
+            groupIds.update(convertedGroups)
+            progress = newProgress(
+                'Groups',
+                totals,
+                'ad_groups',
+                groupIds,
+                'lookups',
+            )
+            for legacyGroup, e in utils.stage(
+                resolveLegacyEntries(
+                    pendingLegacyEntries(
+                        reads.get('groups', aaadao),
+                        'id',
+                        groupIds,
+                    ),
+                    resolveGroups,
+                    driver.getExternalId,
+                    args.bufferSize,
+                ),
+                args.queueSize,
+                'resolve-groups',
+            ):
                 logger.debug("Converting group '%s'", legacyGroup['name'])
-                e = driver.getGroup(entryId=legacyGroup['external_id'])
+                progress.update(notFound=e is None)
                 if e is None:
                     logger.warning(
                         (
@@ -1211,56 +3558,157 @@ def convert(args, engine):
                         legacyGroup['external_id'],
                     )
                 else:
-                    e['domain'] = args.authzName
-                    groups[legacyGroup['id']] = e
+                    e.domain = args.authzName
+                    groupIds[Record.toUUID(legacyGroup['id'])] = e.id
+                    writer.write(
+                        'ad_groups',
+                        legacyGroup['id'],
+                        Record.fromUUID(e.id),
+                        aaadao.insertGroup,
+                        e,
+                    )
+            writer.flush()
+            progress.close()
+            memoryProfiler.snapshot('groups')
 
             logger.info('Converting permissions')
-            permissions = []
-            for perm in aaadao.fetchAllPermissions():
-                group = groups.get(perm['ad_element_id'])
-                if group is not None:
-                    perm['id'] = str(uuid.uuid4())
-                    perm['ad_element_id'] = group['id']
-                    permissions.append(perm)
-                else:
-                    user = users.get(perm['ad_element_id'])
-                    if user is not None:
-                        perm['id'] = str(uuid.uuid4())
-                        perm['ad_element_id'] = user['user_id']
-                        permissions.append(perm)
+            done = journalIds(journal, 'permissions')
+            progress = newProgress(
+                'Permissions',
+                totals,
+                'permissions',
+                done,
+                'rows',
+            )
+            if args.sync:
+                mirrored = set(
+                    (e.role_id, e.ad_element_id, e.object_id)
+                    for e in aaadao.fetchDomainPermissions(
+                        args.authzName,
+                        stream=True,
+                    )
+                )
+            else:
+                mirrored = set()
+            for perm in reads.get('permissions', aaadao):
+                progress.update()
+                if perm.id in done:
+                    continue
+                elementId = groupIds.get(
+                    perm.ad_element_id,
+                    userIds.get(perm.ad_element_id),
+                )
+                if (
+                    elementId is not None and
+                    (
+                        perm.role_id,
+                        elementId,
+                        perm.object_id,
+                    ) not in mirrored
+                ):
+                    legacyId = Record.fromUUID(perm.id)
+                    perm.id = uuid.uuid4().bytes
+                    perm.ad_element_id = elementId
+                    writer.write(
+                        'permissions',
+                        legacyId,
+                        Record.fromUUID(perm.id),
+                        aaadao.insertPermission,
+                        perm,
+                    )
+            writer.flush()
+            progress.close()
+            memoryProfiler.snapshot('permissions')
 
             logger.info('Converting event subscriptions')
-            subscriptions = []
-            for subscription in aaadao.fetchAllSubscriptions():
-                user = users.get(subscription['subscriber_id'])
-                if user:
-                    subscription['subscriber_id'] = user['user_id']
-                    subscriptions.append(subscription)
-
-            logger.info('Adding new users')
-            for user in users.values():
-                aaadao.insertUser(user)
-            aaadao.fetchLegacyUsers(args.authzName)  # For debug purposes
-
-            logger.info('Adding new groups')
-            for group in groups.values():
-                aaadao.insertGroup(group)
-            aaadao.fetchLegacyGroups(args.authzName)  # For debug purposes
-
-            logger.info('Adding new permissions')
-            for permission in permissions:
-                aaadao.insertPermission(permission)
-            aaadao.fetchAllPermissions()  # For debug purposes
-
-            logger.info('Adding new subsriptions')
-            for subscription in subscriptions:
-                aaadao.insertSubscription(subscription)
-            aaadao.fetchAllSubscriptions()  # For debug purposes
-
-            logger.info('Creating new extensions configuration')
-            aaaprofile.save()
+            done = journal.getIds('event_subscriber') if journal else {}
+            progress = newProgress(
+                'Subscriptions',
+                totals,
+                'event_subscriber',
+                done,
+                'rows',
+            )
+            if args.sync:
+                mirrored = set(
+                    tuple(e[k] for k in ConversionJournal.SUBSCRIPTION_KEY)
+                    for e in aaadao.fetchDomainSubscriptions(
+                        args.authzName,
+                        stream=True,
+                    )
+                )
+            else:
+                mirrored = set()
+            for subscription in reads.get('subscriptions', aaadao):
+                progress.update()
+                key = tuple(
+                    subscription[k] for k in ConversionJournal.SUBSCRIPTION_KEY
+                )
+                if key in done:
+                    continue
+                subscriberId = Record.fromUUID(
+                    userIds.get(Record.toUUID(subscription['subscriber_id']))
+                )
+                if (
+                    subscriberId and
+                    (subscriberId,) + key[1:] not in mirrored
+                ):
+                    subscription['subscriber_id'] = subscriberId
+                    writer.write(
+                        'event_subscriber',
+                        key,
+                        subscriberId,
+                        aaadao.insertSubscription,
+                        subscription,
+                    )
+            writer.flush()
+            progress.close()
+            memoryProfiler.snapshot('subscriptions')
+
+            logger.info('Verifying conversion')
+            if args.statementTimeout is not None:
+                #
+                # verification scans whole tables, it is
+                # not bounded by conversion statement timeout.
+                #
+                statement.setTimeouts(
+                    statementTimeout=args.verifyStatementTimeout,
+                )
+            verifier.log(verifier.verify())
+            if args.statementTimeout is not None:
+                statement.setTimeouts(
+                    statementTimeout=args.statementTimeout,
+                )
+
+            if args.sync:
+                logger.info(
+                    (
+                        'Synchronized %s users, %s groups, %s permissions '
+                        'and %s subscriptions'
+                    ),
+                    writer.getCount('users'),
+                    writer.getCount('ad_groups'),
+                    writer.getCount('permissions'),
+                    writer.getCount('event_subscriber'),
+                )
+            else:
+                logger.info('Creating new extensions configuration')
+                aaaprofile.save()
 
             logger.info('Conversion completed')
+            if args.hedge:
+                driver.logHedgeStats()
+            if args.ldapAdaptiveRate or args.ldapMaxRate:
+                driver.logRateStats()
+            if throttle is not None:
+                logger.info(
+                    'Throttled writes waited %.1f seconds',
+                    throttle.waited,
+                )
+            logger.info(
+                'Memory high-water mark: %s KiB',
+                utils.getMemoryHighWaterMark(),
+            )
 
             if args.cacert is None:
                 logger.warning(
@@ -1282,6 +3730,219 @@ def convert(args, engine):
                     'Apply parameter was not specified rolling back'
                 )
 
+            if journal:
+                journal.complete()
+
+
+def _readLegacyRowsStage(statement, bufferSize, fetch):
+    #
+    # reads are performed using own connection, so they
+    # do not interfere with the transaction of the writer.
+    #
+    with statement:
+        for e in fetch(AAADAO(statement, bufferSize=bufferSize)):
+            yield e
+
+
+def resolveShard(args, engine):
+    fetches = legacyFetches(args)
+    with LegacyReads(
+        engine,
+        args,
+        dict(users=fetches['users'], groups=fetches['groups']),
+    ) as reads:
+        _resolveShard(args, engine, reads)
+
+
+def _resolveShard(args, engine, reads):
+    logger = logging.getLogger(utils.Base.LOG_PREFIX)
+    index, count = args.shard
+
+    logger.info('Connecting to database')
+    statement = engine.getStatement()
+    with statement:
+        aaadao = AAADAO(statement, bufferSize=args.bufferSize)
+        domainEntry, driver = connectDriver(args, engine, statement)
+
+        result = ShardResult(args.shardOutput)
+        result.open(args.domain, index, count)
+        for kind, resolve in (
+            ('user', driver.getUsers),
+            ('group', driver.getGroups),
+        ):
+            logger.info('Resolving %ss of shard %s/%s', kind, index, count)
+            progress = utils.Progress(
+                '%ss' % kind.capitalize(),
+                unit='lookups',
+            )
+            for row, e in utils.stage(
+                resolveLegacyEntries(
+                    (
+                        row for row in reads.get('%ss' % kind, aaadao)
+                        if ShardResult.getShard(
+                            row['external_id'],
+                            count,
+                        ) == index
+                    ),
+                    resolve,
+                    driver.getExternalId,
+                    args.bufferSize,
+                ),
+                args.queueSize,
+                'resolve-%ss' % kind,
+            ):
+                progress.update(notFound=e is None)
+                result.add(kind, row['external_id'], e)
+            progress.close()
+        result.complete()
+        logger.info('Shard result written to %s', args.shardOutput)
+        if args.hedge:
+            driver.logHedgeStats()
+        if args.ldapAdaptiveRate or args.ldapMaxRate:
+            driver.logRateStats()
+
+
+def readLegacyRows(engine, aaadao, args, name, fetch):
+    if not args.queueSize:
+        return fetch(aaadao)
+    return utils.stage(
+        _readLegacyRowsStage(engine.getStatement(), args.bufferSize, fetch),
+        args.queueSize,
+        name,
+    )
+
+
+def newProgress(name, totals, table, done, unit):
+    total = totals.get(table)
+    if total is not None:
+        total = max(0, total - len(done))
+    return utils.Progress(name, total=total, unit=unit)
+
+
+def journalIds(journal, table):
+    ret = {}
+    if journal:
+        for k, v in journal.getIds(table).items():
+            ret[Record.toUUID(k)] = Record.toUUID(v)
+    return ret
+
+
+def pendingLegacyEntries(rows, idKey, ids):
+    for row in rows:
+        if Record.toUUID(row[idKey]) not in ids:
+            yield row
+
+
+def resolveLegacyEntries(rows, resolve, externalId, bufferSize):
+    for chunk in utils.chunks(rows, bufferSize):
+        entries = resolve([row['external_id'] for row in chunk])
+        for row in chunk:
+            yield row, entries.pop(externalId(row['external_id']), None)
+
+
+def resolvePendingJournal(journal, aaadao):
+    logger = logging.getLogger(utils.Base.LOG_PREFIX)
+    for seq, table, rows in journal.getPending():
+        key, newId = rows[0]
+        if table == 'event_subscriber':
+            subscription = dict(
+                zip(ConversionJournal.SUBSCRIPTION_KEY, key)
+            )
+            subscription['subscriber_id'] = newId
+            committed = aaadao.isSubscriptionExists(subscription)
+        else:
+            committed = bool(
+                aaadao.fetchExistingIds(
+                    table,
+                    ConversionJournal.ID_COLUMNS[table],
+                    [newId],
+                )
+            )
+        logger.debug(
+            "Journal batch %s of '%s' committed=%s",
+            seq,
+            table,
+            committed,
+        )
+        journal.resolvePending(seq, committed)
+
+
+def rollbackJournal(args, engine):
+
+    logger = logging.getLogger(utils.Base.LOG_PREFIX)
+
+    journal = ConversionJournal(args.journal)
+    if not journal.exists():
+        raise RuntimeError("Journal '%s' does not exist" % args.journal)
+    journal.load()
+
+    logger.info('Connecting to database')
+    statement = engine.getStatement()
+
+    with statement:
+        statement.setTimeouts(
+            lockTimeout=args.lockTimeout,
+            statementTimeout=args.statementTimeout,
+        )
+        aaadao = AAADAO(statement)
+
+        for table in reversed(ConversionJournal.TABLES):
+            ids = journal.getAllNewIds(table)
+            logger.info("Deleting %s rows from '%s'", len(ids), table)
+            aaadao.deleteRows(
+                table,
+                ConversionJournal.ID_COLUMNS[table],
+                ids,
+            )
+
+        if not args.apply:
+            raise RollbackError(
+                'Apply parameter was not specified rolling back'
+            )
+
+    journal.remove()
+    logger.info('Journal rollback completed')
+
+
+def run(args, engine):
+    logger = logging.getLogger(utils.Base.LOG_PREFIX)
+    ret = 1
+    try:
+        if args.journalRollback:
+            rollbackJournal(args=args, engine=engine)
+        else:
+            with utils.SupportingIndexes(
+                engine=engine,
+                indexes=(
+                    ('users', 'domain', args.domain),
+                    ('ad_groups', 'domain', args.domain),
+                    ('permissions', 'ad_element_id', NULL_ID),
+                    ('event_subscriber', 'subscriber_id', NULL_ID),
+                ),
+                enabled=args.createIndexes,
+            ):
+                utils.runProfiled(
+                    args.profileCpu,
+                    resolveShard if args.shard else convert,
+                    args=args,
+                    engine=engine,
+                )
+        ret = 0
+    except RollbackError as e:
+        logger.warning('%s', e)
+    except Exception as e:
+        logger.error('Conversion failed: %s', e)
+        logger.debug('Exception', exc_info=True)
+        if args.chunkSize:
+            logger.info(
+                (
+                    'Committed chunks are recorded in %s, re-run to resume '
+                    'or use --journal-rollback to remove them'
+                ),
+                args.journal,
+            )
+    return ret
+
 
 def main():
     try:
@@ -1290,7 +3951,11 @@ def main():
         sys.stderr.write('Error: %s\n' % e)
         return 1
 
-    utils.setupLogger(log=args.log, debug=args.debug)
+    utils.setupLogger(
+        log=args.log,
+        debug=args.debug,
+        rotateSize=args.logRotate * 1024 * 1024,
+    )
     logger = logging.getLogger(utils.Base.LOG_PREFIX)
     logger.info(
         'tool: %s-%s (%s)',
@@ -1302,16 +3967,7 @@ def main():
 
     engine = utils.Engine(prefix=args.prefix)
     engine.setupEnvironment()
-    ret = 1
-    try:
-        convert(args=args, engine=engine)
-        ret = 0
-    except RollbackError as e:
-        logger.warning('%s', e)
-    except Exception as e:
-        logger.error('Conversion failed: %s', e)
-        logger.debug('Exception', exc_info=True)
-    return ret
+    return run(args, engine)
 
 
 if __name__ == '__main__':